@@ -30,6 +30,7 @@ from __future__ import division
 from math import sqrt, sin, cos, asin, pi, degrees, ceil, floor
 from copy import deepcopy
 
+import numpy as np
 
 from core.point import Point
 
@@ -432,12 +433,10 @@ class ArcGeo(object):
             alpha = 2 * asin(s / (2 * self.r))
             segments = int(abs(self.ext // alpha))
 
-            string = ""
-
-            for i in range(1, segments + 1):
-                Pe = self.get_point_from_start(i, segments)
-                string += PostPro.lin_pol_xy(Ps, Pe)
-                Ps = Pe
+            # The end points of all segments (see get_point_from_start)
+            angs = self.s_ang + np.arange(1, segments + 1) * self.ext / segments
+            string = PostPro.lin_pol_xy_points(Ps, self.O.x + np.cos(angs) * self.r,
+                                               self.O.y + np.sin(angs) * self.r)
         else:
             if self.ext > 0:
                 string = PostPro.lin_pol_arc(
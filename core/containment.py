@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+############################################################################
+#
+#   Copyright (C) 2008-2015
+#    Christian Kohlöffel
+#    Vinzenz Schulz
+#    Jean-Paul Schouwstra
+#
+#   This file is part of DXF2GCODE.
+#
+#   DXF2GCODE is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DXF2GCODE is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with DXF2GCODE.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+from __future__ import absolute_import
+from __future__ import division
+
+from math import ceil, pi
+
+import numpy as np
+
+from core.linegeo import LineGeo
+from core.arcgeo import ArcGeo
+from postpro.spatialindex import BoxIndex
+
+import logging
+logger = logging.getLogger("Core.Containment")
+
+
+class ContainmentTree(object):
+    """
+    Finds for each closed shape the smallest closed shape it lies in (its
+    parent). Shapes without a parent have the level 0, the shapes inside them
+    the level 1 (e.g. holes of a part), the shapes inside those the level 2
+    and so on. Open shapes and drill holes are not part of the tree.
+    """
+    def __init__(self, shapes, arc_step=pi / 8):
+        """
+        @param shapes: list of the shapes (e.g. of one layer)
+        @param arc_step: The max angle of an arc between two polygon points
+        """
+        self.shapes = shapes
+        self.arc_step = arc_step
+        self.parents = [None] * len(shapes)
+        self.levels = [None] * len(shapes)
+
+        self.nrs = [nr for nr, shape in enumerate(shapes)
+                    if shape.closed and shape.type != 'Hole' and len(shape.geos)]
+        self.polygons = [self.make_polygon(shapes[nr]) for nr in self.nrs]
+        self.build()
+
+    def make_polygon(self, shape):
+        """
+        @return: array of the points of the shape with shape (n, 2), arcs are
+        approximated by lines
+        """
+        Pts = []
+        for geo in shape.geos.abs_iter():
+            if isinstance(geo, ArcGeo):
+                segments = max(2, int(ceil(abs(geo.ext) / self.arc_step)))
+                for i in range(segments):
+                    P = geo.get_point_from_start(i, segments)
+                    Pts.append((P.x, P.y))
+            elif isinstance(geo, LineGeo):
+                Pts.append((geo.Ps.x, geo.Ps.y))
+        return np.array(Pts, dtype=float).reshape(-1, 2)
+
+    def build(self):
+        """
+        Searches the parents. Only the shapes whose bounding box contains the
+        one of the shape and which are bigger are tested, starting with the
+        smallest one. The bounding boxes which overlap the one of the shape
+        are looked up in a BoxIndex.
+        """
+        if not self.nrs:
+            return
+
+        BBs = np.array([np.concatenate((poly.min(axis=0), poly.max(axis=0))) if len(poly)
+                        else (np.inf, np.inf, -np.inf, -np.inf) for poly in self.polygons])
+        areas = np.array([abs(self.calc_area(poly)) for poly in self.polygons])
+        valid = np.flatnonzero([len(poly) for poly in self.polygons])
+        index = BoxIndex(BBs[valid])
+
+        parents = [-1] * len(self.nrs)
+        for nr, poly in enumerate(self.polygons):
+            if not len(poly):
+                continue
+            BB = BBs[nr]
+            cands = valid[index.overlapping(*BB.tolist())]
+            cands = cands[(BBs[cands, 0] <= BB[0]) & (BBs[cands, 1] <= BB[1]) &
+                          (BBs[cands, 2] >= BB[2]) & (BBs[cands, 3] >= BB[3]) &
+                          (areas[cands] > areas[nr])]
+            # Test points spread over the shape, most of them have to be inside
+            test_pts = poly[np.linspace(0, len(poly) - 1, min(3, len(poly))).astype(int)]
+            for cand in cands[np.argsort(areas[cands], kind='stable')]:
+                inside = self.points_in_polygon(test_pts, self.polygons[cand])
+                if 2 * np.count_nonzero(inside) > len(inside):
+                    parents[nr] = cand
+                    break
+
+        # Levels from the outer shapes to the inner ones
+        levels = [None] * len(self.nrs)
+        for nr in np.argsort(-areas, kind='stable'):
+            levels[nr] = 0 if parents[nr] < 0 else levels[parents[nr]] + 1
+
+        for nr, shape_nr in enumerate(self.nrs):
+            self.parents[shape_nr] = None if parents[nr] < 0 else self.nrs[parents[nr]]
+            self.levels[shape_nr] = levels[nr]
+
+    def calc_area(self, poly):
+        """
+        @return: The signed area of the polygon (shoelace formula)
+        """
+        x, y = poly[:, 0], poly[:, 1]
+        return 0.5 * (np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+    def points_in_polygon(self, pts, poly):
+        """
+        Even-odd test of all points against all edges of the polygon at once.
+        @return: boolean array, True for the points inside the polygon
+        """
+        xs, ys = poly[:, 0], poly[:, 1]
+        xe, ye = np.roll(xs, -1), np.roll(ys, -1)
+        px, py = pts[:, 0, np.newaxis], pts[:, 1, np.newaxis]
+        crossing = (ys > py) != (ye > py)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = xs + (py - ys) * (xe - xs) / (ye - ys)
+        return np.count_nonzero(crossing & (px < x_cross), axis=1) % 2 == 1
+
+    def get_precedence(self, nrs):
+        """
+        @param nrs: list of the shape nrs which may be reordered
+        @return: list of the pairs (inner, outer) of positions in nrs, the
+        inner shapes have to be cut before the outer ones
+        """
+        pos = dict((shape_nr, nr) for nr, shape_nr in enumerate(nrs))
+        return [(pos[shape_nr], pos[parent]) for shape_nr, parent in enumerate(self.parents)
+                if parent is not None and shape_nr in pos and parent in pos]
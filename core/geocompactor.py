@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+############################################################################
+#
+#   Copyright (C) 2008-2015
+#    Christian Kohlöffel
+#    Vinzenz Schulz
+#    Jean-Paul Schouwstra
+#
+#   This file is part of DXF2GCODE.
+#
+#   DXF2GCODE is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DXF2GCODE is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with DXF2GCODE.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+from __future__ import absolute_import
+from __future__ import division
+
+from math import acos, ceil, pi
+
+import numpy as np
+
+from core.point import Point
+from core.linegeo import LineGeo
+from core.arcgeo import ArcGeo
+
+import logging
+logger = logging.getLogger("Core.GeoCompactor")
+
+
+class GeoCompactor(object):
+    """
+    Replaces runs of consecutive lines and arcs (e.g. tessellated polylines or
+    converted ellipses) by the fewest lines and arcs which stay within the
+    given tolerance of the original geometries. Corners which don't fit
+    within the tolerance are kept, as well as the start and end point of the
+    geometries.
+    """
+    def __init__(self, tol=0.001):
+        """
+        @param tol: The maximal distance of the new geometries to the original
+        ones
+        """
+        self.tol = tol
+
+    def compact(self, geos):
+        """
+        Compacts the given geometries.
+        @param geos: list of the geometries in the order of the contour
+        @return: list of the new geometries, unchanged geometries are reused
+        """
+        if len(geos) < 2:
+            return list(geos)
+
+        self.make_check_points(geos)
+
+        new_geos = []
+        i = 0
+        while i < len(geos):
+            if not self.compactable[i]:
+                new_geos.append(geos[i])
+                i += 1
+                continue
+
+            # Die Geometrien werden verdoppelt bis keine passt, dann wird das
+            # Ende per Bisektion gesucht
+            # The run is doubled until it doesn't fit, then the end is
+            # searched by bisection
+            j_fit, geo_fit = i, geos[i]
+            j_nofit = self.run_end[i] + 1
+            j = i + 1
+            while j < j_nofit:
+                geo = self.fit_run(i, j)
+                if geo is None:
+                    j_nofit = j
+                    break
+                j_fit, geo_fit = j, geo
+                j = min(i + 2 * (j - i), j_nofit - 1) if j < j_nofit - 1 else j_nofit
+
+            while j_nofit - j_fit > 1:
+                j = (j_fit + j_nofit) // 2
+                geo = self.fit_run(i, j)
+                if geo is None:
+                    j_nofit = j
+                else:
+                    j_fit, geo_fit = j, geo
+
+            new_geos.append(geo_fit)
+            i = j_fit + 1
+
+        return new_geos
+
+    def make_check_points(self, geos):
+        """
+        Collects the points against which the runs are checked. Lines are
+        represented by their end points, arcs by points with a sagitta of less
+        than half the tolerance in between.
+        """
+        Pts = []
+        self.pts_index = [0]
+        self.compactable = []
+        segments = []
+        self.segs_index = [0]
+        for geo in geos:
+            if isinstance(geo, LineGeo):
+                Pts += [(geo.Ps.x, geo.Ps.y), (geo.Pe.x, geo.Pe.y)]
+                segments.append((geo.Ps.x, geo.Ps.y, geo.Pe.x, geo.Pe.y))
+                self.compactable.append(True)
+            elif isinstance(geo, ArcGeo) and geo.r > 0.0:
+                step = 2 * acos(max(-1.0, 1 - self.tol / (2 * geo.r)))
+                nr = max(2, int(ceil(abs(geo.ext) / step)))
+                for k in range(nr + 1):
+                    P = geo.get_point_from_start(k, nr)
+                    Pts.append((P.x, P.y))
+                self.compactable.append(True)
+            else:
+                self.compactable.append(False)
+            self.pts_index.append(len(Pts))
+            self.segs_index.append(len(segments))
+
+        self.Pts = np.array(Pts, dtype=float).reshape(-1, 2)
+        self.segments = np.array(segments, dtype=float).reshape(-1, 4)
+
+        # Last geometry of the connected run which starts at each geometry
+        self.run_end = list(range(len(geos)))
+        for k in range(len(geos) - 2, -1, -1):
+            if (self.compactable[k] and self.compactable[k + 1] and
+                    geos[k].Pe.within_tol(geos[k + 1].Ps, self.tol * 1e-3)):
+                self.run_end[k] = self.run_end[k + 1]
+
+    def fit_run(self, i, j):
+        """
+        Searches a single line or arc for the geometries i to j.
+        @return: The new geometry or None if there is none within the tolerance
+        """
+        Pts = self.Pts[self.pts_index[i]:self.pts_index[j + 1]]
+        segments = self.segments[self.segs_index[i]:self.segs_index[j + 1]]
+        P0 = Pts[0]
+        Pn = Pts[-1]
+        chord = Pn - P0
+        chord_len = np.hypot(*chord)
+        if chord_len <= self.tol:
+            return None
+
+        # Zuerst wird eine Linie versucht / A line is tried first
+        t = np.clip(np.dot(Pts - P0, chord) / chord_len ** 2, 0.0, 1.0)
+        diff = np.hypot(*(Pts - P0 - t[:, np.newaxis] * chord).T)
+        if diff.max() <= self.tol:
+            return LineGeo(self.make_point(P0), self.make_point(Pn))
+
+        # Arc through the start, the middle (by length) and the end point
+        length = np.concatenate(([0.0], np.cumsum(np.hypot(*np.diff(Pts, axis=0).T))))
+        Pm = Pts[np.searchsorted(length, length[-1] / 2)]
+        cross = (Pm[0] - P0[0]) * (Pn[1] - Pm[1]) - (Pm[1] - P0[1]) * (Pn[0] - Pm[0])
+        if abs(cross) < 1e-12 * chord_len ** 2:
+            return None
+        a = np.dot(Pm, Pm) - np.dot(P0, P0)
+        b = np.dot(Pn, Pn) - np.dot(P0, P0)
+        d = 2 * ((Pm[0] - P0[0]) * (Pn[1] - P0[1]) - (Pm[1] - P0[1]) * (Pn[0] - P0[0]))
+        O = np.array(((a * (Pn[1] - P0[1]) - b * (Pm[1] - P0[1])) / d,
+                      (b * (Pm[0] - P0[0]) - a * (Pn[0] - P0[0])) / d))
+        r = np.hypot(*(P0 - O))
+        direction = 1 if cross > 0 else -1
+
+        s_ang = np.arctan2(P0[1] - O[1], P0[0] - O[0])
+        ext = (np.arctan2(Pn[1] - O[1], Pn[0] - O[0]) - s_ang) % (2 * pi)
+        if direction < 0:
+            ext = 2 * pi - ext
+
+        # The nearest points of the lines to the center need to be checked too
+        if len(segments):
+            Ps = segments[:, 0:2]
+            v = segments[:, 2:4] - Ps
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = np.clip(np.sum((O - Ps) * v, axis=1) / np.sum(v * v, axis=1), 0.0, 1.0)
+            Pts = np.vstack((Pts, Ps + np.nan_to_num(t)[:, np.newaxis] * v))
+
+        ang = (np.arctan2(Pts[:, 1] - O[1], Pts[:, 0] - O[0]) - s_ang) * direction % (2 * pi)
+        diff = np.where(ang <= ext,
+                        np.abs(np.hypot(Pts[:, 0] - O[0], Pts[:, 1] - O[1]) - r),
+                        np.minimum(np.hypot(*(Pts - P0).T), np.hypot(*(Pts - Pn).T)))
+        if diff.max() > self.tol:
+            return None
+
+        return ArcGeo(Ps=self.make_point(P0), Pe=self.make_point(Pn),
+                      O=self.make_point(O), r=float(r), direction=direction)
+
+    def make_point(self, P):
+        return Point(x=float(P[0]), y=float(P[1]))
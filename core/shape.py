@@ -36,6 +36,8 @@ from core.point import Point
 from core.linegeo import LineGeo
 from core.arcgeo import ArcGeo
 from core.holegeo import HoleGeo
+from core.breakgeo import BreakGeo
+from core.geocompactor import GeoCompactor
 
 from globals.six import text_type
 import globals.constants as c
@@ -315,6 +317,46 @@ class Shape(object):
         else:
             return ""
 
+    def Write_GCode_geos(self, geos, PostPro, cache=None, is_reversed=False):
+        """
+        Writes the geometries for one pass.
+        @param geos: The geometries to write
+        @param PostPro: this is the Postprocessor class including the methods
+        to export
+        @param cache: None or the state variables the code depends on (see
+        PostPro.get_plane_attrs) and a dict for the code of the passes. If
+        they have the same values as in an earlier pass in the same direction,
+        the code of this pass is reused.
+        @param is_reversed: True if the geometries are reversed
+        """
+        if cache is None:
+            return "".join([self.Write_GCode_for_geo(geo, PostPro) for geo in geos.abs_iter()])
+
+        attrs, codes = cache
+        key = (is_reversed, PostPro.get_state_key(attrs))
+        if key in codes:
+            exstr, state = codes[key]
+            PostPro.set_state(attrs, state)
+            return exstr
+
+        exstr = "".join([self.Write_GCode_for_geo(geo, PostPro) for geo in geos.abs_iter()])
+        codes[key] = (exstr, PostPro.get_state(attrs))
+        return exstr
+
+    def get_reversed_geos(self, geos):
+        """
+        Returns copies of the absolute geometries in the reverse order and
+        direction, e.g. for the passes of an open shape in the other
+        direction. The geometries themselves aren't changed.
+        @param geos: The geometries to reverse
+        @return: The reversed copies as Geos
+        """
+        reversed_geos = Geos([deepcopy(geo) for geo in geos.abs_iter()])
+        reversed_geos.reverse()
+        for geo in reversed_geos:
+            geo.reverse()
+        return reversed_geos
+
     def Write_GCode(self, PostPro):
         """
         This method returns the string to be exported for this shape, including
@@ -325,10 +367,10 @@ class Shape(object):
         if g.config.machine_type == 'drag_knife':
             return self.Write_GCode_Drag_Knife(PostPro)
 
-        prv_cut_cor = self.cut_cor
-        if (self.cut_cor != 40 and
+        cut_cor = self.cut_cor
+        if (cut_cor != 40 and
                 not g.config.vars.Cutter_Compensation["done_by_machine"]):
-            self.cut_cor = 40
+            cut_cor = 40
             new_geos = Geos(self.stmove.geos[1:])
         else:
             new_geos = self.geos
@@ -339,7 +381,7 @@ class Shape(object):
 
         new_geos = PostPro.breaks.getNewGeos(new_geos)
         # initialisation of the string
-        exstr = ""
+        exstr = []
 
         # Get the mill settings defined in the GUI
         safe_retract_depth = self.parentLayer.axis3_retract
@@ -354,8 +396,18 @@ class Shape(object):
         f_g1_plane = self.f_g1_plane
         f_g1_depth = self.f_g1_depth
 
-        # Save the initial Cutter correction in a variable
-        has_reversed = False
+        # Open shapes are cut back and forth. The geometries and the cutter
+        # correction of both directions are kept here, the reversed
+        # geometries are built at the first reversed pass. The shape itself
+        # isn't changed.
+        is_reversed = False
+        pass_geos = [new_geos, None]
+        if cut_cor == 41:
+            pass_cut_cors = [41, 42]
+        elif cut_cor == 42:
+            pass_cut_cors = [42, 41]
+        else:
+            pass_cut_cors = [cut_cor, cut_cor]
 
         # If the Output Format is DXF do not perform more then one cut.
         if PostPro.vars.General["output_type"] == 'dxf':
@@ -374,42 +426,49 @@ class Shape(object):
 
         mom_depth = initial_mill_depth
 
+        # Only the depth changes between the passes, so the code of the
+        # geometries is reused (breaks depend on the depth)
+        if (PostPro.cache_geos and mom_depth > depth and max_slice != 0.0 and
+                not any(isinstance(geo, BreakGeo) for geo in new_geos.abs_iter())):
+            geos_cache = (PostPro.get_plane_attrs(), {})
+        else:
+            geos_cache = None
+
         # Move the tool to the start.
-        exstr += self.stmove.geos.abs_el(0).Write_GCode(PostPro)
+        exstr.append(self.stmove.geos.abs_el(0).Write_GCode(PostPro))
 
         # Add string to be added before the shape will be cut.
-        exstr += PostPro.write_pre_shape_cut()
+        exstr.append(PostPro.write_pre_shape_cut())
 
         # Cutter radius compensation when G41 or G42 is on, AND cutter
         # compensation option is set to be done outside the piece
-        if self.cut_cor != 40 and PostPro.vars.General["cc_outside_the_piece"]:
-            exstr += PostPro.set_cut_cor(self.cut_cor)
+        if cut_cor != 40 and PostPro.vars.General["cc_outside_the_piece"]:
+            exstr.append(PostPro.set_cut_cor(cut_cor))
 
-            exstr += PostPro.chg_feed_rate(f_g1_plane)
-            exstr += self.stmove.geos.abs_el(1).Write_GCode(PostPro)
-            exstr += self.stmove.geos.abs_el(2).Write_GCode(PostPro)
+            exstr.append(PostPro.chg_feed_rate(f_g1_plane))
+            exstr.append(self.stmove.geos.abs_el(1).Write_GCode(PostPro))
+            exstr.append(self.stmove.geos.abs_el(2).Write_GCode(PostPro))
 
-        exstr += PostPro.rap_pos_z(
-            workpiece_top_Z + abs(safe_margin))  # Compute the safe margin from the initial mill depth
-        exstr += PostPro.chg_feed_rate(f_g1_depth)
-        exstr += PostPro.lin_pol_z(mom_depth)
-        exstr += PostPro.chg_feed_rate(f_g1_plane)
+        exstr.append(PostPro.rap_pos_z(
+            workpiece_top_Z + abs(safe_margin)))  # Compute the safe margin from the initial mill depth
+        exstr.append(PostPro.chg_feed_rate(f_g1_depth))
+        exstr.append(PostPro.lin_pol_z(mom_depth))
+        exstr.append(PostPro.chg_feed_rate(f_g1_plane))
 
         # Cutter radius compensation when G41 or G42 is on, AND cutter
         # compensation option is set to be done inside the piece
-        if self.cut_cor != 40 and not PostPro.vars.General["cc_outside_the_piece"]:
-            exstr += PostPro.set_cut_cor(self.cut_cor)
+        if cut_cor != 40 and not PostPro.vars.General["cc_outside_the_piece"]:
+            exstr.append(PostPro.set_cut_cor(cut_cor))
 
-            exstr += self.stmove.geos.abs_el(1).Write_GCode(PostPro)
-            exstr += self.stmove.geos.abs_el(2).Write_GCode(PostPro)
+            exstr.append(self.stmove.geos.abs_el(1).Write_GCode(PostPro))
+            exstr.append(self.stmove.geos.abs_el(2).Write_GCode(PostPro))
 
         # Write the geometries for the first cut
-        for geo in new_geos.abs_iter():
-            exstr += self.Write_GCode_for_geo(geo, PostPro)
+        exstr.append(self.Write_GCode_geos(new_geos, PostPro, geos_cache, is_reversed))
 
         # Turning the cutter radius compensation
-        if self.cut_cor != 40 and PostPro.vars.General["cancel_cc_for_depth"]:
-            exstr += PostPro.deactivate_cut_cor()
+        if cut_cor != 40 and PostPro.vars.General["cancel_cc_for_depth"]:
+            exstr.append(PostPro.deactivate_cut_cor())
 
         # Numbers of loops
         snr = 0
@@ -421,54 +480,45 @@ class Shape(object):
                 mom_depth = depth
 
             # Erneutes Eintauchen
-            exstr += PostPro.chg_feed_rate(f_g1_depth)
-            exstr += PostPro.lin_pol_z(mom_depth)
-            exstr += PostPro.chg_feed_rate(f_g1_plane)
+            exstr.append(PostPro.chg_feed_rate(f_g1_depth))
+            exstr.append(PostPro.lin_pol_z(mom_depth))
+            exstr.append(PostPro.chg_feed_rate(f_g1_plane))
 
             # If it is not a closed contour
             if not self.closed:
-                self.reverse(new_geos)
-                self.switch_cut_cor()
-                # switch the "reversed" state (in order to restore it at the
-                # end)
-                has_reversed = not has_reversed
+                is_reversed = not is_reversed
+                if pass_geos[is_reversed] is None:
+                    pass_geos[is_reversed] = self.get_reversed_geos(new_geos)
+                cut_cor = pass_cut_cors[is_reversed]
 
                 # If cutter radius compensation is turned on. Turn it off - because some interpreters cannot handle
                 # a switch
-                if self.cut_cor != 40 and not PostPro.vars.General["cancel_cc_for_depth"]:
-                    exstr += PostPro.deactivate_cut_cor()
+                if cut_cor != 40 and not PostPro.vars.General["cancel_cc_for_depth"]:
+                    exstr.append(PostPro.deactivate_cut_cor())
 
             # If cutter correction is enabled
-            if self.cut_cor != 40 and PostPro.vars.General["cancel_cc_for_depth"]:
-                exstr += PostPro.set_cut_cor(self.cut_cor)
+            if cut_cor != 40 and PostPro.vars.General["cancel_cc_for_depth"]:
+                exstr.append(PostPro.set_cut_cor(cut_cor))
 
-            for geo in new_geos.abs_iter():
-                exstr += self.Write_GCode_for_geo(geo, PostPro)
+            exstr.append(self.Write_GCode_geos(pass_geos[is_reversed], PostPro, geos_cache, is_reversed))
 
             # Turning off the cutter radius compensation if needed
-            if self.cut_cor != 40 and PostPro.vars.General["cancel_cc_for_depth"]:
-                exstr += PostPro.deactivate_cut_cor()
+            if cut_cor != 40 and PostPro.vars.General["cancel_cc_for_depth"]:
+                exstr.append(PostPro.deactivate_cut_cor())
 
         # Do the tool retraction
-        exstr += PostPro.chg_feed_rate(f_g1_depth)
-        exstr += PostPro.lin_pol_z(workpiece_top_Z + abs(safe_margin))
-        exstr += PostPro.rap_pos_z(safe_retract_depth)
+        exstr.append(PostPro.chg_feed_rate(f_g1_depth))
+        exstr.append(PostPro.lin_pol_z(workpiece_top_Z + abs(safe_margin)))
+        exstr.append(PostPro.rap_pos_z(safe_retract_depth))
 
         # If cutter radius compensation is turned on.
-        if self.cut_cor != 40 and not PostPro.vars.General["cancel_cc_for_depth"]:
-            exstr += PostPro.deactivate_cut_cor()
-
-        # Initial value of direction restored if necessary
-        if has_reversed:
-            self.reverse(new_geos)
-            self.switch_cut_cor()
-
-        self.cut_cor = prv_cut_cor
+        if cut_cor != 40 and not PostPro.vars.General["cancel_cc_for_depth"]:
+            exstr.append(PostPro.deactivate_cut_cor())
 
         # Add string to be added before the shape will be cut.
-        exstr += PostPro.write_post_shape_cut()
+        exstr.append(PostPro.write_post_shape_cut())
 
-        return exstr
+        return "".join(exstr)
 
     def Write_GCode_Drag_Knife(self, PostPro):
         """
@@ -480,7 +530,7 @@ class Shape(object):
         """
 
         # initialisation of the string
-        exstr = ""
+        exstr = []
 
         # Get the mill settings defined in the GUI
         safe_retract_depth = self.parentLayer.axis3_retract
@@ -497,60 +547,60 @@ class Shape(object):
         drag_depth = self.axis3_slice_depth
 
         # Move the tool to the start.
-        exstr += self.stmove.geos.abs_el(0).Write_GCode(PostPro)
+        exstr.append(self.stmove.geos.abs_el(0).Write_GCode(PostPro))
 
         # Add string to be added before the shape will be cut.
-        exstr += PostPro.write_pre_shape_cut()
+        exstr.append(PostPro.write_pre_shape_cut())
 
         # Move into workpiece and start cutting into Z
-        exstr += PostPro.rap_pos_z(
-            workpiece_top_Z + abs(safe_margin))  # Compute the safe margin from the initial mill depth
-        exstr += PostPro.chg_feed_rate(f_g1_depth)
+        exstr.append(PostPro.rap_pos_z(
+            workpiece_top_Z + abs(safe_margin)))  # Compute the safe margin from the initial mill depth
+        exstr.append(PostPro.chg_feed_rate(f_g1_depth))
 
         # Write the geometries for the first cut
         if isinstance(self.stmove.geos.abs_el(1), ArcGeo):
             if self.stmove.geos.abs_el(1).drag:
-                exstr += PostPro.lin_pol_z(drag_depth)
+                exstr.append(PostPro.lin_pol_z(drag_depth))
                 drag = True
             else:
-                exstr += PostPro.lin_pol_z(mom_depth)
+                exstr.append(PostPro.lin_pol_z(mom_depth))
                 drag = False
         else:
-            exstr += PostPro.lin_pol_z(mom_depth)
+            exstr.append(PostPro.lin_pol_z(mom_depth))
             drag = False
-        exstr += PostPro.chg_feed_rate(f_g1_plane)
+        exstr.append(PostPro.chg_feed_rate(f_g1_plane))
 
-        exstr += self.stmove.geos.abs_el(1).Write_GCode(PostPro)
+        exstr.append(self.stmove.geos.abs_el(1).Write_GCode(PostPro))
 
         for geo in Geos(self.stmove.geos[2:]).abs_iter():
             if isinstance(geo, ArcGeo):
                 if geo.drag:
-                    exstr += PostPro.chg_feed_rate(f_g1_depth)
-                    exstr += PostPro.lin_pol_z(drag_depth)
-                    exstr += PostPro.chg_feed_rate(f_g1_plane)
+                    exstr.append(PostPro.chg_feed_rate(f_g1_depth))
+                    exstr.append(PostPro.lin_pol_z(drag_depth))
+                    exstr.append(PostPro.chg_feed_rate(f_g1_plane))
                     drag = True
                 elif drag:
-                    exstr += PostPro.chg_feed_rate(f_g1_depth)
-                    exstr += PostPro.lin_pol_z(mom_depth)
-                    exstr += PostPro.chg_feed_rate(f_g1_plane)
+                    exstr.append(PostPro.chg_feed_rate(f_g1_depth))
+                    exstr.append(PostPro.lin_pol_z(mom_depth))
+                    exstr.append(PostPro.chg_feed_rate(f_g1_plane))
                     drag = False
             elif drag:
-                exstr += PostPro.chg_feed_rate(f_g1_depth)
-                exstr += PostPro.lin_pol_z(mom_depth)
-                exstr += PostPro.chg_feed_rate(f_g1_plane)
+                exstr.append(PostPro.chg_feed_rate(f_g1_depth))
+                exstr.append(PostPro.lin_pol_z(mom_depth))
+                exstr.append(PostPro.chg_feed_rate(f_g1_plane))
                 drag = False
 
-            exstr += self.Write_GCode_for_geo(geo, PostPro)
+            exstr.append(self.Write_GCode_for_geo(geo, PostPro))
 
         # Do the tool retraction
-        exstr += PostPro.chg_feed_rate(f_g1_depth)
-        exstr += PostPro.lin_pol_z(workpiece_top_Z + abs(safe_margin))
-        exstr += PostPro.rap_pos_z(safe_retract_depth)
+        exstr.append(PostPro.chg_feed_rate(f_g1_depth))
+        exstr.append(PostPro.lin_pol_z(workpiece_top_Z + abs(safe_margin)))
+        exstr.append(PostPro.rap_pos_z(safe_retract_depth))
 
         # Add string to be added before the shape will be cut.
-        exstr += PostPro.write_post_shape_cut()
+        exstr.append(PostPro.write_post_shape_cut())
 
-        return exstr
+        return "".join(exstr)
 
     def join_colinear_lines(self):
         """
@@ -593,6 +643,25 @@ class Shape(object):
 
         self.geos = new_geos
 
+    def compact_geos(self, tol):
+        """
+        Replaces runs of lines and arcs by the fewest lines and arcs which are
+        within tol of the original geometries (see GeoCompactor).
+        @param tol: The tolerance in absolute coordinates
+        """
+        if self.type == 'Hole':
+            return
+
+        # The geometries are relative to their parent Entity (block), so the
+        # tolerance has to be reduced by its scale.
+        scale = 1.0
+        parent = self.parentEntity
+        while parent is not None:
+            scale *= max(abs(parent.sca[0]), abs(parent.sca[1]))
+            parent = parent.parent
+
+        self.geos = Geos(GeoCompactor(tol / scale).compact(self.geos))
+
 
 class Geos(list):
 
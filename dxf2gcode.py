@@ -34,8 +34,12 @@ from math import degrees, radians
 from copy import copy, deepcopy
 import logging
 import argparse
+import glob
+import json
+import multiprocessing
 import subprocess
 import tempfile
+import time
 
 from core.point import Point
 from core.layercontent import LayerContent, Layers, Shapes
@@ -43,6 +47,8 @@ from core.entitycontent import EntityContent
 from core.customgcode import CustomGCode
 from core.linegeo import LineGeo
 from core.holegeo import HoleGeo
+from core.stmove import StMove
+from core.containment import ContainmentTree
 from globals.config import MyConfig
 import globals.globals as g
 from globals.logger import LoggerClass
@@ -52,7 +58,9 @@ from gui.configwindow import ConfigWindow
 from dxfimport.importer import ReadDXF
 
 from postpro.postprocessor import MyPostProcessor
-from postpro.tspoptimisation import TspOptimization
+from postpro.parallelexport import fork_context
+from postpro.tspoptimisation import TspOptimization, MachineTimeClass
+from postpro.spatialindex import GridIndex
 
 from globals.helperfunctions import str_encode, str_decode, qstr_encode
 
@@ -130,17 +138,253 @@ class MainWindow():
         self.canvas_scene.delete_opt_paths()
         self.canvas_scene.update()
 
-    def exportShapes(self, status=False, save_filename=None):
+    def exportShapes(self, status=False, save_filename=None, output=None, jobs=None):
         """
         This function is called by the menu "Export/Export Shapes". It may open
         a Save Dialog if used without LinuxCNC integration. Otherwise it's
         possible to select multiple postprocessor files, which are located
         in the folder.
+        @param output: Where the code is written to (stdout if None), see
+        MyPostProcessor.exportShapes
+        @param jobs: The number of processes for the export (see
+        MyPostProcessor.exportShapes)
         """
 
-        self.MyPostProcessor.exportShapes(self.filename,save_filename,self.layerContents)
+        self.MyPostProcessor.exportShapes(self.filename, save_filename, self.layerContents, output, jobs)
         # self.close()
 
+    def exportShapesMulti(self, targets, jobs=None):
+        """
+        Exports the shapes with several postprocessor configs at once (see
+        MyPostProcessor.exportShapesMulti).
+        @param targets: list of (postprocessor file, output)
+        @param jobs: The number of processes for the export
+        @return: dict of the outputs which failed and their errors
+        """
+        return self.MyPostProcessor.exportShapesMulti(self.filename, self.layerContents, targets, jobs)
+
+    def convertFile(self, filename, output, tsp_time_ms=None, targets=None):
+        """
+        Loads the file, optimizes the route and exports it, like a call of
+        the program with the file (see batch_convert).
+        @param filename: The dxf file to convert
+        @param output: The file to write the code to (see exportShapes)
+        @param tsp_time_ms: The time for the route optimisation of all
+        shapes, None for the default of the config
+        @param targets: None or list of (postprocessor file, output) to
+        export with several postprocessor configs (see exportShapesMulti)
+        @return: dict with the counts of the layers and shapes and the times
+        of the steps in s
+        """
+        summary = {}
+        start_time = time.time()
+        self.filename = filename
+        self.load()
+        summary['load_s'] = round(time.time() - start_time, 3)
+        summary['layers'] = len(self.layerContents)
+        summary['shapes'] = len(self.shapes)
+        summary['exported_shapes'] = sum(len(LayerContent.exp_order_complete)
+                                         for LayerContent in self.layerContents.non_break_layer_iter())
+
+        step_time = time.time()
+        if tsp_time_ms is not None:
+            for shape in self.shapes:
+                shape.setToolPathOptimized(True)
+        if tsp_time_ms is not None or g.config.vars.Route_Optimisation['default_TSP']:
+            self.optimizeTSP(tsp_time_ms)
+        summary['optimize_s'] = round(time.time() - step_time, 3)
+
+        # The worker processes of a batch can't start processes themselves
+        # (see _init_batch_worker)
+        step_time = time.time()
+        if targets:
+            errors = self.exportShapesMulti(targets, jobs=1)
+            if errors:
+                raise RuntimeError("; ".join("%s: %s" % (output, error) for output, error in errors.items()))
+        else:
+            self.exportShapes(None, None, output, jobs=1)
+        summary['export_s'] = round(time.time() - step_time, 3)
+        return summary
+
+    def optimizeTSP(self, time_ms=None):
+        """
+        Optimizes the export order of the shapes of each layer to shorten the
+        rapid moves between them (TSP). Shapes which are not checked for the
+        optimisation keep their order.
+        @param time_ms: The time budget for all layers in ms. If it is None
+        the number of iterations is limited by max_iterations.
+        """
+        stall_iterations = 100
+        deadline = None if time_ms is None else time.time() + time_ms / 1000.0
+
+        x_st = g.config.vars.Plane_Coordinates['axis1_start_end']
+        y_st = g.config.vars.Plane_Coordinates['axis2_start_end']
+        machine_time = g.config.vars.Route_Optimisation['cost_model'] == 'machine_time'
+        inner_first = g.config.vars.Route_Optimisation['inner_first']
+
+        layers = [LayerContent for LayerContent in self.layerContents.non_break_layer_iter()
+                  if len(LayerContent.exp_order) > 1]
+        for layer_nr, LayerContent in enumerate(layers):
+            # Initial values for the Lists to export.
+            shapes_fixed_order = []
+            shapes_st_en_points = []
+            for shape_nr, exp_nr in enumerate(LayerContent.exp_order):
+                shape = LayerContent.shapes[exp_nr]
+                if not shape.isToolPathOptimized():
+                    shapes_fixed_order.append(shape_nr)
+                shapes_st_en_points.append(shape.get_start_end_points_physical())
+
+            if len(shapes_fixed_order) == len(shapes_st_en_points):
+                continue
+
+            # Adding the Start and End Points to the List.
+            shapes_st_en_points.append([Point(x_st, y_st), Point(x_st, y_st)])
+
+            start_time = time.time()
+            if deadline is None:
+                layer_deadline = None
+                max_iterations = min(g.config.vars.Route_Optimisation['max_iterations'],
+                                     len(shapes_st_en_points) * 50)
+            else:
+                # The remaining time is shared by the remaining layers
+                layer_deadline = start_time + (deadline - start_time) / (len(layers) - layer_nr)
+                max_iterations = None
+
+            if machine_time:
+                CostModel = MachineTimeClass()
+                CostModel.set_shapes([LayerContent.shapes[exp_nr] for exp_nr in LayerContent.exp_order] + [None])
+            else:
+                CostModel = None
+
+            # Die inneren Konturen werden vor den äußeren geschnitten
+            # The inner shapes are cut before the outer ones
+            if inner_first:
+                shapes = [LayerContent.shapes[exp_nr] for exp_nr in LayerContent.exp_order]
+                tree = ContainmentTree(shapes)
+                optimized = [shape_nr for shape_nr, shape in enumerate(shapes) if shape.isToolPathOptimized()]
+                precedence = [(optimized[inner], optimized[outer]) for inner, outer in
+                              tree.get_precedence(optimized)]
+                # The optimisation can't keep the precedence of the shapes
+                # with a fixed order, they are checked afterwards
+                fixed = set(shapes_fixed_order)
+                fixed_precedence = [(LayerContent.exp_order[inner], LayerContent.exp_order[outer])
+                                    for inner, outer in tree.get_precedence(list(range(len(shapes))))
+                                    if inner in fixed or outer in fixed]
+            else:
+                precedence = []
+                fixed_precedence = []
+
+            TSP = TspOptimization(shapes_st_en_points, shapes_fixed_order,
+                                  CostModel=CostModel, precedence=precedence)
+            logger.debug(self.tr("TSP start values initialised for Layer %s") % LayerContent.name)
+            logger.debug(self.tr("Fixed order: %s") % shapes_fixed_order)
+
+            # The best route found so far is kept, since the GA may lose it
+            start_length = TSP.Fittness.best_fittness[0]
+            opt_length = TSP.Fittness.best_fittness[-1]
+            opt_route = TSP.opt_route[:]
+            it_nr = 0
+            best_it_nr = 0
+            while it_nr - best_it_nr < stall_iterations:
+                if layer_deadline is not None and time.time() >= layer_deadline:
+                    break
+                if max_iterations is not None and it_nr >= max_iterations:
+                    break
+                it_nr += 1
+                TSP.calc_next_iteration()
+                if TSP.Fittness.best_fittness[-1] < opt_length:
+                    opt_length = TSP.Fittness.best_fittness[-1]
+                    opt_route = TSP.opt_route[:]
+                    best_it_nr = it_nr
+            TSP.close()
+
+            # The order of the file may not keep the precedence
+            if opt_length < start_length or precedence:
+                LayerContent.exp_order = [LayerContent.exp_order[nr] for nr in opt_route[1:]]
+                LayerContent.exp_order_complete = LayerContent.exp_order[:]
+            else:
+                opt_length = start_length
+
+            pos = dict((exp_nr, nr) for nr, exp_nr in enumerate(LayerContent.exp_order))
+            broken_nr = sum(1 for inner, outer in fixed_precedence if pos[inner] > pos[outer])
+            if broken_nr:
+                logger.warning(self.tr("%i inner shapes of layer %s are cut after their outer shape, "
+                                       "since one of them has a fixed order") % (broken_nr, LayerContent.name))
+
+            if machine_time:
+                logger.info(self.tr("Layer %s: predicted time between the shapes %0.1f s before and %0.1f s after route optimisation, %0.1f s saved (%i iterations, %i ms)")
+                            % (LayerContent.name, start_length, opt_length, start_length - opt_length,
+                               it_nr, (time.time() - start_time) * 1000))
+            else:
+                logger.info(self.tr("Layer %s: rapid travel %0.1f before and %0.1f after route optimisation (%i iterations, %i ms)")
+                            % (LayerContent.name, start_length, opt_length, it_nr, (time.time() - start_time) * 1000))
+
+            if g.config.vars.Route_Optimisation['optimize_entry_points']:
+                self.optimizeEntryPoints(LayerContent, Point(x_st, y_st))
+
+    def optimizeEntryPoints(self, LayerContent, machine_start, cand_nr=4):
+        """
+        Moves the start point of the closed shapes which are checked for the
+        route optimisation to the vertex which shortens the rapid moves to and
+        from it the most, for the current export order. The vertices nearest
+        to the end of the previous and the start of the next shape are the
+        candidates. This is repeated while a start point changes (max 3 times).
+        @param LayerContent: The layer whose shapes are changed
+        @param machine_start: The start and end point of the machine
+        @param cand_nr: Number of candidates near each of the two points
+        """
+        shapes = [LayerContent.shapes[shape_nr] for shape_nr in LayerContent.exp_order]
+        start_length = self.calcRapidLength(shapes, machine_start)
+
+        # Index of the vertices of each closed shape
+        indexes = {}
+        for shape in shapes:
+            if shape.closed and shape.isToolPathOptimized() and len(shape.geos) > 1:
+                starts = [geo.get_start_end_points(True) for geo in shape.geos.abs_iter()]
+                indexes[shape] = (starts, GridIndex([(P.x, P.y) for P in starts]))
+
+        for pass_nr in range(3):
+            changed = 0
+            prv_end = machine_start
+            for shape_nr, shape in enumerate(shapes):
+                if shape in indexes:
+                    if shape_nr + 1 < len(shapes):
+                        nxt_start = shapes[shape_nr + 1].get_start_end_points_physical()[0]
+                    else:
+                        nxt_start = machine_start
+                    starts, index = indexes[shape]
+                    start = shape.get_start_end_points(True)
+                    best_start = start
+                    best_dist = prv_end.distance(start) + start.distance(nxt_start)
+                    for P in (prv_end, nxt_start):
+                        for nr in index.k_nearest(P.x, P.y, cand_nr):
+                            dist = prv_end.distance(starts[nr]) + starts[nr].distance(nxt_start)
+                            if dist < best_dist - 1e-9:
+                                best_start, best_dist = starts[nr], dist
+                    if best_start is not start:
+                        shape.setNearestStPoint(best_start)
+                        shape.stmove = StMove(shape)
+                        changed += 1
+                prv_end = shape.get_start_end_points_physical()[1]
+            if not changed:
+                break
+
+        logger.info(self.tr("Layer %s: rapid travel %0.1f before and %0.1f after the start point optimisation of %i closed shapes")
+                    % (LayerContent.name, start_length, self.calcRapidLength(shapes, machine_start), len(indexes)))
+
+    def calcRapidLength(self, shapes, machine_start):
+        """
+        @return: The length of the rapid moves between the shapes in the given
+        order, from and back to the machine start point
+        """
+        length = 0.0
+        prv_end = machine_start
+        for shape in shapes:
+            start, end = shape.get_start_end_points_physical()
+            length += prv_end.distance(start)
+            prv_end = end
+        return length + prv_end.distance(machine_start)
+
     def open(self):
         """
         This function is called by the menu "File/Load File" of the main toolbar.
@@ -204,11 +448,49 @@ class MainWindow():
 
         self.makeEntityShapes(self.entityRoot)
 
+        if g.config.vars.Import_Parameters['compact_geometry']:
+            self.compactShapes()
+
+        if g.config.vars.General['automatic_cutter_compensation']:
+            self.automaticCutterCompensation()
+
         for layerContent in self.layerContents:
             layerContent.overrideDefaults()
         self.layerContents.sort(key=lambda x: x.nr)
         self.newNumber = len(self.shapes)
 
+    def compactShapes(self):
+        """
+        Replaces runs of lines and arcs of all shapes by the fewest lines and
+        arcs within the fitting tolerance.
+        """
+        nr_before = sum(len(shape.geos) for shape in self.shapes)
+        for shape in self.shapes:
+            shape.compact_geos(g.config.fitting_tolerance)
+        nr_after = sum(len(shape.geos) for shape in self.shapes)
+
+        logger.info(self.tr('Compacted %i geometries to %i') % (nr_before, nr_after))
+
+    def automaticCutterCompensation(self):
+        """
+        Sets the cutter compensation of the closed shapes, so that the outer
+        boundaries are cut outside and the holes in them inside (and the
+        shapes in the holes outside again and so on).
+        """
+        for LayerContent in self.layerContents:
+            if not LayerContent.automaticCutterCompensationEnabled():
+                continue
+            tree = ContainmentTree(LayerContent.shapes)
+            for shape, level in zip(LayerContent.shapes, tree.levels):
+                if level is None:
+                    continue
+                # Die Shapes sind im Uhrzeigersinn, außen ist dann links
+                # The shapes are CW, so the outside is on the left
+                if (level % 2 == 0) == shape.cw:
+                    shape.cut_cor = 41
+                else:
+                    shape.cut_cor = 42
+
     def makeEntityShapes(self, parent, layerNr=-1):
         """
         Instance is called prior to plotting the shapes. It creates
@@ -294,6 +576,8 @@ class MainWindow():
         # Check if the layer already exists and add shape if it is.
         for LayCon in self.layerContents:
             if LayCon.nr == lay_nr:
+                LayCon.exp_order.append(len(LayCon.shapes))
+                LayCon.exp_order_complete.append(len(LayCon.shapes))
                 LayCon.shapes.append(shape)
                 shape.parentLayer = LayCon
                 return
@@ -304,6 +588,135 @@ class MainWindow():
         shape.parentLayer = self.layerContents[-1]
 
 
+def batch_inputs(inputs):
+    """
+    Collects the dxf files of a batch.
+    @param inputs: list of globs, directories (all dxf files in them) or
+    manifest files (one file per line, relative to the manifest, lines
+    beginning with # are left out)
+    @return: list of the file names, each file once
+    """
+    filenames = []
+    for batch_input in inputs:
+        if os.path.isdir(batch_input):
+            filenames += sorted(os.path.join(batch_input, filename) for filename in os.listdir(batch_input)
+                                if os.path.splitext(filename)[1].lower() == '.dxf')
+        elif glob.has_magic(batch_input):
+            filenames += sorted(glob.glob(batch_input))
+        elif os.path.splitext(batch_input)[1].lower() == '.dxf':
+            filenames.append(batch_input)
+        else:
+            with open(batch_input) as manifest:
+                for line in manifest:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        filenames.append(os.path.join(os.path.dirname(batch_input), line))
+
+    # A file given twice (e.g. by a glob and a manifest) is converted once
+    unique_filenames = []
+    seen = set()
+    for filename in filenames:
+        if os.path.abspath(filename) not in seen:
+            seen.add(os.path.abspath(filename))
+            unique_filenames.append(filename)
+    return unique_filenames
+
+
+def _init_batch_worker():
+    """
+    Worker processes of a batch are daemons and can't start processes
+    themselves, so the route optimisation runs without further islands.
+    """
+    g.config.vars.Route_Optimisation['islands'] = 1
+
+
+def _convert_file(task):
+    """
+    Converts a file of a batch in a worker process (see batch_convert).
+    @return: The summary of the file
+    """
+    filename, output, tsp_time_ms, targets = task
+    summary = {'input': filename,
+               'output': output if not targets else [target[1] for target in targets]}
+    start_time = time.time()
+    try:
+        summary.update(g.window.convertFile(filename, output, tsp_time_ms, targets))
+        summary['status'] = 'ok'
+    except Exception as e:
+        logger.exception("Conversion of %s failed" % filename)
+        summary['status'] = 'error'
+        summary['error'] = "%s: %s" % (type(e).__name__, e)
+    summary['total_s'] = round(time.time() - start_time, 3)
+    return summary
+
+
+def batch_convert(filenames, output_dir, workers=None, summary_file=None,
+                  tsp_time_ms=None, postpro_files=None):
+    """
+    Converts many files with the config loaded once. The files are converted
+    in forked worker processes, which inherit the config and g.window.
+    @param filenames: list of the dxf files (see batch_inputs)
+    @param output_dir: The directory for the exported files, they are named
+    like the dxf files with the extension of the postprocessor config
+    @param workers: The number of worker processes, the default is the
+    number of CPUs
+    @param summary_file: file like object for the summary of each file as a
+    JSON line (status, timings, shape counts), default is stdout
+    @param tsp_time_ms: see MainWindow.convertFile
+    @param postpro_files: None or list of postprocessor config files, then
+    each file is exported with each config (named e.g. part_laser.nc)
+    @return: The number of files which failed
+    """
+    PostPro = g.window.MyPostProcessor
+    names = [os.path.splitext(os.path.basename(filename))[0] for filename in filenames]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise ValueError("The outputs of several files would have the same name: %s" % ", ".join(duplicates))
+
+    tasks = []
+    for filename, name in zip(filenames, names):
+        if postpro_files:
+            targets = [(postprocessor_file, os.path.join(output_dir, "%s_%s.%s" % (
+                name, os.path.splitext(postprocessor_file)[0],
+                PostPro.get_postprocessor(postprocessor_file).vars.General['output_format'].lstrip('.'))))
+                for postprocessor_file in postpro_files]
+            tasks.append((filename, None, tsp_time_ms, targets))
+        else:
+            output = os.path.join(output_dir, "%s.%s" % (name, PostPro.vars.General['output_format'].lstrip('.')))
+            tasks.append((filename, output, tsp_time_ms, None))
+
+    if summary_file is None:
+        summary_file = sys.stdout
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, len(tasks))
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    context = fork_context() if workers > 1 else None
+    if context is not None:
+        pool = context.Pool(workers, _init_batch_worker)
+        summaries = pool.imap(_convert_file, tasks)
+    else:
+        pool = None
+        summaries = (_convert_file(task) for task in tasks)
+
+    failed = 0
+    try:
+        for summary in summaries:
+            if summary['status'] != 'ok':
+                failed += 1
+            summary_file.write(json.dumps(summary) + '\n')
+            summary_file.flush()
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    logger.info("Converted %i files, %i failed" % (len(tasks) - failed, failed))
+    return failed
+
+
 if __name__ == "__main__":
     """
     The main function which is executed after program start.
@@ -347,16 +760,68 @@ if __name__ == "__main__":
                         help="export data to FILENAME")
     parser.add_argument("-q", "--quiet", action="store_true",
                         dest="quiet", help="no GUI")
+    parser.add_argument("--tsp-time-ms", dest="tsp_time_ms", type=int,
+                        help="optimize the order of all shapes for the export within TSP_TIME_MS milliseconds")
+    parser.add_argument("-o", "--output", dest="output",
+                        help="write the exported code to OUTPUT: a file, - for stdout (default) or tcp://HOST:PORT")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int,
+                        help="generate the code of the shapes in JOBS parallel processes")
+    parser.add_argument("-b", "--batch", dest="batch", action="append", metavar="INPUT",
+                        help="convert many files: INPUT is a glob, a directory or a manifest file "
+                             "with one file per line, can be given several times")
+    parser.add_argument("-d", "--output-dir", dest="output_dir", default=".",
+                        help="write the exported files of a batch to OUTPUT_DIR")
+    parser.add_argument("-w", "--workers", dest="workers", type=int,
+                        help="convert the files of a batch in WORKERS parallel processes (default: number of CPUs)")
+    parser.add_argument("-s", "--summary", dest="summary",
+                        help="write the summary of each file of a batch as JSON lines to SUMMARY (default: stdout)")
+    parser.add_argument("-p", "--postpro", dest="postpro", action="append",
+                        metavar="CONFIG[=OUTPUT]",
+                        help="export with the postprocessor config file CONFIG to OUTPUT, "
+                             "can be given several times to export to several targets at once")
     options = parser.parse_args()
 
     # (options, args) = parser.parse_args()
     logger.debug("Started with following options:\n%s" % parser)
 
 
+    targets = []
+    for postpro in options.postpro or []:
+        postprocessor_file, _, output = postpro.partition('=')
+        if postprocessor_file not in window.MyPostProcessor.postprocessor_files:
+            parser.error("unknown postprocessor config %s, the configs are: %s"
+                         % (postprocessor_file, ", ".join(window.MyPostProcessor.postprocessor_files)))
+        if output and options.batch:
+            parser.error("-p CONFIG=OUTPUT can't be used with -b, the outputs of a batch are "
+                         "named after the files and the configs in OUTPUT_DIR")
+        targets.append((postprocessor_file, output or None))
+
+    if options.batch:
+        filenames = batch_inputs([str_decode(batch_input) for batch_input in options.batch])
+        postpro_files = [target[0] for target in targets]
+        if options.summary is None:
+            failed = batch_convert(filenames, options.output_dir, options.workers, None,
+                                   options.tsp_time_ms, postpro_files)
+        else:
+            with open(options.summary, 'w') as summary_file:
+                failed = batch_convert(filenames, options.output_dir, options.workers, summary_file,
+                                       options.tsp_time_ms, postpro_files)
+        sys.exit(1 if failed else 0)
+
     if options.filename is not None:
         window.filename = str_decode(options.filename)
         window.load()
 
     if options.export_filename is not None:
-        window.exportShapes(None, options.export_filename)
+        if options.tsp_time_ms is not None:
+            # There is no way to check single shapes without the GUI
+            for shape in window.shapes:
+                shape.setToolPathOptimized(True)
+        if options.tsp_time_ms is not None or g.config.vars.Route_Optimisation['default_TSP']:
+            window.optimizeTSP(options.tsp_time_ms)
+        if targets:
+            if window.exportShapesMulti(targets, options.jobs):
+                sys.exit(1)
+        else:
+            window.exportShapes(None, options.export_filename, options.output, options.jobs)
 
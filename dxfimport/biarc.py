@@ -26,7 +26,8 @@
 from __future__ import absolute_import
 from __future__ import division
 
-from math import sin, cos, pi, ceil
+from math import sin, cos, pi, ceil, atan2, hypot
+
 from core.linegeo import LineGeo
 from core.arcgeo import ArcGeo
 from core.point import Point
@@ -57,7 +58,8 @@ class BiarcClass(object):
         self.tan_b = tan_b
         self.l = 0.0
         self.shape = None
-        self.geos = []
+        self.arcs = []
+        self._geos = None
         self.k = 0.0
 
         # Errechnen der Winkel, L�nge und Shape
@@ -73,19 +75,14 @@ class BiarcClass(object):
             self.shape = "Zero"
 
         elif self.shape == "LineGeo":
-            # Erstellen der Geometrie
-            # Create the geometry
-            self.geos.append(LineGeo(self.Ps, self.Pb))
+            return
         else:
             # Berechnen der Radien, Mittelpunkte, Zwichenpunkt
             # Calculate the radii, midpoints Zwichenpunkt
             r1, r2 = self.calc_r1_r2(self.l, alpha, beta, self.theta)
 
             if abs(r1) > max_r or abs(r2) > max_r:
-                # Erstellen der Geometrie
-                # Create the geometry
                 self.shape = "LineGeo"
-                self.geos.append(LineGeo(self.Ps, self.Pb))
                 return
 
 #             elif abs(r1) < min_r or abs(r2) < min_r:
@@ -107,12 +104,26 @@ class BiarcClass(object):
             dir_ang2 = (tan_b - e_ang2) % (-2 * pi)
             dir_ang2 -= ceil(dir_ang2 / pi) * (2 * pi)
 
-            # Erstellen der Geometrien
-            # Create the geometries
-            self.geos.append(ArcGeo(Ps=self.Ps, Pe=k, O=O1, r=r1,
-                                    s_ang=s_ang1, e_ang=e_ang1, direction=dir_ang1))
-            self.geos.append(ArcGeo(Ps=k, Pe=self.Pb, O=O2, r=r2,
-                                    s_ang=s_ang2, e_ang=e_ang2, direction=dir_ang2))
+            # Die Geometrien werden erst bei Bedarf erstellt
+            # The geometries are only created when they are needed
+            self.arcs = [(self.Ps, k, O1, r1, s_ang1, e_ang1, dir_ang1),
+                         (k, self.Pb, O2, r2, s_ang2, e_ang2, dir_ang2)]
+
+    @property
+    def geos(self):
+        """
+        The geometries of the biarc, one LineGeo or two ArcGeos. They are
+        created at the first access, since the spline conversion only checks
+        most of its biarcs.
+        """
+        if self._geos is None:
+            if self.shape == "LineGeo":
+                self._geos = [LineGeo(self.Ps, self.Pb)]
+            else:
+                self._geos = [ArcGeo(Ps=Ps, Pe=Pe, O=O, r=r, s_ang=s_ang,
+                                     e_ang=e_ang, direction=direction)
+                              for Ps, Pe, O, r, s_ang, e_ang, direction in self.arcs]
+        return self._geos
 
     def __str__(self):
         s = "\nBiarc Shape: %s" % self.shape +\
@@ -193,6 +204,11 @@ class BiarcClass(object):
         calc_r1_r2()
         """
         # print("alpha: %s, beta: %s, theta: %s" %(alpha,beta,theta))
+        if abs(alpha + beta) < 1e-9:
+            # Parallel tangents, the limit of the S-shaped biarc below are two
+            # arcs with opposite radii which meet in the middle of the chord
+            r1 = l / (4 * sin(alpha))
+            return r1, -r1
         r1 = (l / (2 * sin((alpha + beta) / 2)) *
               sin((beta - alpha + theta) / 2) / sin(theta / 2))
         r2 = (l / (2 * sin((alpha + beta) / 2)) *
@@ -219,3 +235,54 @@ class BiarcClass(object):
         else:
             diff = self.geos[1].O.distance(Pt) - abs(self.geos[1].r)
         return abs(diff)
+
+    def get_biarc_fitting_errors(self, Pts):
+        """
+        Returns the distances of several points to the biarc (both arcs or the
+        line for a LineGeo shape). Other than get_biarc_fitting_error() it
+        also works for points beyond the ends of the arcs, as the samples of
+        the spline conversion are checked with it. The geometries of the biarc
+        aren't needed for it.
+        @param Pts: list of the points to check as (x, y)
+        @return: list of the fitting errors
+        """
+        Ps = self.Ps
+        Pb = self.Pb
+        if self.shape == "LineGeo":
+            vx = Pb.x - Ps.x
+            vy = Pb.y - Ps.y
+            vv = vx * vx + vy * vy
+            errors = []
+            for x, y in Pts:
+                wx = x - Ps.x
+                wy = y - Ps.y
+                t = min(max((wx * vx + wy * vy) / vv, 0.0), 1.0)
+                errors.append(hypot(wx - t * vx, wy - t * vy))
+            return errors
+
+        # Distance to the nearest of both arcs. Points outside of the angle
+        # range of an arc get the distance to its nearer end point.
+        k = self.arcs[0][1]
+        arcs = [(O.x, O.y, abs(r), s_ang, self.calc_ext(s_ang, e_ang, direction))
+                for _Ps, _Pe, O, r, s_ang, e_ang, direction in self.arcs]
+        errors = []
+        for x, y in Pts:
+            diff = min(hypot(x - Ps.x, y - Ps.y), hypot(x - k.x, y - k.y),
+                       hypot(x - Pb.x, y - Pb.y))
+            for Ox, Oy, r, s_ang, ext in arcs:
+                ang = atan2(y - Oy, x - Ox) - s_ang
+                if (ang if ext >= 0.0 else -ang) % (2 * pi) <= abs(ext):
+                    diff = min(diff, abs(hypot(x - Ox, y - Oy) - r))
+            errors.append(diff)
+        return errors
+
+    def calc_ext(self, s_ang, e_ang, direction):
+        """
+        Returns the extent of an arc of the biarc like ArcGeo.dif_ang() does
+        """
+        ext = (e_ang - s_ang) % (-2 * pi)
+        if direction > 0:
+            ext += 2 * pi
+        elif ext == 0:
+            ext = -2 * pi
+        return ext
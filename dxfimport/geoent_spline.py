@@ -26,7 +26,7 @@
 from __future__ import absolute_import
 
 from core.point import Point
-from dxfimport.spline_convert import Spline2Arcs
+from dxfimport.spline_convert import spline_cache
 from dxfimport.classes import PointsClass, ContourClass
 
 import globals.globals as g
@@ -58,11 +58,9 @@ class GeoentSpline:
         check = g.config.vars.Import_Parameters['spline_check']
 
         # Umwandeln zu einem ArcSpline
-        # Convert to a ArcSpline
-        Spline2ArcsClass = Spline2Arcs(degree=self.degree, Knots=self.Knots,
-                                       Weights=self.Weights, CPoints=self.CPoints, tol=tol, check=check)
-
-        self.geo = Spline2ArcsClass.Curve
+        # Convert to a ArcSpline (identical splines are only converted once)
+        self.geo = spline_cache.convert(degree=self.degree, Knots=self.Knots,
+                                        Weights=self.Weights, CPoints=self.CPoints, tol=tol, check=check)
 
         for geo in self.geo:
             self.length += geo.length
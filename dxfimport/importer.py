@@ -38,6 +38,7 @@ from dxfimport.geoent_insert import GeoentInsert
 from dxfimport.geoent_line import GeoentLine
 from dxfimport.geoent_polyline import GeoentPolyline
 from dxfimport.geoent_spline import GeoentSpline
+from dxfimport.spline_convert import spline_cache
 from dxfimport.geoent_ellipse import GeoentEllipse
 from dxfimport.geoent_lwpolyline import GeoentLwPolyline
 from dxfimport.geoent_point import GeoentPoint
@@ -76,6 +77,9 @@ class ReadDXF(QtCore.QObject):
         # logger.info(("\n\nFile has   %0.0f Lines" % len(str_)), 1)
         # logger.info(("\nFile has   %0.0f Linepairs" % self.line_pairs.nrs), 1)
 
+        spline_cache.load(g.config.vars.Import_Parameters['spline_cache_file'],
+                          g.config.vars.Import_Parameters['spline_cache_size'])
+
         logger.info(self.tr("Reading DXF Structure"))
         sections_pos = self.Get_Sections_pos()
         self.layers = self.Read_Layers(sections_pos)
@@ -83,6 +87,7 @@ class ReadDXF(QtCore.QObject):
         blocks_pos = self.Get_Blocks_pos(sections_pos)
         self.blocks = self.Read_Blocks(blocks_pos)
         self.entities = self.Read_Entities(sections_pos)
+        spline_cache.save()
 
         # Aufruf der Klasse um die Konturen zur suchen
         # Schleife f�r die Anzahl der Bl�cke und den Layern
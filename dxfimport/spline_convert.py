@@ -26,8 +26,15 @@
 from __future__ import absolute_import
 from __future__ import division
 
-from math import atan2
+from collections import OrderedDict
+from itertools import count
+from math import atan2, ceil, copysign, hypot, pi
+import json
 import logging
+import os
+import tempfile
+
+import numpy as np
 
 from core.point import Point
 from core.arcgeo import ArcGeo
@@ -45,6 +52,12 @@ class Spline2Arcs:
         self.epsilon_high = self.epsilon * 0.1
         self.segments = 50
 
+        # Sampling density used for fitting the biarcs and the minimum number
+        # of samples every biarc is checked against
+        self.samples_per_span = 3
+        self.max_sample_angle = 0.1
+        self.check_samples = 1
+
         # NURBS Klasse initialisieren
         self.NURBS = NURBSClass(degree=degree, Knots=Knots,
                                 CPoints=CPoints, Weights=Weights)
@@ -106,11 +119,10 @@ class Spline2Arcs:
                         # print "Increasing"
                         anz = len(NewCurve)
                         triarc = NewCurve[anz - 3:anz]
-                        Arc0, Arc1 = self.fit_triac_by_inc_biarc(triarc, tau)
-                        diff = self.check_diff_to_pts(Pts, Arc0, Arc1)
-
                         # �berpr�fen ob es in Toleranz liegt
                         try:
+                            Arc0, Arc1 = self.fit_triac_by_inc_biarc(triarc, tau)
+                            diff = self.check_diff_to_pts(Pts, Arc0, Arc1)
                             if max(diff) < self.epsilon:
                                 tau = self.calc_active_tolerance_inc(self.epsilon, triarc, Arc0, Arc1)
                                 del NewCurve[anz - 3:anz]
@@ -125,9 +137,9 @@ class Spline2Arcs:
                         # print "Decreasing"
                         anz = len(NewCurve)
                         triarc = NewCurve[anz - 3:anz]
-                        Arc0, Arc1 = self.fit_triac_by_dec_biarc(triarc, tau)
-                        diff = self.check_diff_to_pts(Pts, Arc1, Arc0)
                         try:
+                            Arc0, Arc1 = self.fit_triac_by_dec_biarc(triarc, tau)
+                            diff = self.check_diff_to_pts(Pts, Arc1, Arc0)
                             if max(diff) < self.epsilon:
                                 tau = self.calc_active_tolerance_dec(self.epsilon, triarc, Arc0, Arc1)
 
@@ -321,13 +333,16 @@ class Spline2Arcs:
             if anz >= 2:
                 # Wenn Geo eine Linie ist anh�ngen und �berpr�fen
                 if isinstance(NewCurve[-2], LineGeo) and isinstance(NewCurve[-1], LineGeo):
+                    # Joint of the first two lines
+                    if not Pts:
+                        Pts.append(NewCurve[-1].Ps)
                     Pts.append(geo.Pe)
                     JointLine = LineGeo(NewCurve[-2].Ps, NewCurve[-1].Pe)
 
                     # �berpr�fung der Abweichung
                     res = []
                     for Point in Pts:
-                        res.append(JointLine.distance(Point))
+                        res.append(JointLine.distance_l_p(Point))
                     # print res
 
                     # Wenn die Abweichung OK ist Vorheriges anh�ngen
@@ -335,7 +350,6 @@ class Spline2Arcs:
                         anz = len(NewCurve)
                         del NewCurve[anz - 2:anz]
                         NewCurve.append(JointLine)
-                        points = [geo.Pe]
                     # Wenn nicht nicht anh�ngen und Pts zur�cksetzen
                     else:
                         Pts = [geo.Pe]
@@ -413,86 +427,331 @@ class Spline2Arcs:
 
     def calc_Biarc_section(self, u_sect, nom_tol, max_tol):
         """
-        calc_Biarc_section()
+        calc_Biarc_section() - The section is sampled once and the end points
+        of the biarcs are searched on these samples, if the step of the last
+        biarc doesn't fit anymore by bisection. Each candidate biarc is checked
+        against all the samples in between. Where even the shortest biarc
+        doesn't fit, or the biarc may leave the tolerance between the samples,
+        more samples are added.
         """
-        #max_tol=0.1
-        #print(max_tol)
         min_u = 1e-12
+        min_u_step = (self.NURBS.Knots[-1] - self.NURBS.Knots[0]) * 1e-9
+
+        # Eine Zeile pro Sample mit u, x, y und Tangente
+        # One row per sample with u, x, y and tangent
+        samples = self.calc_section_samples(u_sect[0] + min_u, u_sect[-1] - min_u,
+                                            min_u_step)
+
         BiarcCurve = []
-        cur_step = self.max_step
-        u = u_sect[0] + min_u
-
-        PtsVec = [self.NURBS.NURBS_evaluate(n=1, u=u)]
-        step = 0
-
-        # Berechnen bis alle Biarcs berechnet sind
-        while u < u_sect[-1] - min_u:
-            step += 1
-            # logger.debug(step)
-            u += cur_step
-
-            # Begrenzung von u auf den Maximalwert
-            if u > u_sect[-1]:
-                cur_step = u_sect[-1] - (u - cur_step) - min_u
-                u = u_sect[-1] - min_u
-
-            PtVec = self.NURBS.NURBS_evaluate(n=1, u=u)
-
-            # Aus den letzten 2 Punkten den n�chsten Biarc berechnen
-            Biarc = (BiarcClass(PtsVec[-1][0], PtsVec[-1][1], PtVec[0], PtVec[1], nom_tol * 0.5))
-
-            if Biarc.shape == "Zero":
-                # print("zero")
-                # self.cur_step = min([cur_step * 2, self.max_step])
-                cur_step = min([cur_step * 2, self.max_step])
-            elif Biarc.shape == "LineGeo":
-                # print("LineGeo")
-                BiarcCurve.append(Biarc)
-                cur_step = min([cur_step * 2, self.max_step])
-                PtsVec.append(PtVec)
+        PtsVec = [self.get_sample(samples, 0)]
+
+        min_step = self.check_samples + 1
+        i = 0
+        step = min_step
+        while i < len(samples) - 1:
+            last = len(samples) - 1
+
+            # Zuerst wird die etwas vergr��erte L�nge des letzten Biarcs
+            # versucht, passt dieser nicht wird das Ende per Bisektion gesucht
+            # First the slightly increased length of the last biarc is tried,
+            # if that one doesn't fit the end is searched by bisection
+            j_fit, j_nofit = None, min(i + step, last)
+            Biarc, fits = self.fit_biarc(samples, i, j_nofit, nom_tol, max_tol)
+            if fits:
+                j_fit, Biarc_fit = j_nofit, Biarc
+            elif j_nofit > i + min_step:
+                j = i + min_step
+                Biarc, fits = self.fit_biarc(samples, i, j, nom_tol, max_tol)
+                if fits:
+                    j_fit, Biarc_fit = j, Biarc
+                    while j_nofit - j_fit > max(1, (j_fit - i) // 8):
+                        j = (j_fit + j_nofit) // 2
+                        Biarc, fits = self.fit_biarc(samples, i, j, nom_tol, max_tol)
+                        if fits:
+                            j_fit, Biarc_fit = j, Biarc
+                        else:
+                            j_nofit = j
+
+            if j_fit is None:
+                step = min_step
+                if samples[i + 1, 0] - samples[i, 0] > min_u_step:
+                    # Add samples in the gaps ahead and try again
+                    samples = self.insert_samples(samples, np.arange(i, min(i + min_step, last)))
+                    continue
+                # Not resolvable anymore, the biarc is used nevertheless
+                logger.debug("Biarc exceeds the tolerance at u: %s" % samples[i, 0])
+                j_fit = i + 1
+                Biarc_fit = self.fit_biarc(samples, i, j_fit, nom_tol, max_tol)[0]
             else:
-                if self.check_biarc_fitting_tolerance(Biarc, max_tol, u - cur_step, u):
-                    # print("fit1")
-                    PtsVec.append(PtVec)
-                    BiarcCurve.append(Biarc)
-                    cur_step = min([cur_step / 0.7, self.max_step])
-                else:
-                    # print("else")
-                    u -= cur_step
-                    cur_step *= 0.7
-            # print cur_step
-            if step > 10000:
-                raise ValueError("Iterations above 10000 reduce tolerance")
+                step = max(min_step, int((j_fit - i) * 1.5))
+
+            if Biarc_fit.shape != "Zero":
+                # Pr�fen zwischen den Samples / Samples are added between
+                # those samples where the biarc might leave the tolerance,
+                # until it can't anymore. If it doesn't fit at the added
+                # samples the biarc is searched again.
+                gaps = self.calc_unsafe_gaps(samples, i, j_fit, Biarc_fit,
+                                             nom_tol - max_tol, min_u_step)
+                while len(gaps):
+                    samples = self.insert_samples(samples, gaps)
+                    j_fit += len(gaps)
+                    if not self.check_biarc_fitting_tolerance(Biarc_fit, max_tol, samples, i, j_fit):
+                        break
+                    gaps = self.calc_unsafe_gaps(samples, i, j_fit, Biarc_fit,
+                                                 nom_tol - max_tol, min_u_step)
+                if len(gaps):
+                    continue
+
+                BiarcCurve.append(Biarc_fit)
+                PtsVec.append(self.get_sample(samples, j_fit))
+            i = j_fit
 
         return BiarcCurve, PtsVec
 
-    def check_biarc_fitting_tolerance(self, Biarc, epsilon, u0, u1):
+    def calc_section_samples(self, u_beg, u_end, min_u_step):
+        """
+        Samples the section between u_beg and u_end. Every knot span gets at
+        least samples_per_span samples, then samples are added until the
+        tangent turns less than max_sample_angle between two samples.
+        @return: array with one row (u, x, y, tangent) per sample
+        """
+        Knots = self.NURBS.Knots
+        bounds = [u_beg] + sorted(set(knot for knot in Knots if u_beg < knot < u_end)) + [u_end]
+        u = []
+        for u0, u1 in zip(bounds[:-1], bounds[1:]):
+            nr = max(self.samples_per_span, int(ceil((u1 - u0) / self.max_step)))
+            u.append(np.linspace(u0, u1, nr, endpoint=False))
+        u.append([u_end])
+        u = np.concatenate(u)
+        Pts, tangents = self.NURBS.NURBS_evaluate_array(n=1, u=u)
+        samples = np.column_stack((u, Pts, tangents))
+
+        while True:
+            turn = np.abs((np.diff(samples[:, 3]) + pi) % (2 * pi) - pi)
+            gaps = np.flatnonzero((turn > self.max_sample_angle) &
+                                  (np.diff(samples[:, 0]) > min_u_step))
+            if not len(gaps):
+                return samples
+            samples = self.insert_samples(samples, gaps)
+
+    def calc_unsafe_gaps(self, samples, i, j, Biarc, tol, min_u_step):
         """
-        check_biarc_fitting_tolerance()
+        Returns the gaps (index of the sample before) between the samples i
+        and j in which the deviation of the biarc can grow by more than tol
+        although it fits at the samples. The growth is estimated by the
+        difference of the arc heights of the NURBS and of the arcs of the
+        biarc over the gap, from the difference of their turning angles.
         """
-        check_step = (u1 - u0) / 5
-        check_u = []
-        check_Pts = []
-        fit_error = []
+        if Biarc.shape == "LineGeo":
+            curvatures = [0.0]
+        else:
+            curvatures = [copysign(1 / abs(r), Biarc.calc_ext(s_ang, e_ang, direction))
+                          for _Ps, _Pe, _O, r, s_ang, e_ang, direction in Biarc.arcs]
+        rows = samples[i:j + 1].tolist()
+        gaps = []
+        for nr, (u0, x0, y0, tan0), (u1, x1, y1, tan1) in zip(count(i), rows[:-1], rows[1:]):
+            chord = hypot(x1 - x0, y1 - y0)
+            turn = (tan1 - tan0 + pi) % (2 * pi) - pi
+            turn_diff = max(abs(turn - chord * curvature) for curvature in curvatures)
+            if chord * turn_diff / 8 > tol and u1 - u0 > min_u_step:
+                gaps.append(nr)
+        return np.array(gaps, dtype=int)
+
+    def insert_samples(self, samples, gaps):
+        """
+        Evaluates the NURBS in the middle of the gaps (index of the sample
+        before) and inserts these samples.
+        @return: The new samples array
+        """
+        add_u = (samples[gaps, 0] + samples[gaps + 1, 0]) / 2
+        add_Pts, add_tangents = self.NURBS.NURBS_evaluate_array(n=1, u=add_u)
+        return np.insert(samples, gaps + 1, np.column_stack((add_u, add_Pts, add_tangents)), axis=0)
 
-        for i in range(1, 5):
-            check_u.append(u0 + check_step * i)
-            check_Pts.append(self.NURBS.NURBS_evaluate(n=0, u=check_u[-1]))
-            fit_error.append(Biarc.get_biarc_fitting_error(check_Pts[-1]))
+    def get_sample(self, samples, i):
+        """
+        Returns the sample i as Point and tangent like NURBS_evaluate()
+        """
+        return Point(x=float(samples[i, 1]), y=float(samples[i, 2])), float(samples[i, 3])
 
-        # if debug_on:
-        if 0:
-            logger.debug('u0: %s' % u0)
-            logger.debug('u1: %s' % u1)
-            logger.debug('Biarc: %s' % Biarc)
-            logger.debug(check_Pts)
-            logger.debug('check_Pts: %s %s %s %s' % (check_Pts[0], check_Pts[1], check_Pts[2], check_Pts[3]))
-            logger.debug('fit_error: %s' % fit_error)
+    def fit_biarc(self, samples, i, j, nom_tol, max_tol):
+        """
+        Calculates the biarc between the samples i and j and checks it against
+        the samples in between.
+        @return: The Biarc and True if it is within max_tol
+        """
+        Ps, tan_a = self.get_sample(samples, i)
+        Pb, tan_b = self.get_sample(samples, j)
+        Biarc = BiarcClass(Ps, tan_a, Pb, tan_b, nom_tol * 0.5)
+
+        if Biarc.shape == "Zero":
+            return Biarc, True
+        elif j - i <= self.check_samples:
+            # Not enough samples in between to check the biarc
+            return Biarc, False
+        return Biarc, self.check_biarc_fitting_tolerance(Biarc, max_tol, samples, i, j)
+
+    def check_biarc_fitting_tolerance(self, Biarc, epsilon, samples, i, j):
+        """
+        Checks the biarc against the samples between the samples i and j.
+        @return: True if all of them are within epsilon
+        """
+        fit_error = Biarc.get_biarc_fitting_errors(samples[i + 1:j, 1:3].tolist())
+        return max(fit_error) < epsilon
+
+
+class SplineCache(object):
+    """
+    Memo cache for the Spline2Arcs conversions. Identical splines (e.g. the
+    same spline in several blocks or copied parts) are only converted once.
+    The converted curves are stored as tuples and new geometries are created
+    for every hit, since the shapes modify their geometries later on.
+    """
+    # Version of the cache file, it needs to be increased whenever the
+    # conversion or the format of the entries changes. Files of another
+    # version are discarded.
+    VERSION = 2
+
+    def __init__(self, max_curves=10000):
+        """
+        @param max_curves: The number of splines which are kept, the least
+        recently used ones are dropped first
+        """
+        self.curves = OrderedDict()
+        self.max_curves = max_curves
+        self.filename = None
+        self.modified = False
+
+    def make_key(self, degree, Knots, Weights, CPoints, tol, check):
+        """
+        Returns the key of the spline, which is built from its content.
+        """
+        return (degree, tuple(Knots), tuple(Weights),
+                tuple((CPoint.x, CPoint.y) for CPoint in CPoints), tol, check)
 
-        if max(fit_error) >= epsilon:
-            return 0
+    def convert(self, degree=0, Knots=[], Weights=[], CPoints=[], tol=0.01, check=1):
+        """
+        Returns the converted Curve of the spline, either from the cache or
+        by converting it with Spline2Arcs.
+        @return: list of ArcGeo and LineGeo
+        """
+        key = self.make_key(degree, Knots, Weights, CPoints, tol, check)
+        if key in self.curves:
+            # Move it to the end, as the most recently used one
+            curve = self.curves.pop(key)
+            self.curves[key] = curve
+            return [self.tuple_2_geo(geo) for geo in curve]
+
+        Curve = Spline2Arcs(degree=degree, Knots=Knots, Weights=Weights,
+                            CPoints=CPoints, tol=tol, check=check).Curve
+        self.curves[key] = [self.geo_2_tuple(geo) for geo in Curve]
+        self.modified = True
+        self.limit()
+        return Curve
+
+    def limit(self):
+        """
+        Drops the least recently used splines, which exceed max_curves.
+        """
+        while len(self.curves) > self.max_curves:
+            self.curves.popitem(last=False)
+
+    def geo_2_tuple(self, geo):
+        """
+        Returns the values which are needed to recreate the geometry
+        """
+        if isinstance(geo, ArcGeo):
+            return (geo.Ps.x, geo.Ps.y, geo.Pe.x, geo.Pe.y,
+                    geo.O.x, geo.O.y, geo.r, geo.s_ang, geo.e_ang, geo.ext)
         else:
-            return 1
+            return (geo.Ps.x, geo.Ps.y, geo.Pe.x, geo.Pe.y)
+
+    def tuple_2_geo(self, values):
+        """
+        Creates the geometry out of the values of geo_2_tuple()
+        """
+        if len(values) == 4:
+            return LineGeo(Point(values[0], values[1]), Point(values[2], values[3]))
+        else:
+            return ArcGeo(Ps=Point(values[0], values[1]),
+                          Pe=Point(values[2], values[3]),
+                          O=Point(values[4], values[5]),
+                          r=values[6], s_ang=values[7], e_ang=values[8],
+                          direction=values[9])
+
+    def load(self, filename, max_curves=None):
+        """
+        Loads the cache file, if it is not already loaded. An empty filename
+        disables the persistence.
+        @param filename: The name of the cache file
+        @param max_curves: None or the new number of splines which are kept
+        """
+        if max_curves is not None:
+            self.max_curves = max_curves
+            self.limit()
+        filename = os.path.expanduser(filename) if filename else None
+        if filename == self.filename:
+            return
+        self.filename = filename
+        self.modified = False
+        if filename is None or not os.path.isfile(filename):
+            return
+
+        try:
+            with open(filename, 'r') as cache_file:
+                content = json.load(cache_file)
+        except (IOError, OSError, ValueError) as e:
+            logger.warning("Unable to read the spline cache %s: %s" % (filename, e))
+            return
+
+        if not isinstance(content, dict) or content.get('version') != self.VERSION:
+            logger.info("Discarding the spline cache %s of another version" % filename)
+            return
+
+        # The entries are stored from the least to the most recently used one
+        entries = content['curves'][-self.max_curves:] if self.max_curves > 0 else []
+        for key, curve in entries:
+            degree, Knots, Weights, CPoints, tol, check = key
+            key = (degree, tuple(Knots), tuple(Weights),
+                   tuple(tuple(CPoint) for CPoint in CPoints), tol, check)
+            self.curves.pop(key, None)
+            self.curves[key] = [tuple(geo) for geo in curve]
+        self.limit()
+        logger.debug("Loaded %i splines from the cache %s" % (len(entries), filename))
+
+    def save(self):
+        """
+        Writes the cache to its file if new splines were converted.
+        """
+        if self.filename is None or not self.modified:
+            return
+
+        # A unique temporary file, since several processes (e.g. of a batch)
+        # may write the cache at the same time
+        tmp_filename = None
+        try:
+            fd, tmp_filename = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.filename)),
+                prefix='.' + os.path.basename(self.filename), suffix='.tmp')
+            with os.fdopen(fd, 'w') as cache_file:
+                json.dump({'version': self.VERSION,
+                           'curves': list(self.curves.items())}, cache_file)
+            if hasattr(os, 'replace'):
+                os.replace(tmp_filename, self.filename)
+            else:
+                # Python 2: rename doesn't replace files on Windows
+                if os.name == 'nt' and os.path.isfile(self.filename):
+                    os.remove(self.filename)
+                os.rename(tmp_filename, self.filename)
+        except (IOError, OSError) as e:
+            logger.warning("Unable to write the spline cache %s: %s" % (self.filename, e))
+            if tmp_filename is not None and os.path.isfile(tmp_filename):
+                os.remove(tmp_filename)
+        else:
+            self.modified = False
+
+
+# One cache for all the splines of a run
+spline_cache = SplineCache()
 
 
 class NURBSClass:
@@ -643,6 +902,31 @@ class NURBSClass:
         else:
             return Point
 
+    def NURBS_evaluate_array(self, n=0, u=()):
+        """
+        Berechnen mehrerer Punkte des NURBS und der ersten Ableitung in einem
+        Aufruf.
+        Evaluates the NURBS for an array of u values at once.
+        @param n: 0 for points only, 1 to also return the tangent angles
+        @param u: sequence of the parameters to evaluate
+        @return: array of the points with shape (len(u), 2) and, if n > 0, the
+        array of the tangent angles
+        """
+        HPt = self.BSpline.bspline_ders_evaluate_array(n=n, u=u)
+
+        # Punkte wieder in Normal Koordinaten zur�ck transformieren
+        w = HPt[0, :, -1:]
+        Pts = HPt[0, :, :-1] / w
+
+        if n > 0:
+            #    w(u)*A'(u)-w'(u)*A(u)
+            # dPt=---------------------
+            #           w(u)^2
+            dPt = (w * HPt[1, :, :-1] - HPt[1, :, -1:] * HPt[0, :, :-1]) / w ** 2
+            return Pts, np.arctan2(dPt[:, 1], dPt[:, 0])
+        else:
+            return Pts
+
     def CPts_2_HCPts(self):
         """
         Umwandeln der NURBS Kontrollpunkte und Weight in einen Homogenen Vektor
@@ -670,6 +954,10 @@ class BSplineClass:
         self.CPt_len = len(self.CPts[0])
         self.CPts_len = len(self.CPts)
 
+        # Array copies used for the batched evaluation
+        self.Knots_array = np.array(self.Knots, dtype=float)
+        self.CPts_array = np.array(self.CPts, dtype=float)
+
         # Eingangspr�fung, ober KnotenAnzahl usw. passt
         if self.Knots_len < self.degree + 1:
             raise ValueError("degree greater than number of control points.")
@@ -734,6 +1022,32 @@ class BSplineClass:
 
         return CK
 
+    def bspline_ders_evaluate_array(self, n=0, u=()):
+        """
+        Batched version of bspline_ders_evaluate() for an array of u values.
+        @return: array with shape (n + 1, len(u), CPt_len)
+        """
+        u = np.asarray(u, dtype=float)
+        p = self.degree
+        du = min(n, p)
+
+        span = self.findspan_array(u)
+        dN = self.ders_basis_functions_array(span, u, du)
+
+        # Indices of the control points which influence each u
+        cpt_nr = span + np.arange(-p, 1)[:, np.newaxis]
+
+        CK = np.zeros((n + 1, len(u), self.CPt_len))
+        CK[:du + 1] = np.einsum('kjm,jmi->kmi', np.array(dN), self.CPts_array[cpt_nr])
+        return CK
+
+    def findspan_array(self, u):
+        """
+        Batched version of findspan() using a binary search over the knots.
+        """
+        inner_knots = self.Knots_array[self.degree + 1:self.Knots_len - self.degree - 1]
+        return self.degree + np.searchsorted(inner_knots, u, side='right')
+
     def findspan(self, u):
         """
         Algorithm A2.1 from "THE NURBS BOOK" pg.68
@@ -877,3 +1191,74 @@ class BSplineClass:
                 ders[k][j] *= r
             r *= (d - k)
         return ders
+
+    def ders_basis_functions_array(self, span, u, n):
+        """
+        Algorithm A2.3 from "THE NURBS BOOK" pg.72, evaluated for all u values
+        at once. Each entry of the returned (n + 1, degree + 1) nested lists
+        is an array along u.
+        """
+        d = self.degree
+
+        # All knot differences needed for the spans in one gather
+        j_range = np.arange(1, d + 1)[:, np.newaxis]
+        left = [None] + list(u - self.Knots_array[span + 1 - j_range])
+        right = [None] + list(self.Knots_array[span + j_range] - u)
+
+        zeros = np.zeros(len(u))
+        ndu = [[zeros] * (d + 1) for _ in range(d + 1)]
+        ndu[0][0] = np.ones(len(u))
+
+        for j in range(1, d + 1):
+            saved = zeros
+            for r in range(j):
+                # Lower Triangle
+                ndu[j][r] = right[r + 1] + left[j - r]
+                temp = ndu[r][j - 1] / ndu[j][r]
+                # Upper Triangle
+                ndu[r][j] = saved + right[r + 1] * temp
+                saved = left[j - r] * temp
+            ndu[j][j] = saved
+
+        # Load the basis functions
+        ders = [[ndu[j][d] for j in range(d + 1)]]
+        ders += [[zeros] * (d + 1) for _ in range(n)]
+
+        # This section computes the derivatives (Eq. [2.9])
+        a = [[zeros] * (d + 1) for _ in range(2)]
+        for r in range(d + 1):  # Loop over function index
+            s1 = 0; s2 = 1  # Alternate rows in array a
+            a[0][0] = 1.0
+            for k in range(1, n + 1):
+                der = zeros
+                rk = r - k; pk = d - k
+
+                if r >= k:
+                    a[s2][0] = a[s1][0] / ndu[pk + 1][rk]
+                    der = a[s2][0] * ndu[rk][pk]
+                if rk >= -1:
+                    j1 = 1
+                else:
+                    j1 = -rk
+                if r - 1 <= pk:
+                    j2 = k - 1
+                else:
+                    j2 = d - r
+
+                for j in range(j1, j2 + 1):
+                    a[s2][j] = (a[s1][j] - a[s1][j - 1]) / ndu[pk + 1][rk + j]
+                    der = der + a[s2][j] * ndu[rk + j][pk]
+
+                if r <= pk:
+                    a[s2][k] = -a[s1][k - 1] / ndu[pk + 1][r]
+                    der = der + a[s2][k] * ndu[r][pk]
+
+                ders[k][r] = der
+                s1, s2 = s2, s1  # Switch rows
+
+        # Multiply through by the correct factors
+        r = d
+        for k in range(1, n + 1):
+            ders[k] = [der * r for der in ders[k]]
+            r *= (d - k)
+        return ders
@@ -51,7 +51,7 @@ except ImportError:
 
 logger = logging.getLogger("Core.Config")
 
-CONFIG_VERSION = "9.9"
+CONFIG_VERSION = "9.20"
 """
 version tag - increment this each time you edit CONFIG_SPEC
 
@@ -156,6 +156,8 @@ CONFIG_SPEC = str('''
     split_line_segments = boolean(default = False)
     # Automatically enable cutter compensation for all the shapes (G41 & G42)
     automatic_cutter_compensation = boolean(default = False)
+    # Number of processes which generate the code of the shapes in parallel (only with absolute coordinates)
+    export_jobs = integer(min = 1, max = 64, default = 1)
     # Machine types supported: milling; lathe; drag_knife
     machine_type = option('milling', 'lathe', 'drag_knife', default = 'milling')
     # The unit used for all values in this file
@@ -191,7 +193,38 @@ CONFIG_SPEC = str('''
     # - Ordered will start with the defined one in the listbox
     # - Random just random
     # - Heuristic will search the nearest neighbors and starts with the resulting order.
-    begin_art = option('ordered', 'random', 'heuristic', default = 'heuristic')
+    # - Hilbert orders the shapes along a space-filling curve (fastest for very many shapes).
+    begin_art = option('ordered', 'random', 'heuristic', 'hilbert', default = 'heuristic')
+    # If enabled, the distance matrix is stored with single precision. This halves its memory for very many shapes.
+    float32_distance_matrix = boolean(default = False)
+    # Local search with 2-opt and Or-opt moves for the path optimizer:
+    # - none: only the genetic algorithm is used
+    # - memetic: the best routes of each generation are improved by the local search
+    # - alone: only the local search is used (on the start population)
+    local_search = option('none', 'memetic', 'alone', default = 'none')
+    # Number of nearest shapes which are tried as new neighbours of each shape by the local search.
+    candidate_neighbours = integer(min = 1, max = 100, default = 8)
+    # From this number of shapes on no distance matrix is generated. Only the nearest candidates of each shape are stored
+    # and the route is optimized by the local search alone (0 disables it).
+    large_instance_shapes = integer(min = 0, default = 5000)
+    # Number of populations (islands) which are optimized in parallel processes. They exchange their best routes
+    # every migration_interval generations (1 uses only one population in the main process).
+    islands = integer(min = 1, max = 64, default = 1)
+    migration_interval = integer(min = 1, max = 10000, default = 20)
+    # If enabled, the start point of the closed shapes which are optimized is moved to the vertex which shortens the
+    # rapid moves the most (manually set start points of these shapes are overwritten).
+    optimize_entry_points = boolean(default = False)
+    # If enabled, the closed shapes which lie inside other ones (e.g. holes) are always cut before them.
+    inner_first = boolean(default = False)
+    # Cost of the route which is minimized:
+    # - distance: the length of the rapid moves in the plane
+    # - machine_time: the estimated time of the moves between the shapes, including the retract and plunge moves
+    cost_model = option('distance', 'machine_time', default = 'distance')
+    # Rapid feed rates of the axes (units per minute) and their acceleration (units per s^2, 0 ignores it) for the machine_time cost model
+    rapid_feed_x = float(min = 1, default = 3000)
+    rapid_feed_y = float(min = 1, default = 3000)
+    rapid_feed_z = float(min = 1, default = 1500)
+    rapid_acceleration = float(min = 0, default = 500)
 
     [Import_Parameters]
     # Tolerance at which similar points will be interpreted as similar
@@ -203,6 +236,12 @@ CONFIG_SPEC = str('''
     spline_check = integer(min = 1, max = 3, default = 3)
     # This is the tolerance which is used to fit the converted lines and arc segments to the converted NURBS.
     fitting_tolerance = float(min = 0, max = 1, default = 0.001)
+    # File in which the converted splines are kept between runs, so that identical splines are converted only once. Leave it empty to disable it.
+    spline_cache_file = string(default = "")
+    # Maximum number of splines which are kept in the spline cache, the least recently used ones are dropped first.
+    spline_cache_size = integer(min = 0, default = 10000)
+    # If checked, runs of lines and arcs (e.g. tessellated polylines or ellipses) are replaced by the fewest lines and arcs within the fitting tolerance. This reduces the number of G-code blocks.
+    compact_geometry = boolean(default = False)
     # If checked, the elements (shape, ...) which are part of a block will be inserted on the layer that belongs to the block (even though the elements might be defined on a different layers)
     insert_at_block_layer = boolean(default = False)
 
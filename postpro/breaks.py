@@ -23,7 +23,7 @@
 #
 ############################################################################
 
-from math import sqrt
+from math import sqrt, isinf, isnan
 import logging
 
 from core.linegeo import LineGeo
@@ -31,12 +31,7 @@ from core.arcgeo import ArcGeo
 from core.breakgeo import BreakGeo
 from core.point import Point
 from core.shape import Geos
-
-import globals.constants as c
-if c.PYQT5notPYQT4:
-    from PyQt5.QtCore import QLineF, QPointF
-else:
-    from PyQt4.QtCore import QLineF, QPointF
+from postpro.spatialindex import BoxIndex
 
 logger = logging.getLogger("PostPro.Breaks")
 
@@ -58,6 +53,21 @@ class Breaks(object):
 
         logger.debug("Found %d break layers" % len(self.breakLayers))
 
+        # Only the lines of the break shapes break the geometries. The
+        # shapes are indexed by the bounding box of their lines, so that each
+        # geometry is only checked against the shapes which it may cross.
+        self.breakShapes = []
+        self.breakLines = []
+        boxes = []
+        for breakLayer in self.breakLayers:
+            for breakShape in breakLayer.shapes.not_disabled_iter():
+                lines = [breakGeo for breakGeo in breakShape.geos.abs_iter() if isinstance(breakGeo, LineGeo)]
+                if lines:
+                    self.breakShapes.append(breakShape)
+                    self.breakLines.append(lines)
+                    boxes.append(self.boundingBox([line.Ps for line in lines] + [line.Pe for line in lines]))
+        self.breakIndex = BoxIndex(boxes)
+
     def getNewGeos(self, geos):
         # TODO use intersect class and update_start_end_points
         new_geos = Geos([])
@@ -77,16 +87,16 @@ class Breaks(object):
         @return: The list of geometries after breaking (lineGeo itself if no breaking happened)
         """
         newGeos = Geos([])
-        for breakLayer in self.breakLayers:
-            for breakShape in breakLayer.shapes.not_disabled_iter():
-                intersections = self.intersectLineGeometry(lineGeo, breakShape)
-                if len(intersections) == 2:
-                    (near, far) = self.classifyIntersections(lineGeo, intersections)
-                    logger.debug("Line %s broken from (%f, %f) to (%f, %f)" % (lineGeo.to_short_string(), near.x, near.y, far.x, far.y))
-                    newGeos.extend(self.breakLineGeo(LineGeo(lineGeo.Ps, near)))
-                    newGeos.append(BreakGeo(near, far, breakShape.axis3_mill_depth, breakShape.f_g1_plane, breakShape.f_g1_depth))
-                    newGeos.extend(self.breakLineGeo(LineGeo(far, lineGeo.Pe)))
-                    return newGeos
+        for nr in self.breakIndex.overlapping(*self.boundingBox([lineGeo.Ps, lineGeo.Pe])):
+            breakShape = self.breakShapes[nr]
+            intersections = self.intersectLineGeometry(lineGeo, self.breakLines[nr])
+            if len(intersections) == 2:
+                (near, far) = self.classifyIntersections(lineGeo, intersections)
+                logger.debug("Line %s broken from (%f, %f) to (%f, %f)" % (lineGeo.to_short_string(), near.x, near.y, far.x, far.y))
+                newGeos.extend(self.breakLineGeo(LineGeo(lineGeo.Ps, near)))
+                newGeos.append(BreakGeo(near, far, breakShape.axis3_mill_depth, breakShape.f_g1_plane, breakShape.f_g1_depth))
+                newGeos.extend(self.breakLineGeo(LineGeo(far, lineGeo.Pe)))
+                return newGeos
         return [lineGeo]
 
     def breakArcGeo(self, arcGeo):
@@ -96,68 +106,87 @@ class Breaks(object):
         @return: The list of geometries after breaking (arcGeo itself if no breaking happened)
         """
         newGeos = Geos([])
-        for breakLayer in self.breakLayers:
-            for breakShape in breakLayer.shapes.not_disabled_iter():
-                intersections = self.intersectArcGeometry(arcGeo, breakShape)
-                if len(intersections) == 2:
-                    (near, far) = self.classifyIntersections(arcGeo, intersections)
-                    logger.debug("Arc %s broken from (%f, %f) to (%f, %f)" % (arcGeo.toShortString(), near.x, near.y, far.x, far.y))
-                    newGeos.extend(self.breakArcGeo(ArcGeo(Ps=arcGeo.Ps, Pe=near, O=arcGeo.O, r=arcGeo.r, s_ang=arcGeo.s_ang, direction=arcGeo.ext)))
-                    newGeos.append(BreakGeo(near, far, breakShape.axis3_mill_depth, breakShape.f_g1_plane, breakShape.f_g1_depth))
-                    newGeos.extend(self.breakArcGeo(ArcGeo(Ps=far, Pe=arcGeo.Pe, O=arcGeo.O, r=arcGeo.r, e_ang=arcGeo.e_ang, direction=arcGeo.ext)))
-                    return newGeos
+        # The intersections are on the circle of the arc
+        circleBox = (arcGeo.O.x - arcGeo.r, arcGeo.O.y - arcGeo.r, arcGeo.O.x + arcGeo.r, arcGeo.O.y + arcGeo.r)
+        for nr in self.breakIndex.overlapping(*circleBox):
+            breakShape = self.breakShapes[nr]
+            intersections = self.intersectArcGeometry(arcGeo, self.breakLines[nr])
+            if len(intersections) == 2:
+                (near, far) = self.classifyIntersections(arcGeo, intersections)
+                logger.debug("Arc %s broken from (%f, %f) to (%f, %f)" % (arcGeo.toShortString(), near.x, near.y, far.x, far.y))
+                newGeos.extend(self.breakArcGeo(ArcGeo(Ps=arcGeo.Ps, Pe=near, O=arcGeo.O, r=arcGeo.r, s_ang=arcGeo.s_ang, direction=arcGeo.ext)))
+                newGeos.append(BreakGeo(near, far, breakShape.axis3_mill_depth, breakShape.f_g1_plane, breakShape.f_g1_depth))
+                newGeos.extend(self.breakArcGeo(ArcGeo(Ps=far, Pe=arcGeo.Pe, O=arcGeo.O, r=arcGeo.r, e_ang=arcGeo.e_ang, direction=arcGeo.ext)))
+                return newGeos
         return [arcGeo]
 
-    def intersectLineGeometry(self, lineGeo, breakShape):
+    def boundingBox(self, points):
+        """
+        @return: The box (xmin, ymin, xmax, ymax) around the points, with a
+        margin for the rounding errors of the intersections
+        """
+        xs = [point.x for point in points]
+        ys = [point.y for point in points]
+        xmin, ymin, xmax, ymax = min(xs), min(ys), max(xs), max(ys)
+        margin = 1e-9 * (1 + max(abs(xmin), abs(ymin), abs(xmax), abs(ymax)))
+        return (xmin - margin, ymin - margin, xmax + margin, ymax + margin)
+
+    def intersectLineGeometry(self, lineGeo, breakLines):
         """
-        Try to break lineGeo with the given breakShape. Will return the intersection points of lineGeo with breakShape.
+        Try to break lineGeo with the lines of a break shape. Will return the intersection points of lineGeo with them.
+        The intersections are calculated like QLineF.intersect does (bounded intersections only).
         """
-        # TODO geos should be abs
         intersections = []
-        line = QLineF(lineGeo.Ps.x, lineGeo.Ps.y, lineGeo.Pe.x, lineGeo.Pe.y)
-        for breakGeo in breakShape.geos.abs_iter():
-            if isinstance(breakGeo, LineGeo):
-                breakLine = QLineF(breakGeo.Ps.x, breakGeo.Ps.y, breakGeo.Pe.x, breakGeo.Pe.y)
-                intersection = QPointF(0, 0)  # values do not matter
-                res = line.intersect(breakLine, intersection)
-                if res == QLineF.BoundedIntersection:
-                    intersections.append(Point(intersection.x(), intersection.y()))
+        x1, y1 = lineGeo.Ps.x, lineGeo.Ps.y
+        ax, ay = lineGeo.Pe.x - x1, lineGeo.Pe.y - y1
+        for breakGeo in breakLines:
+            bx, by = breakGeo.Ps.x - breakGeo.Pe.x, breakGeo.Ps.y - breakGeo.Pe.y
+            cx, cy = x1 - breakGeo.Ps.x, y1 - breakGeo.Ps.y
+            denominator = ay * bx - ax * by
+            if denominator == 0 or isinf(denominator) or isnan(denominator):
+                continue
+            reciprocal = 1 / denominator
+            na = (by * cx - bx * cy) * reciprocal
+            if na < 0 or na > 1:
+                continue
+            nb = (ax * cy - ay * cx) * reciprocal
+            if nb < 0 or nb > 1:
+                continue
+            intersections.append(Point(x1 + ax * na, y1 + ay * na))
         return intersections
 
-    def intersectArcGeometry(self, arcGeo, breakShape):
+    def intersectArcGeometry(self, arcGeo, breakLines):
         """
-        Get the intersections between the finite line and arc.
+        Get the intersections between the finite lines of a break shape and the arc.
         Algorithm based on http://vvvv.org/contribution/2d-circle-line-intersections
         """
-        # TODO geos should be abs
         intersections = []
-        for breakGeo in breakShape.geos.abs_iter():
-            if isinstance(breakGeo, LineGeo):
-                dxy = breakGeo.Pe - breakGeo.Ps
-                a = dxy.x**2 + dxy.y**2
-                b = 2 * (dxy.x * (breakGeo.Ps.x - arcGeo.O.x) + dxy.y * (breakGeo.Ps.y - arcGeo.O.y))
-                c = breakGeo.Ps.x**2 + breakGeo.Ps.y**2 + arcGeo.O.x**2 + arcGeo.O.y**2\
-                    - 2 * (arcGeo.O.x * breakGeo.Ps.x + arcGeo.O.y * breakGeo.Ps.y)\
-                    - arcGeo.r**2
-                bb4ac = b * b - 4 * a * c
-
-                if bb4ac > 0:
-                    mu1 = (-b + sqrt(bb4ac)) / (2*a)
-                    mu2 = (-b - sqrt(bb4ac)) / (2*a)
-                    p1 = breakGeo.Ps + mu1 * dxy
-                    p2 = breakGeo.Ps + mu2 * dxy
-
-                    # Points belong to the finite line?
-                    if not\
-                        (p1.x < breakGeo.Ps.x and p2.x < breakGeo.Ps.x and p1.x < breakGeo.Pe.x and p2.x < breakGeo.Pe.x or
-                         p1.y < breakGeo.Ps.y and p2.y < breakGeo.Ps.y and p1.y < breakGeo.Pe.y and p2.y < breakGeo.Pe.y or
-                         p1.x > breakGeo.Ps.x and p2.x > breakGeo.Ps.x and p1.x > breakGeo.Pe.x and p2.x > breakGeo.Pe.x or
-                         p1.y > breakGeo.Ps.y and p2.y > breakGeo.Ps.y and p1.y > breakGeo.Pe.y and p2.y > breakGeo.Pe.y):
-
-                        if arcGeo.O.distance(breakGeo.Ps) >= arcGeo.r and self.point_belongs_to_arc(p2, arcGeo):
-                            intersections.append(p2)
-                        if arcGeo.O.distance(breakGeo.Pe) >= arcGeo.r and self.point_belongs_to_arc(p1, arcGeo):
-                            intersections.append(p1)
+        for breakGeo in breakLines:
+            dxy = breakGeo.Pe - breakGeo.Ps
+            a = dxy.x**2 + dxy.y**2
+            b = 2 * (dxy.x * (breakGeo.Ps.x - arcGeo.O.x) + dxy.y * (breakGeo.Ps.y - arcGeo.O.y))
+            c = breakGeo.Ps.x**2 + breakGeo.Ps.y**2 + arcGeo.O.x**2 + arcGeo.O.y**2\
+                - 2 * (arcGeo.O.x * breakGeo.Ps.x + arcGeo.O.y * breakGeo.Ps.y)\
+                - arcGeo.r**2
+            bb4ac = b * b - 4 * a * c
+
+            if bb4ac > 0:
+                mu1 = (-b + sqrt(bb4ac)) / (2*a)
+                mu2 = (-b - sqrt(bb4ac)) / (2*a)
+                p1 = breakGeo.Ps + mu1 * dxy
+                p2 = breakGeo.Ps + mu2 * dxy
+
+                # Points belong to the finite line?
+                if not\
+                    (p1.x < breakGeo.Ps.x and p2.x < breakGeo.Ps.x and p1.x < breakGeo.Pe.x and p2.x < breakGeo.Pe.x or
+                     p1.y < breakGeo.Ps.y and p2.y < breakGeo.Ps.y and p1.y < breakGeo.Pe.y and p2.y < breakGeo.Pe.y or
+                     p1.x > breakGeo.Ps.x and p2.x > breakGeo.Ps.x and p1.x > breakGeo.Pe.x and p2.x > breakGeo.Pe.x or
+                     p1.y > breakGeo.Ps.y and p2.y > breakGeo.Ps.y and p1.y > breakGeo.Pe.y and p2.y > breakGeo.Pe.y):
+
+                    if arcGeo.O.distance(breakGeo.Ps) >= arcGeo.r and self.point_belongs_to_arc(p2, arcGeo):
+                        intersections.append(p2)
+                    if arcGeo.O.distance(breakGeo.Pe) >= arcGeo.r and self.point_belongs_to_arc(p1, arcGeo):
+                        intersections.append(p1)
         return intersections
 
     def point_belongs_to_arc(self, point, arcGeo):
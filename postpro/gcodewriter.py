@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+############################################################################
+#
+#   Copyright (C) 2008-2015
+#    Christian Kohlöffel
+#    Vinzenz Schulz
+#    Jean-Paul Schouwstra
+#
+#   This file is part of DXF2GCODE.
+#
+#   DXF2GCODE is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DXF2GCODE is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with DXF2GCODE.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import socket
+import sys
+import tempfile
+
+import logging
+logger = logging.getLogger("PostPro.GCodeWriter")
+
+
+class GCodeWriter(object):
+    """
+    Buffered sink for the exported code. The chunks are collected until
+    buffer_size characters are reached and then written (utf-8 encoded) and
+    flushed to the stream, so only the buffer is kept in memory and a
+    consumer gets the code while the export is still running. The code ends
+    with a newline like print() does, the same for all sinks.
+    """
+    def __init__(self, stream, buffer_size=65536, end='\n'):
+        """
+        @param stream: binary file like object to write to
+        @param buffer_size: The number of characters which are buffered
+        @param end: string written at the end of the code (like print does)
+        """
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.end = end
+        self.chunks = []
+        self.size = 0
+
+    def write(self, chunk):
+        """
+        Adds the chunk to the buffer, the buffer is written if it is full.
+        @param chunk: The string to write
+        """
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffer to the stream.
+        """
+        if self.chunks:
+            self.stream.write(''.join(self.chunks).encode('utf-8'))
+            self.chunks = []
+            self.size = 0
+        self.stream.flush()
+
+    def close(self):
+        """
+        Writes the rest of the code and closes the stream.
+        """
+        self.write(self.end)
+        self.flush()
+        self.stream.close()
+
+    def abort(self):
+        """
+        Closes the stream after an error, the buffer is dropped.
+        """
+        self.chunks = []
+        self.stream.close()
+
+
+class StdoutWriter(GCodeWriter):
+    """
+    Writes the code to stdout.
+    """
+    def __init__(self, buffer_size=65536):
+        sys.stdout.flush()
+        GCodeWriter.__init__(self, getattr(sys.stdout, 'buffer', sys.stdout), buffer_size)
+
+    def close(self):
+        # stdout stays open
+        self.write(self.end)
+        self.flush()
+
+    def abort(self):
+        self.chunks = []
+
+
+class FileWriter(GCodeWriter):
+    """
+    Writes the code to a temporary file next to the file, which replaces
+    the file when the export is finished. So there is never a half written
+    file with the name, e.g. if the export fails.
+    """
+    def __init__(self, filename, buffer_size=65536):
+        """
+        @param filename: The name of the file to create
+        """
+        self.filename = os.path.abspath(filename)
+        fd, self.tmp_filename = tempfile.mkstemp(
+            dir=os.path.dirname(self.filename),
+            prefix='.' + os.path.basename(self.filename), suffix='.tmp')
+        GCodeWriter.__init__(self, os.fdopen(fd, 'wb'), buffer_size)
+
+    def close(self):
+        GCodeWriter.close(self)
+        # mkstemp creates the file only readable by the user, the exported
+        # file gets the mode of the replaced file or the default mode
+        if os.path.exists(self.filename):
+            mode = os.stat(self.filename).st_mode & 0o7777
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(self.tmp_filename, mode)
+        if hasattr(os, 'replace'):
+            os.replace(self.tmp_filename, self.filename)
+        else:
+            # Python 2: rename doesn't replace files on Windows
+            if os.path.exists(self.filename) and os.name == 'nt':
+                os.remove(self.filename)
+            os.rename(self.tmp_filename, self.filename)
+        logger.info("Export to FILE %s was successful" % self.filename)
+
+    def abort(self):
+        GCodeWriter.abort(self)
+        os.remove(self.tmp_filename)
+
+
+class SocketWriter(GCodeWriter):
+    """
+    Sends the code to a TCP socket (e.g. of a machine controller).
+    """
+    def __init__(self, host, port, buffer_size=65536):
+        """
+        @param host: The host to connect to
+        @param port: The port to connect to
+        """
+        self.sock = socket.create_connection((host, port))
+        GCodeWriter.__init__(self, self.sock.makefile('wb'), buffer_size)
+
+    def close(self):
+        GCodeWriter.close(self)
+        self.sock.close()
+
+    def abort(self):
+        GCodeWriter.abort(self)
+        self.sock.close()
+
+
+class NullWriter(object):
+    """
+    Writer which drops the code (e.g. when only the moves are recorded).
+    """
+    def write(self, chunk):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+def open_writer(output=None):
+    """
+    Creates the writer for the given output.
+    @param output: None or '-' for stdout, 'tcp://HOST:PORT' for a socket,
+    otherwise the name of a file
+    @return: The writer
+    """
+    if output is None or output == '-':
+        return StdoutWriter()
+    elif output.startswith('tcp://'):
+        host, port = output[len('tcp://'):].rsplit(':', 1)
+        return SocketWriter(host, int(port))
+    else:
+        return FileWriter(output)
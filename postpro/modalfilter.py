@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+############################################################################
+#
+#   Copyright (C) 2008-2015
+#    Christian Kohlöffel
+#    Vinzenz Schulz
+#    Jean-Paul Schouwstra
+#
+#   This file is part of DXF2GCODE.
+#
+#   DXF2GCODE is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DXF2GCODE is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with DXF2GCODE.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+from __future__ import absolute_import
+from __future__ import division
+
+import re
+
+import logging
+logger = logging.getLogger("PostPro.ModalFilter")
+
+# Comments or a word (letter and number, e.g. "X  -1.000")
+WORD_RE = re.compile(r'\([^)]*\)|;.*|([A-Za-z])(\s*[-+]?[0-9.,]*)')
+
+# Words of arcs, the axis words of arcs are always written
+ARC_WORDS = 'IJKR'
+
+
+class ModalFilter(object):
+    """
+    Stage between the postprocessor and the GCodeWriter, which leaves out
+    the words which don't change the modal state of the machine:
+    - a code of a modal group (e.g. G1) if the last code of its group was
+      the same,
+    - axis words and modal words (e.g. F) if they have the same value as the
+      last time.
+    Lines which are empty then are left out completely. G codes which aren't
+    in a modal group (e.g. G81, G92, G41) make the modal state unknown
+    again, M6 the axis values. While G91 is active the axis words are always
+    written.
+    """
+    def __init__(self, writer, Modal_Filter, abs_export=True):
+        """
+        @param writer: The GCodeWriter to write the filtered code to
+        @param Modal_Filter: The Modal_Filter section of the postprocessor
+        config
+        @param abs_export: False if the program begins in incremental mode
+        """
+        self.writer = writer
+        self.groups = {}
+        for group_nr, group in enumerate(Modal_Filter['modal_groups']):
+            for code in group.split():
+                self.groups[self.make_code(code[0], code[1:])] = group_nr
+        self.axis_words = set(word.upper() for word in Modal_Filter['axis_words'])
+        self.modal_words = set(word.upper() for word in Modal_Filter['modal_words'])
+        self.incremental = not abs_export
+
+        self.group_codes = {}
+        self.values = {}
+        self.rest = ''
+
+    def make_code(self, letter, number):
+        """
+        @return: The code in a unique form (e.g. G1 for g01)
+        """
+        try:
+            return '%s%g' % (letter.upper(), float(number.replace(',', '.')))
+        except ValueError:
+            return letter.upper() + number.strip()
+
+    def write(self, chunk):
+        """
+        Filters the complete lines of the chunk, the rest of the last line is
+        kept until it is complete.
+        @param chunk: The string to write
+        """
+        lines = (self.rest + chunk).split('\n')
+        self.rest = lines.pop()
+        exstr = []
+        for line in lines:
+            line = self.filter_line(line)
+            if line is not None:
+                exstr.append(line + '\n')
+        self.writer.write(''.join(exstr))
+
+    def filter_line(self, line):
+        """
+        @param line: The line without the newline
+        @return: The line without the redundant words, None if nothing is
+        left of it
+        """
+        words = [(match.start(), match.end(), match.group(1).upper(), match.group(2).strip())
+                 for match in WORD_RE.finditer(line) if match.group(1)]
+        codes = [self.make_code(letter, number) for beg, end, letter, number in words]
+
+        # The axis values of the other mode are no longer valid
+        if 'G90' in codes or 'G91' in codes:
+            self.incremental = codes[max(nr for nr, code in enumerate(codes) if code in ('G90', 'G91'))] == 'G91'
+            self.values = {}
+        keep_axes = self.incremental or any(letter in ARC_WORDS for beg, end, letter, number in words)
+
+        drop = []
+        for (beg, end, letter, number), code in zip(words, codes):
+            if code in self.groups:
+                group_nr = self.groups[code]
+                if self.group_codes.get(group_nr) == code:
+                    drop.append((beg, end))
+                self.group_codes[group_nr] = code
+            elif letter == 'G':
+                # e.g. a canned cycle (G81) or its end (G80) changes the
+                # motion mode
+                self.group_codes = {}
+                self.values = {}
+            elif code == 'M6':
+                self.values = {}
+            elif letter in self.axis_words or letter in self.modal_words:
+                if self.values.get(letter) == number and not (keep_axes and letter in self.axis_words):
+                    drop.append((beg, end))
+                self.values[letter] = number
+
+        if not drop:
+            return line
+
+        # The whitespace before a word is removed with it, the one after it
+        # if it is at the beginning
+        for beg, end in reversed(drop):
+            while beg > 0 and line[beg - 1].isspace():
+                beg -= 1
+            if beg == 0:
+                while end < len(line) and line[end].isspace():
+                    end += 1
+            line = line[:beg] + line[end:]
+        return line if line.strip() else None
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        if self.rest:
+            line = self.filter_line(self.rest)
+            if line is not None:
+                self.writer.write(line)
+        self.writer.close()
+
+    def abort(self):
+        self.writer.abort()
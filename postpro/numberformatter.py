@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+############################################################################
+#
+#   Copyright (C) 2008-2015
+#    Christian Kohlöffel
+#    Vinzenz Schulz
+#    Jean-Paul Schouwstra
+#
+#   This file is part of DXF2GCODE.
+#
+#   DXF2GCODE is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DXF2GCODE is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with DXF2GCODE.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+from __future__ import absolute_import
+from __future__ import division
+
+import numpy as np
+
+import logging
+logger = logging.getLogger("PostPro.NumberFormatter")
+
+
+class NumberFormatter(object):
+    """
+    Formats the numbers as defined in the Number_Format section of a
+    postprocessor config. The settings are read and the format string is
+    built only once, when the formatter is created.
+    """
+    def __init__(self, Number_Format):
+        """
+        @param Number_Format: The Number_Format section of the postprocessor
+        config (e.g. vars.Number_Format)
+        """
+        pre_dec = Number_Format["pre_decimals"]
+        self.post_dec = Number_Format["post_decimals"]
+        self.dec_sep = Number_Format["decimal_separator"]
+        pre_dec_z_pad = Number_Format["pre_decimal_zero_padding"]
+        self.post_dec_z_pad = Number_Format["post_decimal_zero_padding"]
+        signed_val = Number_Format["signed_values"]
+
+        # + or - sign if required. Also used for Leading Zeros
+        self.format_str = ('%' + ('+' if signed_val else '') + ('0' if pre_dec_z_pad else '') +
+                           str(pre_dec + self.post_dec + 1) + '.' + str(self.post_dec) + 'f')
+
+        # The decimal point of the formatted number is replaced by the
+        # separator. With post_decimals = 0 there is no decimal point, then
+        # the last digit is cut and the whole number appended (as before)
+        self.head_end = -(self.post_dec + 1)
+        self.tail_beg = -self.post_dec
+
+        # Trailing zeros and a trailing separator are removed, if zero padding
+        # isn't wanted (a separator of more than one character stays)
+        self.strip_chars = '0' + self.dec_sep if len(self.dec_sep) == 1 else '0'
+
+    def format(self, number):
+        """
+        @param number: The number which shall be returned in a formatted string
+        @return: The formatted string of the number.
+        """
+        numstr = self.format_str % number
+        if self.post_dec_z_pad:
+            return numstr[:self.head_end] + self.dec_sep + numstr[self.tail_beg:]
+        return numstr[:self.head_end] + (self.dec_sep + numstr[self.tail_beg:]).rstrip(self.strip_chars)
+
+    def format_array(self, numbers):
+        """
+        Formats many numbers at once (e.g. all coordinates of a shape).
+        @param numbers: array or list of the numbers
+        @return: list of the formatted strings in the same order
+        """
+        format_str = self.format_str
+        head_end, tail_beg = self.head_end, self.tail_beg
+        dec_sep = self.dec_sep
+        numstrs = [format_str % number for number in np.asarray(numbers, dtype=float).ravel().tolist()]
+        if self.post_dec_z_pad:
+            return [numstr[:head_end] + dec_sep + numstr[tail_beg:] for numstr in numstrs]
+        strip_chars = self.strip_chars
+        return [numstr[:head_end] + (dec_sep + numstr[tail_beg:]).rstrip(strip_chars)
+                for numstr in numstrs]
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+############################################################################
+#
+#   Copyright (C) 2008-2015
+#    Christian Kohlöffel
+#    Vinzenz Schulz
+#    Jean-Paul Schouwstra
+#
+#   This file is part of DXF2GCODE.
+#
+#   DXF2GCODE is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DXF2GCODE is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with DXF2GCODE.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+from __future__ import absolute_import
+from __future__ import division
+
+import multiprocessing
+import os
+
+from postpro.postprocessor import MyPostProcessor, STATE_ATTRS, state_value
+
+import logging
+logger = logging.getLogger("PostPro.ParallelExport")
+
+# Postprocessor and shapes of the export, inherited by the forked workers
+_job = None
+_tracker = None
+_last_nr = -1
+
+# Postprocessors, toolpaths and outputs of a multi-target export
+_targets = None
+
+
+def _state_property(name):
+    def get(self):
+        try:
+            value = self._state[name]
+        except KeyError:
+            raise AttributeError(name)
+        if name not in self._writes and name not in self._reads:
+            self._reads[name] = state_value(value)
+        return value
+
+    def set(self, value):
+        self._writes.add(name)
+        self._state[name] = value
+    return property(get, set)
+
+
+class TrackingPostProcessor(MyPostProcessor):
+    """
+    Postprocessor of a worker process. Its state variables record, whether
+    the code of a shape reads them before setting them.
+    """
+    def __init__(self, PostPro):
+        """
+        Takes over the export variables of PostPro (the config files are not
+        loaded again).
+        @param PostPro: The postprocessor of the main process
+        """
+        self._reads = {}
+        self._writes = set()
+        self._state = {}
+        for name, value in PostPro.__dict__.items():
+            if name in STATE_ATTRS:
+                self._state[name] = value
+            else:
+                self.__dict__[name] = value
+
+    def export_shape(self, shape):
+        """
+        @return: The code of the shape, the values of the state variables
+        read before they were set and the values of the variables set
+        """
+        self._reads = {}
+        self._writes = set()
+        exstr = self.write_shape(shape)
+        return exstr, self._reads, dict((name, self._state[name]) for name in self._writes)
+
+for name in STATE_ATTRS:
+    setattr(TrackingPostProcessor, name, _state_property(name))
+
+
+def fork_context():
+    """
+    @return: The multiprocessing context which forks the workers, None if
+    there are no forked processes on this platform
+    """
+    if hasattr(multiprocessing, 'get_context'):
+        if 'fork' in multiprocessing.get_all_start_methods():
+            return multiprocessing.get_context('fork')
+    elif os.name == 'posix':
+        return multiprocessing
+    logger.info("There are no forked processes on this platform, running serially")
+    return None
+
+
+def _export_shape(nr):
+    global _tracker, _last_nr
+    PostPro, shapes = _job
+    if _tracker is None:
+        _tracker = TrackingPostProcessor(PostPro)
+    # At the beginning of a run the shape before is exported too, so that
+    # the state is mostly the same as in the main process
+    if nr > 0 and nr != _last_nr + 1:
+        _tracker.export_shape(shapes[nr - 1])
+    _last_nr = nr
+    return _tracker.export_shape(shapes[nr])
+
+
+def export_shapes_parallel(PostPro, shapes, jobs):
+    """
+    Exports the shapes in jobs worker processes. The code of a shape depends
+    on the shape, the config and the state of the postprocessor (e.g. the
+    current feed) when the shape begins. Each worker exports runs of
+    consecutive shapes with its own postprocessor, so its state is only
+    unknown at the beginning of a run. merge_shape_code checks the state.
+    @param PostPro: The postprocessor, initialized for the export
+    @param shapes: list of the shapes in the route order
+    @param jobs: The number of worker processes
+    @return: iterator over the codes of the shapes in the route order (see
+    merge_shape_code) or None if there are no forked processes on this
+    platform
+    """
+    global _job
+    context = fork_context()
+    if context is None:
+        return None
+
+    # The workers get the shapes by forking, they aren't picklable with the GUI
+    _job = (PostPro, shapes)
+    pool = context.Pool(jobs)
+    _job = None
+
+    def codes():
+        try:
+            chunksize = max(1, -(-len(shapes) // (4 * jobs)))
+            for code in pool.imap(_export_shape, range(len(shapes)), chunksize):
+                yield code
+        finally:
+            pool.terminate()
+    return codes()
+
+
+def merge_shape_code(PostPro, shape, code):
+    """
+    Takes the code of the shape from a worker, if the state variables which
+    the shape read before setting them had the same values as in PostPro.
+    Otherwise the shape is exported again, so the code is always the same as
+    with the serial export.
+    @param PostPro: The postprocessor of the main process
+    @param shape: The shape
+    @param code: The result of the worker for the shape
+    @return: The code of the shape
+    """
+    exstr, reads, writes = code
+    for name, value in reads.items():
+        if state_value(getattr(PostPro, name, None)) != value:
+            logger.debug("Shape Nr. %i exported again, %s differs" % (shape.nr, name))
+            return PostPro.write_shape(shape)
+
+    for name, value in writes.items():
+        setattr(PostPro, name, value)
+    return exstr
+
+
+def _export_toolpath(nr):
+    PostPro, toolpath, output = _targets[nr]
+    try:
+        PostPro.exportToolpath(toolpath, output)
+    except Exception as e:
+        return "%s: %s" % (type(e).__name__, e)
+    return None
+
+
+def export_toolpaths_parallel(targets, jobs=None):
+    """
+    Writes the toolpaths with their postprocessors, each target in its own
+    worker process.
+    @param targets: list of (postprocessor, toolpath, output), see
+    MyPostProcessor.exportToolpath
+    @param jobs: The number of worker processes, the default is one per
+    target (at most the number of CPUs)
+    @return: dict of the outputs which failed and their errors
+    """
+    global _targets
+    if jobs is None:
+        jobs = min(len(targets), multiprocessing.cpu_count())
+
+    _targets = targets
+    try:
+        context = fork_context() if jobs > 1 and len(targets) > 1 else None
+        if context is None:
+            results = [_export_toolpath(nr) for nr in range(len(targets))]
+        else:
+            # The workers get the toolpaths by forking
+            pool = context.Pool(min(jobs, len(targets)))
+            try:
+                results = pool.map(_export_toolpath, range(len(targets)))
+            finally:
+                pool.terminate()
+    finally:
+        _targets = None
+
+    errors = {}
+    for (PostPro, toolpath, output), error in zip(targets, results):
+        if error is not None:
+            logger.error("Export to %s failed: %s" % (output, error))
+            errors[output] = error
+    return errors
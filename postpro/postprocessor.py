@@ -27,16 +27,22 @@
 
 import os
 import time
+from copy import copy
 import re
 from math import degrees
 import shutil
 import logging
 
+import numpy as np
+
 import globals.globals as g
 
 from core.point import Point
 from postpro.postprocessorconfig import MyPostProConfig
 from postpro.breaks import Breaks
+from postpro.gcodewriter import open_writer, NullWriter
+from postpro.modalfilter import ModalFilter
+from postpro.numberformatter import NumberFormatter
 from gui.configwindow import *
 
 from globals.six import text_type, PY2
@@ -49,6 +55,25 @@ else:
 
 logger = logging.getLogger("PostPro.PostProcessor")
 
+# The variables of the postprocessor which are passed from move to move (and
+# from shape to shape)
+STATE_ATTRS = ('feed', 'speed', 'tool_nr', 'comment', 'cut_cor',
+               'Pe', 'Ps', 'lPe', 'IJ', 'O', 'r', 's_ang', 'e_ang', 'ext',
+               'ze', 'lz')
+
+# The variables set by the moves in the plane (lin_pol_xy and lin_pol_arc)
+PLANE_ATTRS = ('Pe', 'Ps', 'lPe', 'IJ', 'O', 'r', 's_ang', 'e_ang', 'ext')
+
+
+def state_value(value):
+    """
+    @return: A value which can be compared exactly (points by their
+    coordinates)
+    """
+    if isinstance(value, Point):
+        return (value.x, value.y)
+    return value
+
 
 class MyPostProcessor(object):
     """
@@ -56,6 +81,9 @@ class MyPostProcessor(object):
     variables from the PostProcessorConfig Classes and general function related
     to the export of the Code.
     """
+    # The code of the passes of a shape is reused (see Shape.Write_GCode)
+    cache_geos = True
+
     def __init__(self):
         """
         The initialisation of the Postprocessor class. This function is called
@@ -162,7 +190,7 @@ class MyPostProcessor(object):
         return PostProConfig
 
 
-    def exportShapes(self, load_filename, save_filename, LayerContents):
+    def exportShapes(self, load_filename, save_filename, LayerContents, output=None, jobs=None):
         """
         This function performs the export to a file or stdout.
         It calls the following dedicated export functions and runs
@@ -175,16 +203,189 @@ class MyPostProcessor(object):
         LayerContent to be exported and the LayerContent itself includes the
         export parameters (e.g. mill depth) and the shapes to be exported. The
         shape order is also given in a list defined in LayerContent.
+        @param output: Where the code is written to, None or '-' for stdout,
+        'tcp://HOST:PORT' for a socket or the name of a file (see open_writer)
+        @param jobs: The number of processes which export the shapes, the
+        default is General/export_jobs of the config
+        """
+        self.breaks = Breaks(LayerContents)
+        self.initialize_export_vars()
+
+        # The code is written chunk by chunk (e.g. shape by shape), so it is
+        # never kept in memory completely
+        writer = self.open_export_writer(output)
+        try:
+            self.write_gcode(writer, load_filename, LayerContents, jobs)
+        except:
+            writer.abort()
+            raise
+        writer.close()
+
+    def open_export_writer(self, output=None):
+        """
+        @param output: see exportShapes
+        @return: The writer for the output, with the modal filter if it is
+        enabled in the postprocessor config
+        """
+        writer = open_writer(output)
+        if self.vars.Modal_Filter['enabled'] and self.vars.General["output_type"] == 'g-code':
+            writer = ModalFilter(writer, self.vars.Modal_Filter, self.abs_export)
+        return writer
+
+    def make_toolpath(self, load_filename, LayerContents):
         """
+        Records the moves of the export in a Toolpath, which can be written
+        with exportToolpath by this or another postprocessor with the same
+        options (see get_toolpath_options).
+        @param load_filename: see exportShapes
+        @param LayerContents: see exportShapes
+        @return: The Toolpath
+        """
+        from postpro.toolpath import Toolpath, ToolpathRecorder
+
         self.breaks = Breaks(LayerContents)
         self.initialize_export_vars()
+        toolpath = Toolpath(self.get_toolpath_options())
+        recorder = ToolpathRecorder(self, toolpath)
+        recorder.write_gcode(NullWriter(), load_filename, LayerContents, jobs=1)
+        toolpath.flush()
+        logger.debug(self.tr("Toolpath with %i records") % len(toolpath))
+        return toolpath
 
-        exstr = self.write_gcode_be(load_filename)
+    def exportToolpath(self, toolpath, output=None):
+        """
+        Writes the code of a Toolpath (see make_toolpath) with this
+        postprocessor.
+        @param toolpath: The Toolpath
+        @param output: see exportShapes
+        """
+        self.initialize_export_vars()
+        writer = self.open_export_writer(output)
+        try:
+            toolpath.replay(self, writer)
+        except:
+            writer.abort()
+            raise
+        writer.close()
+
+    def exportShapesMulti(self, load_filename, LayerContents, targets, jobs=None):
+        """
+        Exports the shapes with several postprocessor configs at once. The
+        toolpath is recorded once for all configs with the same options (see
+        get_toolpath_options) and then written for each config in its own
+        process.
+        @param load_filename: see exportShapes
+        @param LayerContents: see exportShapes
+        @param targets: list of (postprocessor file, output). The output is
+        as for exportShapes, None for a file next to the dxf file named after
+        the postprocessor file (e.g. part_laser.ngc)
+        @param jobs: The number of processes, the default is one per target
+        @return: dict of the outputs which failed and their errors
+        """
+        from postpro.parallelexport import export_toolpaths_parallel
+
+        postpros = []
+        for postprocessor_file, output in targets:
+            PostPro = self.get_postprocessor(postprocessor_file)
+            if output is None:
+                output = "%s_%s.%s" % (os.path.splitext(load_filename)[0],
+                                       os.path.splitext(postprocessor_file)[0],
+                                       PostPro.vars.General['output_format'].lstrip('.'))
+            postpros.append((PostPro, output))
+
+        if sum(1 for PostPro, output in postpros if output in (None, '-')) > 1:
+            raise ValueError(self.tr("Only one target can be written to stdout"))
+
+        toolpaths = {}
+        exports = []
+        for PostPro, output in postpros:
+            options = PostPro.get_toolpath_options()
+            if options not in toolpaths:
+                toolpaths[options] = PostPro.make_toolpath(load_filename, LayerContents)
+            exports.append((PostPro, toolpaths[options], output))
+        logger.info(self.tr("Exporting %i targets with %i toolpaths") % (len(exports), len(toolpaths)))
+
+        return export_toolpaths_parallel(exports, jobs)
+
+    def get_postprocessor(self, postprocessor_file):
+        """
+        @param postprocessor_file: The name of a file in the postprocessor
+        config directory (e.g. postpro_config.cfg)
+        @return: A postprocessor with the variables of this file
+        """
+        if postprocessor_file not in self.postprocessor_files:
+            raise ValueError(self.tr("Unknown postprocessor config %s, the configs are: %s")
+                             % (postprocessor_file, ", ".join(self.postprocessor_files)))
+        PostPro = copy(self)
+        PostPro.getPostProVars(self.postprocessor_files.index(postprocessor_file))
+        return PostPro
+
+    def get_toolpath_options(self):
+        """
+        @return: The options of the postprocessor which change the moves, not
+        only their code (e.g. arcs exported as lines)
+        """
+        General = self.vars.General
+        return (General["output_type"] == 'dxf', General["abs_export"],
+                General["cc_outside_the_piece"], General["cancel_cc_for_depth"],
+                General["max_arc_radius"], General["export_arcs_as_lines"],
+                General["export_ccw_arcs_only"], self.vars.Number_Format["post_decimals"])
+
+    def write_gcode(self, writer, load_filename, LayerContents, jobs=None):
+        """
+        Writes the code of all the LayerContents to the writer.
+        @param writer: The GCodeWriter
+        @param load_filename: The name of the loaded dxf file
+        @param LayerContents: see exportShapes
+        @param jobs: see exportShapes
+        """
+        if jobs is None:
+            jobs = g.config.vars.General['export_jobs']
+        writer.write(self.write_gcode_be(load_filename))
 
         # Move Machine to retraction Area before continuing anything.
         # Note: none of the changes done in the GUI can affect this height,
         #       only the config file can do so (intended)
-        exstr += self.rap_pos_z(g.config.vars.Depth_Coordinates['axis3_retract'])
+        writer.write(self.rap_pos_z(g.config.vars.Depth_Coordinates['axis3_retract']))
+        writer.flush()
+
+        # The shapes are exported in parallel in the order of the route. In
+        # incremental mode each position depends on the one before.
+        shape_codes = None
+        if jobs > 1 and not self.abs_export:
+            logger.info(self.tr("Parallel export is only possible with absolute coordinates, exporting serially"))
+        elif jobs > 1:
+            from postpro.parallelexport import export_shapes_parallel
+            shapes = [LayerContent.shapes[shape_nr]
+                      for LayerContent in LayerContents.non_break_layer_iter()
+                      for shape_nr in LayerContent.exp_order_complete]
+            shape_codes = export_shapes_parallel(self, shapes, jobs)
+
+        try:
+            self.write_layers(writer, LayerContents, shape_codes)
+        finally:
+            if shape_codes is not None:
+                shape_codes.close()
+
+        # Move machine to the Final Position
+        EndPosition = Point(g.config.vars.Plane_Coordinates['axis1_start_end'],
+                            g.config.vars.Plane_Coordinates['axis2_start_end'])
+
+        writer.write(self.rap_pos_xy(EndPosition))
+
+        # Write the end G-Code at the end
+        writer.write(self.write_gcode_en())
+
+    def write_layers(self, writer, LayerContents, shape_codes=None):
+        """
+        Writes the code of the layers and their shapes to the writer.
+        @param writer: The GCodeWriter
+        @param LayerContents: see exportShapes
+        @param shape_codes: iterator over the codes of the shapes from the
+        worker processes (see export_shapes_parallel) or None
+        """
+        if shape_codes is not None:
+            from postpro.parallelexport import merge_shape_code
 
         previous_tool = None
         # Do the export for each LayerContent in LayerContents List
@@ -199,39 +400,27 @@ class MyPostProcessor(object):
             # print LayerContent.exp_order_complete
 
             if len(LayerContent.exp_order_complete):
-                exstr += self.commentprint("*** LAYER: %s ***" % LayerContent.name)
+                writer.write(self.commentprint("*** LAYER: %s ***" % LayerContent.name))
 
                 # If tool has changed for this LayerContent, add it
                 if LayerContent.tool_nr != previous_tool:
-                    exstr += self.chg_tool(LayerContent.tool_nr, LayerContent.speed)
+                    writer.write(self.chg_tool(LayerContent.tool_nr, LayerContent.speed))
                     previous_tool = LayerContent.tool_nr
 
-                # for shape_nr in LayerContent.exp_order_complete:
-                for shape in LayerContent.shapes:
-                    logger.debug(self.tr("Beginning export of Shape Nr: %s") % shape.nr)
-                    exstr += self.commentprint("* SHAPE Nr: %i *" % shape.nr)
-                    exstr += shape.Write_GCode(self)
-
-        # Move machine to the Final Position
-        EndPosition = Point(g.config.vars.Plane_Coordinates['axis1_start_end'],
-                            g.config.vars.Plane_Coordinates['axis2_start_end'])
-
-        exstr += self.rap_pos_xy(EndPosition)
+                for shape_nr in LayerContent.exp_order_complete:
+                    shape = LayerContent.shapes[shape_nr]
+                    if shape_codes is None:
+                        writer.write(self.write_shape(shape))
+                    else:
+                        writer.write(merge_shape_code(self, shape, next(shape_codes)))
 
-        # Write the end G-Code at the end
-        exstr += self.write_gcode_en()
-
-        # exstr = self.make_line_numbers(exstr)
-        print(exstr)
-        # try:
-        #     # File open and write
-        #     f = open(save_filename, "w")
-        #     f.write(str_encode(exstr))
-        #     f.close()
-        #     logger.info("Export to FILE was successful")
-        # except IOError:
-        #     logger.info("Warning during Export")
-        #     logger.info("Cannot Save the File")
+    def write_shape(self, shape):
+        """
+        @param shape: The shape to export
+        @return: The code of the shape with the comment before it
+        """
+        logger.debug(self.tr("Beginning export of Shape Nr: %s") % shape.nr)
+        return self.commentprint("* SHAPE Nr: %i *" % shape.nr) + shape.Write_GCode(self)
 
     def initialize_export_vars(self):
         """
@@ -245,6 +434,7 @@ class MyPostProcessor(object):
         self.comment = ""
 
         self.abs_export = self.vars.General["abs_export"]
+        self.number_formatter = NumberFormatter(self.vars.Number_Format)
 
         self.Pe = Point(g.config.vars.Plane_Coordinates['axis1_start_end'],
                         g.config.vars.Plane_Coordinates['axis2_start_end'])
@@ -296,6 +486,12 @@ class MyPostProcessor(object):
                         "%-ext": 'self.fnprint(degrees(-self.ext))',
                         "%comment": 'self.sprint(self.comment)'}
 
+        # The keyvars are compiled once, the templates when they are used the
+        # first time (see make_print_str)
+        self.keycodes = [(key, compile(value, key, 'eval'))
+                         for key, value in self.keyvars.items()]
+        self.templates = {}
+
     def write_gcode_be(self, load_filename):
         """
         Adding the begin to a new variable. If the exported file is from the
@@ -437,6 +633,67 @@ class MyPostProcessor(object):
         else:
             return self.make_print_str(self.vars.Program["arc_int_ccw"])
 
+    def lin_pol_xy_points(self, Ps, xs, ys):
+        """
+        Code for the lines from Ps through the points (e.g. an arc exported
+        as lines), the same as lin_pol_xy for each line. The coordinates are
+        formatted all at once and the code is returned as one block.
+        @param Ps: The start point of the first line
+        @param xs: array of the x values of the end points
+        @param ys: array of the y values of the end points
+        @return: Returns the string which shall be added.
+        """
+        xs = np.asarray(xs, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        if not len(xs):
+            return ""
+
+        keystr = self.vars.Program["lin_mov_plane"]
+        tokens = self.templates.get(keystr)
+        if tokens is None:
+            tokens = self.templates[keystr] = self.compile_template(keystr)
+        if tokens[-1] and '%' in self.comment:
+            exstr = []
+            for Pe in [Point(x, y) for x, y in zip(xs.tolist(), ys.tolist())]:
+                exstr.append(self.lin_pol_xy(Ps, Pe))
+                Ps = Pe
+            return ''.join(exstr)
+
+        fac = 2 if g.config.machine_type == 'lathe' else 1
+
+        xs_start = np.concatenate(([Ps.x], xs[:-1]))
+        ys_start = np.concatenate(([Ps.y], ys[:-1]))
+        if self.abs_export:
+            xs_end, ys_end = xs, ys
+        else:
+            xs_end = np.diff(np.concatenate(([self.lPe.x], xs)))
+            ys_end = np.diff(np.concatenate(([self.lPe.y], ys)))
+
+        # The keys of the points are formatted for all lines at once, the
+        # other keys are the same for all lines
+        columns = {"%XE": xs_end, "%-XE": -xs_end,
+                   "%YE": ys_end * fac, "%-YE": -ys_end * fac,
+                   "%XS": xs_start, "%-XS": -xs_start,
+                   "%YS": ys_start * fac, "%-YS": -ys_start * fac}
+        variables = {'self': self, 'fac': fac}
+        parts = []
+        for nr, token in enumerate(tokens[:-1]):
+            if nr % 2 == 0:
+                parts.append([token] * len(xs))
+                continue
+            key, code = token
+            if key in columns:
+                parts.append(self.number_formatter.format_array(columns[key]))
+            else:
+                parts.append([eval(code, globals(), variables)] * len(xs))
+        exstr = ''.join([''.join(line) for line in zip(*parts)])
+
+        self.Ps = Point(xs_start[-1].item(), ys_start[-1].item())
+        self.Pe = Point(xs_end[-1].item(), ys_end[-1].item())
+        if not self.abs_export:
+            self.lPe = Point(xs[-1].item(), ys[-1].item())
+        return exstr
+
     def rap_pos_z(self, z_pos):
         """
         Code to add if the machine is rapidly commanded to a new
@@ -534,6 +791,105 @@ class MyPostProcessor(object):
         else:
             fac = 1
 
+        tokens = self.templates.get(keystr)
+        if tokens is None:
+            tokens = self.templates[keystr] = self.compile_template(keystr)
+
+        # A comment may contain keys itself, these are replaced too by the
+        # keys which follow %comment
+        if tokens[-1] and '%' in self.comment:
+            return self.replace_keyvars(keystr, fac)
+
+        # Only the keys in the template are evaluated
+        # Nur die Schluessel im Template werden ausgewertet
+        variables = {'self': self, 'fac': fac}
+        exstr = tokens[:-1]
+        for nr in range(1, len(exstr), 2):
+            exstr[nr] = eval(exstr[nr][1], globals(), variables)
+        return ''.join(exstr)
+
+    def compile_template(self, keystr):
+        """
+        Splits the template at the keys in the same order as replace_keyvars
+        replaces them. The numbers don't contain any keys, so the result is
+        the same.
+        @param keystr: The template (e.g. Program["lin_mov_plane"])
+        @return: list of the text parts with the keys and their compiled
+        keyvars (key, code) in between, the last item tells if the template
+        contains %comment
+        """
+        tokens = [keystr]
+        has_comment = False
+        for key, code in self.keycodes:
+            new_tokens = []
+            for nr, token in enumerate(tokens):
+                if nr % 2:
+                    new_tokens.append(token)
+                    continue
+                parts = token.split(key)
+                if len(parts) > 1 and key == "%comment":
+                    has_comment = True
+                for part in parts:
+                    new_tokens += [part, (key, code)]
+                new_tokens.pop()
+            tokens = new_tokens
+        return tokens + [has_comment]
+
+    def template_attrs(self, keystr):
+        """
+        @param keystr: The template
+        @return: set of the state variables which the template reads
+        """
+        tokens = self.templates.get(keystr)
+        if tokens is None:
+            tokens = self.templates[keystr] = self.compile_template(keystr)
+        # With a comment containing keys all keyvars are evaluated
+        codes = [code for key, code in (self.keycodes if tokens[-1] else tokens[1:-1:2])]
+        names = set()
+        for code in codes:
+            names.update(code.co_names)
+        return names.intersection(STATE_ATTRS)
+
+    def get_plane_attrs(self):
+        """
+        @return: The state variables which the moves in the plane set or read.
+        The code of the moves only depends on these and the geometries, as
+        long as there are no breaks.
+        """
+        attrs = set(PLANE_ATTRS)
+        for name in ("lin_mov_plane", "arc_int_cw", "arc_int_ccw"):
+            attrs.update(self.template_attrs(self.vars.Program[name]))
+        return tuple(sorted(attrs))
+
+    def get_state(self, attrs):
+        """
+        @param attrs: The names of the state variables
+        @return: tuple of their values
+        """
+        return tuple(getattr(self, name, None) for name in attrs)
+
+    def get_state_key(self, attrs):
+        """
+        @param attrs: The names of the state variables
+        @return: tuple of their values, which can be compared exactly
+        """
+        return tuple(state_value(getattr(self, name, None)) for name in attrs)
+
+    def set_state(self, attrs, values):
+        """
+        @param attrs: The names of the state variables
+        @param values: The values from get_state
+        """
+        for name, value in zip(attrs, values):
+            setattr(self, name, value)
+
+    def replace_keyvars(self, keystr, fac):
+        """
+        Replaces the keys one after the other by their evaluated values.
+        @param keystr: The template
+        @param fac: The factor for the Y values (2 for lathes)
+        @return: Returns the string with replaced keyvars
+        """
         exstr = keystr
         for key, value in self.keyvars.items():
             exstr = exstr.replace(key, eval(value))
@@ -570,40 +926,7 @@ class MyPostProcessor(object):
         @param number: The number which shall be returned in a formatted string
         @return: The formatted string of the number.
         """
-        pre_dec = self.vars.Number_Format["pre_decimals"]
-        post_dec = self.vars.Number_Format["post_decimals"]
-        dec_sep = self.vars.Number_Format["decimal_separator"]
-        pre_dec_z_pad = self.vars.Number_Format["pre_decimal_zero_padding"]
-        post_dec_z_pad = self.vars.Number_Format["post_decimal_zero_padding"]
-        signed_val = self.vars.Number_Format["signed_values"]
-
-        exstr = ''
-
-        # + or - sign if required. Also used for Leading Zeros
-        if signed_val and pre_dec_z_pad:
-            numstr = ('%+0' + str(pre_dec + post_dec + 1) +
-                      '.' + str(post_dec) + 'f') % number
-        elif signed_val == 0 and pre_dec_z_pad:
-            numstr = ('%0' + str(pre_dec + post_dec + 1) +
-                      '.' + str(post_dec) + 'f') % number
-        elif signed_val and pre_dec_z_pad == 0:
-            numstr = ('%+' + str(pre_dec + post_dec + 1) +
-                      '.' + str(post_dec) + 'f') % number
-        elif signed_val == 0 and pre_dec_z_pad == 0:
-            numstr = ('%' + str(pre_dec + post_dec + 1) +
-                      '.' + str(post_dec) + 'f') % number
-
-        # Gives the required decimal format.
-        exstr += numstr[0:-(post_dec + 1)]
-
-        exstr_end = dec_sep
-        exstr_end += numstr[-post_dec:]
-
-        # Add's Zero's to the end if required
-        if not post_dec_z_pad:
-            while len(exstr_end) > 0 and (exstr_end[-1] == '0' or exstr_end[-1] == dec_sep):
-                exstr_end = exstr_end[0:-1]
-        return exstr + exstr_end
+        return self.number_formatter.format(number)
 
 #    def __str__(self):
 #
@@ -40,7 +40,7 @@ import globals.constants as c
 import logging
 logger = logging.getLogger("PostPro.PostProcessorConfig")
 
-POSTPRO_VERSION = "6"
+POSTPRO_VERSION = "8"
 """
 version tag - increment this each time you edit CONFIG_SPEC
 
@@ -76,6 +76,8 @@ POSTPRO_SPEC = str('''
     export_ccw_arcs_only = boolean(default=False)
     # If an arc's radius exceeds this value, then it will be exported as a line.
     max_arc_radius = float(min = 0, default=10000)
+    # Used for machines which don't support arcs. The arcs are exported as lines within the fitting tolerance of the import.
+    export_arcs_as_lines = boolean(default=False)
 
     code_begin_units_mm = string(default="G21 (Units in millimeters)")
     code_begin_units_in = string(default="G20 (Units in inches)")
@@ -100,6 +102,16 @@ POSTPRO_SPEC = str('''
     # If True 1.000 will be written as +1.000
     signed_values = boolean(default=False)
 
+    [Modal_Filter]
+    # If enabled, words which don't change the modal state of the machine are left out, e.g. a repeated G1, an unchanged X or F. This makes the programs smaller.
+    enabled = boolean(default=False)
+    # The groups of codes which are modal, a code is left out if the last code of its group was the same. Other G codes make the modal state unknown.
+    modal_groups = list(default=list('G0 G1 G2 G3', 'G17 G18 G19', 'G90 G91'))
+    # The axis words are left out if their value is unchanged, except in incremental mode (G91) and for arcs.
+    axis_words = list(default=list('X', 'Y', 'Z'))
+    # Further words which are left out if their value is unchanged.
+    modal_words = list(default=list('F', 'S'))
+
     [Line_Numbers]
     # Enables line numbers into the exported G-Code file.
     use_line_nrs = boolean(default=False)
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+############################################################################
+#
+#   Copyright (C) 2008-2015
+#    Christian Kohlöffel
+#    Vinzenz Schulz
+#    Jean-Paul Schouwstra
+#
+#   This file is part of DXF2GCODE.
+#
+#   DXF2GCODE is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DXF2GCODE is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with DXF2GCODE.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+from __future__ import absolute_import
+from __future__ import division
+
+from heapq import heappush, heapreplace
+from math import floor, hypot, sqrt
+
+import numpy as np
+
+import logging
+logger = logging.getLogger("PostPro.SpatialIndex")
+
+
+class GridIndex(object):
+    """
+    Grid of buckets with a few points each for nearest neighbour searches
+    directly on the coordinates (no distance matrix). Points can be removed,
+    if only a quarter of the points is left the grid is rebuilt with bigger
+    buckets, so that the searches don't have to pass many empty buckets.
+    """
+    def __init__(self, pts, bucket_size=2.0):
+        """
+        @param pts: array of the points with shape (n, 2)
+        @param bucket_size: The average number of points per bucket
+        """
+        self.pts = np.asarray(pts, dtype=float).reshape(-1, 2)
+        self.x = self.pts[:, 0].tolist()
+        self.y = self.pts[:, 1].tolist()
+        self.active = [True] * len(self.pts)
+        self.cells = [0] * len(self.pts)
+        self.bucket_size = bucket_size
+        self.build(np.arange(len(self.pts)))
+
+    def __len__(self):
+        return self.count
+
+    def build(self, nrs):
+        """
+        Sorts the points nrs into the buckets of a new grid
+        """
+        self.count = len(nrs)
+        self.built_count = len(nrs)
+        if not len(nrs):
+            return
+
+        pts = self.pts[nrs]
+        self.x0, self.y0 = pts.min(axis=0).tolist()
+        width, height = (pts.max(axis=0) - (self.x0, self.y0)).tolist()
+        self.cell = max(sqrt(width * height / len(nrs) * self.bucket_size),
+                        max(width, height) / len(nrs), 1e-9)
+        self.nx = int(width / self.cell) + 1
+        self.ny = int(height / self.cell) + 1
+
+        cells = np.floor((pts - (self.x0, self.y0)) / self.cell).astype(int)
+        cells = np.minimum(cells, (self.nx - 1, self.ny - 1))
+        cells = (cells[:, 0] * self.ny + cells[:, 1]).tolist()
+        self.buckets = [[] for cell in range(self.nx * self.ny)]
+        for cell, nr in zip(cells, np.asarray(nrs).tolist()):
+            self.buckets[cell].append(nr)
+            self.cells[nr] = cell
+
+    def remove(self, nr):
+        """
+        Removes the point nr from the index
+        """
+        if not self.active[nr]:
+            return
+        self.active[nr] = False
+        self.count -= 1
+        self.buckets[self.cells[nr]].remove(nr)
+
+        if self.count and self.count < self.built_count // 4:
+            self.build(np.flatnonzero(self.active))
+
+    def locate(self, x, y):
+        """
+        @return: The position (x, y) in units of buckets and the bucket
+        (ix, iy) next to it
+        """
+        fx = (x - self.x0) / self.cell
+        fy = (y - self.y0) / self.cell
+        ix = int(floor(fx))
+        ix = 0 if ix < 0 else self.nx - 1 if ix >= self.nx else ix
+        iy = int(floor(fy))
+        iy = 0 if iy < 0 else self.ny - 1 if iy >= self.ny else iy
+        return fx, fy, ix, iy
+
+    def ring_cells(self, ix, iy, ring):
+        """
+        @return: The buckets which are ring buckets away from (ix, iy)
+        """
+        nx, ny = self.nx, self.ny
+        if not ring:
+            return [ix * ny + iy]
+        y_beg = iy - ring if iy >= ring else 0
+        y_end = iy + ring if iy + ring < ny else ny - 1
+        cells = []
+        for cx in range(ix - ring if ix >= ring else 0, (ix + ring if ix + ring < nx else nx - 1) + 1):
+            if cx == ix - ring or cx == ix + ring:
+                cells.extend(range(cx * ny + y_beg, cx * ny + y_end + 1))
+            else:
+                cells.extend(cx * ny + cy for cy in (iy - ring, iy + ring) if 0 <= cy < ny)
+        return cells
+
+    def nearest(self, x, y):
+        """
+        Searches the nearest point to (x, y) ring by ring around its bucket,
+        until the ring can't contain a nearer point.
+        @return: The nr of the nearest point or None if there is none left
+        """
+        if not self.count:
+            return None
+
+        buckets = self.buckets
+        px, py = self.x, self.y
+        fx, fy, ix, iy = self.locate(x, y)
+
+        best_nr = None
+        best_dist = float('inf')
+        max_ring = max(ix, self.nx - 1 - ix, iy, self.ny - 1 - iy)
+        for ring in range(max_ring + 1):
+            # Points outside the cells within ring - 1 are at least as far
+            # away as the border of these cells
+            bound = min(fx - ix, ix + 1 - fx, fy - iy, iy + 1 - fy) + ring - 1
+            if best_dist <= bound * self.cell:
+                break
+
+            for cell in self.ring_cells(ix, iy, ring):
+                for nr in buckets[cell]:
+                    dist = hypot(px[nr] - x, py[nr] - y)
+                    if dist < best_dist:
+                        best_nr, best_dist = nr, dist
+        return best_nr
+
+    def k_nearest(self, x, y, k):
+        """
+        Searches the k nearest points to (x, y) in the same way as nearest().
+        @return: list of the nrs of the points sorted by their distance
+        """
+        buckets = self.buckets
+        px, py = self.x, self.y
+        k = min(k, self.count)
+        if not k:
+            return []
+        fx, fy, ix, iy = self.locate(x, y)
+
+        # Max-heap of the k nearest points found so far
+        heap = []
+        max_ring = max(ix, self.nx - 1 - ix, iy, self.ny - 1 - iy)
+        for ring in range(max_ring + 1):
+            bound = min(fx - ix, ix + 1 - fx, fy - iy, iy + 1 - fy) + ring - 1
+            if len(heap) == k and -heap[0][0] <= bound * self.cell:
+                break
+
+            for cell in self.ring_cells(ix, iy, ring):
+                for nr in buckets[cell]:
+                    dist = hypot(px[nr] - x, py[nr] - y)
+                    if len(heap) < k:
+                        heappush(heap, (-dist, nr))
+                    elif dist < -heap[0][0]:
+                        heapreplace(heap, (-dist, nr))
+        return [nr for dist, nr in sorted(heap, reverse=True)]
+
+
+class BoxIndex(object):
+    """
+    Grid of buckets with the boxes (e.g. bounding boxes of shapes) which
+    overlap them, to find the boxes which overlap a given box without
+    testing all of them.
+    """
+    def __init__(self, boxes):
+        """
+        @param boxes: array of the boxes (xmin, ymin, xmax, ymax) with shape
+        (n, 4)
+        """
+        self.boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        self.xmin, self.ymin, self.xmax, self.ymax = self.boxes.T.tolist()
+        if not len(self.boxes):
+            return
+
+        self.x0, self.y0 = self.boxes[:, :2].min(axis=0).tolist()
+        width, height = (self.boxes[:, 2:].max(axis=0) - (self.x0, self.y0)).tolist()
+        # About one box per bucket, but buckets not smaller than the boxes
+        sizes = self.boxes[:, 2:] - self.boxes[:, :2]
+        self.cell = max(sqrt(width * height / len(self.boxes)), float(sizes.max(axis=1).mean()),
+                        max(width, height) / len(self.boxes), 1e-9)
+        self.nx = int(width / self.cell) + 1
+        self.ny = int(height / self.cell) + 1
+
+        self.buckets = [[] for cell in range(self.nx * self.ny)]
+        for nr in range(len(self.boxes)):
+            ix_beg, iy_beg, ix_end, iy_end = self.cell_range(self.xmin[nr], self.ymin[nr],
+                                                             self.xmax[nr], self.ymax[nr])
+            for ix in range(ix_beg, ix_end + 1):
+                for cell in range(ix * self.ny + iy_beg, ix * self.ny + iy_end + 1):
+                    self.buckets[cell].append(nr)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def cell_range(self, xmin, ymin, xmax, ymax):
+        """
+        @return: The first and the last bucket (ix, iy) which the box
+        overlaps, clipped to the grid
+        """
+        nx, ny = self.nx, self.ny
+        ix_beg = int(floor((xmin - self.x0) / self.cell))
+        iy_beg = int(floor((ymin - self.y0) / self.cell))
+        ix_end = int(floor((xmax - self.x0) / self.cell))
+        iy_end = int(floor((ymax - self.y0) / self.cell))
+        return (0 if ix_beg < 0 else nx - 1 if ix_beg >= nx else ix_beg,
+                0 if iy_beg < 0 else ny - 1 if iy_beg >= ny else iy_beg,
+                0 if ix_end < 0 else nx - 1 if ix_end >= nx else ix_end,
+                0 if iy_end < 0 else ny - 1 if iy_end >= ny else iy_end)
+
+    def overlapping(self, xmin, ymin, xmax, ymax):
+        """
+        @return: sorted list of the nrs of the boxes which overlap the box
+        (touching boxes overlap too)
+        """
+        if not len(self.boxes) or xmax < self.x0 or ymax < self.y0:
+            return []
+
+        ix_beg, iy_beg, ix_end, iy_end = self.cell_range(xmin, ymin, xmax, ymax)
+        if ix_beg == ix_end and iy_beg == iy_end:
+            nrs = self.buckets[ix_beg * self.ny + iy_beg]
+        else:
+            nrs = set()
+            for ix in range(ix_beg, ix_end + 1):
+                for cell in range(ix * self.ny + iy_beg, ix * self.ny + iy_end + 1):
+                    nrs.update(self.buckets[cell])
+            nrs = sorted(nrs)
+
+        bxmin, bymin, bxmax, bymax = self.xmin, self.ymin, self.xmax, self.ymax
+        return [nr for nr in nrs
+                if bxmin[nr] <= xmax and xmin <= bxmax[nr] and bymin[nr] <= ymax and ymin <= bymax[nr]]
+
+
+def nearest_neighbour_tour(st_pts, end_pts, start_nr=0):
+    """
+    Builds a tour by going from the end point of each shape to the nearest
+    start point of the shapes not visited yet.
+    @param st_pts: array of the start points with shape (n, 2)
+    @param end_pts: array of the end points with shape (n, 2)
+    @param start_nr: The shape to begin with
+    @return: The tour as list of the shape nrs
+    """
+    index = GridIndex(st_pts)
+    end_x = np.asarray(end_pts, dtype=float)[:, 0].tolist()
+    end_y = np.asarray(end_pts, dtype=float)[:, 1].tolist()
+
+    tour = [start_nr]
+    index.remove(start_nr)
+    while len(index):
+        nr = index.nearest(end_x[tour[-1]], end_y[tour[-1]])
+        index.remove(nr)
+        tour.append(nr)
+    return tour
+
+
+def hilbert_order(pts, bits=16):
+    """
+    Sorts the points along a Hilbert space-filling curve, so that points which
+    are close to each other are mostly close in the order too.
+    @param pts: array of the points with shape (n, 2)
+    @param bits: The resolution of the curve is 2**bits in x and y
+    @return: The order as list of the point nrs
+    """
+    pts = np.asarray(pts, dtype=float).reshape(-1, 2)
+    if len(pts) < 2:
+        return list(range(len(pts)))
+
+    side = 1 << bits
+    mins = pts.min(axis=0)
+    span = max((pts.max(axis=0) - mins).max(), 1e-12)
+    xy = np.minimum(((pts - mins) / span * side).astype(np.int64), side - 1)
+    x = xy[:, 0].copy()
+    y = xy[:, 1].copy()
+
+    # Hilbert index of each point, from the biggest to the smallest quadrant
+    d = np.zeros(len(pts), dtype=np.int64)
+    s = side >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant
+        flip = ~ry & rx
+        x = np.where(flip, s - 1 - x, x)
+        y = np.where(flip, s - 1 - y, y)
+        swap = ~ry
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        s >>= 1
+    return np.argsort(d, kind='stable').tolist()
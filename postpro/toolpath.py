@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+
+############################################################################
+#
+#   Copyright (C) 2008-2015
+#    Christian Kohlöffel
+#    Vinzenz Schulz
+#    Jean-Paul Schouwstra
+#
+#   This file is part of DXF2GCODE.
+#
+#   DXF2GCODE is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DXF2GCODE is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with DXF2GCODE.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+from __future__ import absolute_import
+from __future__ import division
+
+import numpy as np
+
+from core.point import Point
+from postpro.postprocessor import MyPostProcessor
+
+import logging
+logger = logging.getLogger("PostPro.Toolpath")
+
+# The operations of the records
+BEGIN = 0           # write_gcode_be, text: load_filename
+END = 1             # write_gcode_en
+RAPID_XY = 2        # rap_pos_xy, x y
+RAPID_Z = 3         # rap_pos_z, z
+LINEAR_XY = 4       # lin_pol_xy, xs ys -> x y
+LINEAR_Z = 5        # lin_pol_z, z
+ARC_CW = 6          # lin_pol_arc, xs ys -> x y, xo yo i j r s_ang e_ang ext
+ARC_CCW = 7
+FEED = 8            # chg_feed_rate, z: feed
+TOOL = 9            # chg_tool, nr: tool_nr, z: speed
+CUT_COR = 10        # set_cut_cor, nr: 41/42
+CUT_COR_OFF = 11    # deactivate_cut_cor
+PRE_SHAPE_CUT = 12  # write_pre_shape_cut
+POST_SHAPE_CUT = 13 # write_post_shape_cut
+COMMENT = 14        # commentprint, text
+CODE = 15           # make_print_str, text: the template
+TEXT = 16           # text written as it is (e.g. of a CustomGCode)
+
+RECORD_DTYPE = np.dtype([('op', 'u1'), ('nr', 'i4'),
+                         ('x', 'f8'), ('y', 'f8'), ('xs', 'f8'), ('ys', 'f8'),
+                         ('z', 'f8'), ('xo', 'f8'), ('yo', 'f8'),
+                         ('i', 'f8'), ('j', 'f8'), ('r', 'f8'),
+                         ('s_ang', 'f8'), ('e_ang', 'f8'), ('ext', 'f8')])
+
+# The moves in the plane, the ones in the depth and the cutting moves
+XY_OPS = (RAPID_XY, LINEAR_XY, ARC_CW, ARC_CCW)
+Z_OPS = (RAPID_Z, LINEAR_Z)
+CUT_OPS = (LINEAR_XY, ARC_CW, ARC_CCW, LINEAR_Z)
+
+# The number of records which are collected before they are added to the array
+CHUNK_SIZE = 65536
+
+
+class Toolpath(object):
+    """
+    The motion of a job as an array of records (see RECORD_DTYPE), made once
+    by a ToolpathRecorder and written by any postprocessor with replay. The
+    texts (comments, templates, ...) are kept in a list, the records refer to
+    them by their index in nr.
+
+    The decisions of the shapes which depend on the postprocessor config
+    (e.g. arcs as lines, the number of passes for dxf) are already taken in
+    the records, so a toolpath is only valid for postprocessors with the same
+    options (see get_toolpath_options).
+    """
+    def __init__(self, options=None):
+        """
+        @param options: The options of the postprocessor the toolpath is
+        recorded with
+        """
+        self.options = options
+        self.texts = []
+        self.text_nrs = {}
+        self.chunks = []
+        self.rows = []
+        self._records = np.zeros(0, dtype=RECORD_DTYPE)
+
+    def __len__(self):
+        return len(self._records) + sum(len(chunk) for chunk in self.chunks) + len(self.rows)
+
+    @property
+    def records(self):
+        """
+        @return: The structured array of all the records
+        """
+        if self.rows or self.chunks:
+            self.flush()
+            self._records = np.concatenate([self._records] + self.chunks)
+            self.chunks = []
+        return self._records
+
+    def append(self, op, nr=0, x=0.0, y=0.0, xs=0.0, ys=0.0, z=0.0, xo=0.0, yo=0.0,
+               i=0.0, j=0.0, r=0.0, s_ang=0.0, e_ang=0.0, ext=0.0):
+        """
+        Adds a record, the fields not given are 0.
+        """
+        self.rows.append((op, nr, x, y, xs, ys, z, xo, yo, i, j, r, s_ang, e_ang, ext))
+        if len(self.rows) >= CHUNK_SIZE:
+            self.flush()
+
+    def append_text(self, op, text):
+        """
+        Adds a record for a text, each text is stored once.
+        @param op: The operation (e.g. COMMENT)
+        @param text: The text
+        """
+        nr = self.text_nrs.get(text)
+        if nr is None:
+            nr = self.text_nrs[text] = len(self.texts)
+            self.texts.append(text)
+        self.append(op, nr)
+
+    def flush(self):
+        """
+        Converts the collected rows into a chunk of the array.
+        """
+        if self.rows:
+            self.chunks.append(np.array(self.rows, dtype=RECORD_DTYPE))
+            self.rows = []
+
+    def replay(self, PostPro, writer):
+        """
+        Writes the toolpath with the postprocessor. PostPro must be
+        initialized (see initialize_export_vars) and have the same options
+        as the postprocessor which recorded the toolpath.
+        @param PostPro: The postprocessor which makes the code
+        @param writer: The GCodeWriter
+        """
+        options = PostPro.get_toolpath_options()
+        if options != self.options:
+            raise ValueError("The toolpath was recorded with other postprocessor options: %s != %s"
+                             % (self.options, options))
+
+        texts = self.texts
+        records = self.records
+        for beg in range(0, len(records), CHUNK_SIZE):
+            exstr = []
+            for (op, nr, x, y, xs, ys, z, xo, yo, i, j, r, s_ang, e_ang, ext)\
+                    in records[beg:beg + CHUNK_SIZE].tolist():
+                if op == LINEAR_XY:
+                    exstr.append(PostPro.lin_pol_xy(Point(xs, ys), Point(x, y)))
+                elif op == ARC_CW or op == ARC_CCW:
+                    exstr.append(PostPro.lin_pol_arc("cw" if op == ARC_CW else "ccw",
+                                                     Point(xs, ys), Point(x, y), s_ang, e_ang,
+                                                     r, Point(xo, yo), Point(i, j), ext))
+                elif op == FEED:
+                    exstr.append(PostPro.chg_feed_rate(z))
+                elif op == LINEAR_Z:
+                    exstr.append(PostPro.lin_pol_z(z))
+                elif op == RAPID_Z:
+                    exstr.append(PostPro.rap_pos_z(z))
+                elif op == RAPID_XY:
+                    exstr.append(PostPro.rap_pos_xy(Point(x, y)))
+                elif op == COMMENT:
+                    exstr.append(PostPro.commentprint(texts[nr]))
+                elif op == PRE_SHAPE_CUT:
+                    exstr.append(PostPro.write_pre_shape_cut())
+                elif op == POST_SHAPE_CUT:
+                    exstr.append(PostPro.write_post_shape_cut())
+                elif op == CUT_COR:
+                    exstr.append(PostPro.set_cut_cor(nr))
+                elif op == CUT_COR_OFF:
+                    exstr.append(PostPro.deactivate_cut_cor())
+                elif op == TOOL:
+                    exstr.append(PostPro.chg_tool(nr, z))
+                elif op == CODE:
+                    exstr.append(PostPro.make_print_str(texts[nr]))
+                elif op == TEXT:
+                    exstr.append(texts[nr])
+                elif op == BEGIN:
+                    exstr.append(PostPro.write_gcode_be(texts[nr]))
+                elif op == END:
+                    exstr.append(PostPro.write_gcode_en())
+            writer.write(''.join(exstr))
+
+    def calc_lengths(self, start=(0.0, 0.0, 0.0)):
+        """
+        Calculates the lengths of the moves with the whole array.
+        @param start: The position (x, y, z) before the first move
+        @return: The length of the rapid moves, the length of the cutting
+        moves and the length of the cutting moves divided by their feed (the
+        time in minutes with the feed in units/min)
+        """
+        records = self.records
+        op = records['op']
+
+        # Moves in the plane, from the end of the move before
+        xy = records[np.isin(op, XY_OPS)]
+        x = np.concatenate(([start[0]], xy['x']))
+        y = np.concatenate(([start[1]], xy['y']))
+        xy_lengths = np.hypot(np.diff(x), np.diff(y))
+        is_arc = np.isin(xy['op'], (ARC_CW, ARC_CCW))
+        xy_lengths[is_arc] = np.abs(xy['r'][is_arc] * xy['ext'][is_arc])
+
+        z = records[np.isin(op, Z_OPS)]
+        z_lengths = np.abs(np.diff(np.concatenate(([start[2]], z['z']))))
+
+        lengths = np.zeros(len(records))
+        lengths[np.isin(op, XY_OPS)] = xy_lengths
+        lengths[np.isin(op, Z_OPS)] = z_lengths
+
+        # The feed of each record is the one of the last FEED record
+        feed_nrs = np.maximum.accumulate(np.where(op == FEED, np.arange(len(records)), -1))
+        feeds = np.where(feed_nrs >= 0, records['z'][np.maximum(feed_nrs, 0)], 0.0)
+
+        is_cut = np.isin(op, CUT_OPS)
+        cut_lengths = lengths[is_cut]
+        cut_feeds = feeds[is_cut]
+        with np.errstate(divide='ignore'):
+            cut_time = np.sum(np.where(cut_feeds > 0, cut_lengths / cut_feeds, 0.0))
+        return (float(np.sum(lengths[np.isin(op, (RAPID_XY, RAPID_Z))])),
+                float(np.sum(cut_lengths)), float(cut_time))
+
+
+class ToolpathRecorder(MyPostProcessor):
+    """
+    Postprocessor which records the calls of the shapes in a Toolpath
+    instead of making the code. The state variables are set like by the
+    postprocessor, since the shapes read some of them (e.g. BreakGeo).
+    """
+    # The code of the passes isn't reused, each pass is recorded
+    cache_geos = False
+
+    def __init__(self, PostPro, toolpath):
+        """
+        Takes over the export variables of PostPro (the config files are not
+        loaded again).
+        @param PostPro: The initialized postprocessor
+        @param toolpath: The Toolpath to record to
+        """
+        self.__dict__.update(PostPro.__dict__)
+        self.toolpath = toolpath
+        self.in_call = False
+
+    def update_state(self, method, *args):
+        """
+        Calls the method of the postprocessor for its changes of the state,
+        the code isn't made.
+        @return: An empty string
+        """
+        self.in_call = True
+        try:
+            method(self, *args)
+        finally:
+            self.in_call = False
+        return ""
+
+    def make_print_str(self, keystr):
+        # Templates used directly by the shapes (e.g. HoleGeo) are recorded
+        if not self.in_call:
+            self.toolpath.append_text(CODE, keystr)
+        return ""
+
+    def write_gcode_be(self, load_filename):
+        self.toolpath.append_text(BEGIN, load_filename)
+        return self.update_state(MyPostProcessor.write_gcode_be, load_filename)
+
+    def write_gcode_en(self):
+        self.toolpath.append(END)
+        return self.update_state(MyPostProcessor.write_gcode_en)
+
+    def write_shape(self, shape):
+        # The text of a shape (e.g. of a CustomGCode) is written as it is
+        exstr = MyPostProcessor.write_shape(self, shape)
+        if exstr:
+            self.toolpath.append_text(TEXT, exstr)
+        return ""
+
+    def chg_tool(self, tool_nr, speed):
+        self.toolpath.append(TOOL, nr=tool_nr, z=speed)
+        return self.update_state(MyPostProcessor.chg_tool, tool_nr, speed)
+
+    def chg_feed_rate(self, feed):
+        if self.feed != feed:
+            self.toolpath.append(FEED, z=feed)
+        return self.update_state(MyPostProcessor.chg_feed_rate, feed)
+
+    def set_cut_cor(self, cut_cor):
+        self.toolpath.append(CUT_COR, nr=cut_cor)
+        return self.update_state(MyPostProcessor.set_cut_cor, cut_cor)
+
+    def deactivate_cut_cor(self):
+        self.toolpath.append(CUT_COR_OFF)
+        return self.update_state(MyPostProcessor.deactivate_cut_cor)
+
+    def lin_pol_arc(self, dir, Ps, Pe, s_ang, e_ang, R, O, IJ, ext):
+        self.toolpath.append(ARC_CW if dir == 'cw' else ARC_CCW,
+                             x=Pe.x, y=Pe.y, xs=Ps.x, ys=Ps.y, xo=O.x, yo=O.y,
+                             i=IJ.x, j=IJ.y, r=R, s_ang=s_ang, e_ang=e_ang, ext=ext)
+        return self.update_state(MyPostProcessor.lin_pol_arc, dir, Ps, Pe, s_ang, e_ang, R, O, IJ, ext)
+
+    def rap_pos_z(self, z_pos):
+        self.toolpath.append(RAPID_Z, z=z_pos)
+        return self.update_state(MyPostProcessor.rap_pos_z, z_pos)
+
+    def rap_pos_xy(self, Pe):
+        self.toolpath.append(RAPID_XY, x=Pe.x, y=Pe.y)
+        return self.update_state(MyPostProcessor.rap_pos_xy, Pe)
+
+    def lin_pol_z(self, z_pos):
+        self.toolpath.append(LINEAR_Z, z=z_pos)
+        return self.update_state(MyPostProcessor.lin_pol_z, z_pos)
+
+    def lin_pol_xy(self, Ps, Pe):
+        self.toolpath.append(LINEAR_XY, x=Pe.x, y=Pe.y, xs=Ps.x, ys=Ps.y)
+        return self.update_state(MyPostProcessor.lin_pol_xy, Ps, Pe)
+
+    def lin_pol_xy_points(self, Ps, xs, ys):
+        # Each line is recorded
+        for Pe in [Point(x, y) for x, y in zip(np.asarray(xs).tolist(), np.asarray(ys).tolist())]:
+            self.lin_pol_xy(Ps, Pe)
+            Ps = Pe
+        return ""
+
+    def write_pre_shape_cut(self):
+        self.toolpath.append(PRE_SHAPE_CUT)
+        return self.update_state(MyPostProcessor.write_pre_shape_cut)
+
+    def write_post_shape_cut(self):
+        self.toolpath.append(POST_SHAPE_CUT)
+        return self.update_state(MyPostProcessor.write_post_shape_cut)
+
+    def commentprint(self, comment):
+        self.toolpath.append_text(COMMENT, comment)
+        return self.update_state(MyPostProcessor.commentprint, comment)
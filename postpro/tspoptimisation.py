@@ -27,9 +27,14 @@
 from __future__ import absolute_import
 from __future__ import division
 
-from random import random, shuffle
-from math import floor, ceil
+from random import random, seed, shuffle
+from math import floor, ceil, hypot
+from collections import deque
+from multiprocessing import Pipe, Process, RawArray
 
+import numpy as np
+
+from postpro.spatialindex import GridIndex, nearest_neighbour_tour, hilbert_order
 import globals.globals as g
 
 from globals.six import text_type
@@ -43,7 +48,18 @@ class TspOptimization(object):
     """
     Optimization using the Travelling Salesman Problem (TSP) algorithim
     """
-    def __init__(self, st_end_points, order):
+    def __init__(self, st_end_points, order, DistanceMatrix=None, CostModel=None, precedence=None):
+        """
+        @param st_end_points: list of the start and end points of the shapes,
+        the last one is the start point of the machine
+        @param order: The shapes which have a fixed order
+        @param DistanceMatrix: An already generated DistanceMatrixClass, e.g.
+        the shared one of an island
+        @param CostModel: The cost of the moves between the shapes, e.g. a
+        MachineTimeClass. If it is None the distance is used.
+        @param precedence: list of the pairs (before, after) of shapes, e.g.
+        the inner shapes which have to be cut before the outer ones
+        """
         self.shape_nrs = len(st_end_points)
         self.iterations = int(self.shape_nrs) * 10
         self.pop_nr = min(int(ceil(self.shape_nrs / 8.0) * 8.0),
@@ -51,21 +67,53 @@ class TspOptimization(object):
         self.mutate_rate = g.config.vars.Route_Optimisation['mutation_rate']
         self.opt_route = []
         self.order = order
+        self.precedence = precedence or []
         self.st_end_points = st_end_points
+        self.local_search = g.config.vars.Route_Optimisation['local_search']
+        self.local_search_nr = 2
+        self.migrant_nr = 2
+        self.islands = []
+        nei_nr = g.config.vars.Route_Optimisation['candidate_neighbours']
+
+        # Für sehr viele Konturen wird keine Matrix erstellt, es werden nur
+        # die Kandidaten mit 2-opt / Or-opt optimiert
+        # For very many shapes no matrix is generated, only the candidates
+        # are optimized with 2-opt / Or-opt
+        large_instance_nr = g.config.vars.Route_Optimisation['large_instance_shapes']
+        self.large_instance = 0 < large_instance_nr <= self.shape_nrs
+        if self.large_instance:
+            self.local_search = 'alone'
+            self.pop_nr = min(self.pop_nr, self.local_search_nr)
 
         # Generate the Distance Matrix
-        self.DistanceMatrix = DistanceMatrixClass()
-        self.DistanceMatrix.generate_matrix(st_end_points)
+        if DistanceMatrix is not None:
+            self.DistanceMatrix = DistanceMatrix
+        else:
+            if self.large_instance:
+                self.DistanceMatrix = CandidateDistanceClass(nei_nr, CostModel)
+            elif g.config.vars.Route_Optimisation['float32_distance_matrix']:
+                self.DistanceMatrix = DistanceMatrixClass(np.float32, CostModel)
+            else:
+                self.DistanceMatrix = DistanceMatrixClass(CostModel=CostModel)
+            self.DistanceMatrix.generate_matrix(st_end_points)
+
+        # Weitere Populationen (Inseln) in eigenen Prozessen starten
+        # Start further populations (islands) in own processes
+        island_nr = g.config.vars.Route_Optimisation['islands']
+        if island_nr > 1 and not self.large_instance:
+            self.start_islands(island_nr)
 
         # Generation Population
         self.Population = PopulationClass([self.shape_nrs, self.pop_nr],
                                           self.DistanceMatrix.matrix,
-                                          self.mutate_rate)
+                                          self.mutate_rate,
+                                          self.DistanceMatrix.st_pts,
+                                          self.DistanceMatrix.end_pts)
 
         # Initialise the Result Class
         self.Fittness = FittnessClass(self.Population,
                                       list(range(self.Population.size[1])),
-                                      self.order)
+                                      self.order, self.precedence)
         self.Fittness.calc_st_fittness(self.DistanceMatrix.matrix,
                                        range(self.shape_nrs))
 
@@ -81,25 +129,31 @@ class TspOptimization(object):
         # Erstellen der ersten Ergebnisse
         # Create the first result
         self.Fittness.calc_cur_fittness(self.DistanceMatrix.matrix)
-        self.Fittness.select_best_fittness()
-        self.opt_route = self.Population.pop[self.Fittness.best_route]
 
-        # ERstellen der 2 opt Optimierungs Klasse
-        # Create the 2 opt optimization class ???
-        # self.optmove=ClassOptMove(dmatrix=self.DistanceMatrix.matrix, nei_nr=int(round(self.shape_nrs/10)))
+        # Erstellen der 2-opt / Or-opt Optimierungs Klasse
+        # Create the 2-opt / Or-opt optimization class
+        if self.local_search != 'none':
+            if self.large_instance:
+                neighbours = (self.DistanceMatrix.out_neighbours,
+                              self.DistanceMatrix.in_neighbours)
+            else:
+                neighbours = None
+            self.LocalSearch = LocalSearchClass(self.DistanceMatrix.matrix, self.order,
+                                                nei_nr, neighbours=neighbours)
+            self.improved_routes = set()
+            self.calc_local_search()
+
+        self.Fittness.select_best_fittness()
+        self.opt_route = self.Population.pop[self.Fittness.best_route].tolist()
 
     def calc_next_iteration(self):
         """
         calc_next_iteration()
         """
         # Algorithmus ausfürhen
-        self.Population.genetic_algorithm(self.Fittness, self.mutate_rate)
-        # Für die Anzahl der Tours die Tours nach dem 2-opt Verfahren optimieren
-        # Optimise the number of Tours de Tours to the 2-opt method ???
-#        for pop_nr in range(len(self.Population.pop)):
-#            #print ("Vorher: %0.2f" %self.calc_tour_length(tours[tour_nr]))
-#            self.Population.pop[pop_nr]=self.optmove.do2optmove(self.Population.pop[pop_nr])
-#            #print ("Nachher: %0.2f" %self.calc_tour_length(tours[tour_nr]))
+        # Run the genetic algorithm
+        if self.local_search != 'alone':
+            self.Population.genetic_algorithm(self.Fittness, self.mutate_rate)
         # Anfang der Reihenfolge immer auf den letzen Punkt legen
         # Always put the last point at the beginning of the sequence
         self.Fittness.set_startpoint()
@@ -109,13 +163,118 @@ class TspOptimization(object):
         # Fittness der jeweiligen Routen ausrechen
         # Calculate fitness of each route
         self.Fittness.calc_cur_fittness(self.DistanceMatrix.matrix)
+        # Die besten Routen nach dem 2-opt / Or-opt Verfahren optimieren
+        # Improve the best routes with 2-opt and Or-opt moves
+        if self.local_search != 'none':
+            self.calc_local_search()
+        # Die besten Routen mit den anderen Inseln austauschen
+        # Exchange the best routes with the other islands
+        if self.islands:
+            self.exchange_migrants()
         # Straffunktion falls die Route nicht der gewünschten Reihenfolge entspricht
         # Function if the route is not the desired sequence ???
         # Best route to choose
         self.Fittness.select_best_fittness()
-        self.opt_route = self.Population.pop[self.Fittness.best_route]
+        self.opt_route = self.Population.pop[self.Fittness.best_route].tolist()
         # logger.debug('Calculation next iteration of TSP: %s' %self)
 
+    def calc_local_search(self):
+        """
+        Improves the best routes of the population by the local search and
+        updates their fitness.
+        """
+        cur_fittness = self.Fittness.cur_fittness
+        best = sorted(range(len(cur_fittness)), key=lambda pop_nr: cur_fittness[pop_nr])
+        improved = set()
+        for pop_nr in best[:self.local_search_nr]:
+            pop = self.Population.pop[pop_nr]
+            # Routes which were already improved can't be improved anymore
+            if pop.tobytes() not in self.improved_routes:
+                pop[:] = self.LocalSearch.improve(pop.tolist())
+            improved.add(pop.tobytes())
+        self.improved_routes = improved
+        # The local search doesn't know the precedence
+        if self.precedence:
+            self.Fittness.correct_constrain_order()
+        self.Fittness.calc_cur_fittness(self.DistanceMatrix.matrix)
+
+    def start_islands(self, island_nr):
+        """
+        Starts island_nr - 1 further populations in worker processes. They
+        share the distance matrix and begin with different seeds and
+        initialisations. This population is the first island.
+        """
+        begin_arts = ['heuristic', 'random', 'hilbert', 'ordered']
+        begin_nr = begin_arts.index(g.config.vars.Route_Optimisation['begin_art'])
+        self.DistanceMatrix.share()
+        for nr in range(1, island_nr):
+            conn, island_conn = Pipe()
+            process = Process(target=run_island,
+                              args=(island_conn, g.config, self.st_end_points, self.order,
+                                    self.precedence, self.DistanceMatrix,
+                                    begin_arts[(begin_nr + nr) % len(begin_arts)],
+                                    int(random() * 2 ** 31)))
+            process.daemon = True
+            process.start()
+            island_conn.close()
+            self.islands.append((process, conn))
+
+    def exchange_migrants(self):
+        """
+        Takes the best routes of the islands which finished their migration
+        interval into the population and sends them the best routes of this
+        population back.
+        """
+        for island in self.islands[:]:
+            process, conn = island
+            try:
+                if not conn.poll():
+                    continue
+                migrants = conn.recv()
+                conn.send(self.get_migrants())
+            except (EOFError, IOError):
+                logger.warning(self.tr("TSP island process stopped unexpectedly"))
+                self.islands.remove(island)
+                continue
+            self.add_migrants(migrants)
+
+    def get_migrants(self):
+        """
+        @return: The best migrant_nr routes of the population
+        """
+        cur_fittness = self.Fittness.cur_fittness
+        best = sorted(range(len(cur_fittness)), key=lambda pop_nr: cur_fittness[pop_nr])
+        return [self.Population.pop[pop_nr].tolist() for pop_nr in best[:self.migrant_nr]]
+
+    def add_migrants(self, migrants):
+        """
+        Replaces the worst routes of the population by the migrants.
+        """
+        cur_fittness = self.Fittness.cur_fittness
+        worst = sorted(range(len(cur_fittness)), key=lambda pop_nr: -cur_fittness[pop_nr])
+        lengths = self.Fittness.calc_tour_lengths(self.DistanceMatrix.matrix, migrants)
+        for pop_nr, migrant, length in zip(worst, migrants, lengths):
+            self.Population.pop[pop_nr] = migrant
+            cur_fittness[pop_nr] = length
+
+    def close(self):
+        """
+        Stops the worker processes of the islands.
+        """
+        for process, conn in self.islands:
+            process.terminate()
+            process.join()
+            conn.close()
+        self.islands = []
+
+    def tr(self, string_to_translate):
+        """
+        Translate a string using the QCoreApplication translation framework
+        @param: string_to_translate: a unicode string
+        @return: the translated unicode string if it was possible to translate
+        """
+        return text_type(string_to_translate)
+
     def __str__(self):
         #res = self.Population.pop
         return "Iteration nrs:    %i" % (self.iterations * 10) +\
@@ -127,12 +286,49 @@ class TspOptimization(object):
                "\nOpt. length:    %0.1f" % self.Fittness.best_fittness[-1] +\
                "\nOpt. route:     %s" % self.opt_route
 
+def run_island(conn, config, st_end_points, order, precedence, DistanceMatrix, begin_art, seed_nr):
+    """
+    Runs one island of the route optimisation in a worker process. After each
+    migration interval its best routes are sent to the first island, which
+    answers with its own best routes.
+    @param conn: The connection to the first island
+    @param config: The configuration of the main process
+    @param DistanceMatrix: The shared DistanceMatrixClass
+    @param begin_art: The initialisation of the population of this island
+    @param seed_nr: The seed for the random numbers of this island
+    """
+    g.config = config
+    g.config.vars.Route_Optimisation['begin_art'] = begin_art
+    g.config.vars.Route_Optimisation['islands'] = 1
+    migration_interval = g.config.vars.Route_Optimisation['migration_interval']
+    seed(seed_nr)
+
+    TSP = TspOptimization(st_end_points, order, DistanceMatrix, precedence=precedence)
+    try:
+        while True:
+            for it_nr in range(migration_interval):
+                TSP.calc_next_iteration()
+            conn.send(TSP.get_migrants())
+            TSP.add_migrants(conn.recv())
+    except (EOFError, IOError):
+        pass
+
 class PopulationClass:
-    def __init__(self, size, dmatrix, mutate_rate):
+    def __init__(self, size, dmatrix, mutate_rate, st_pts=None, end_pts=None):
+        """
+        @param size: [number of shapes, number of tours]
+        @param dmatrix: The distance matrix
+        @param mutate_rate: The rate of mutated tours per generation
+        @param st_pts: array of the start points. If given the heuristic
+        begin searches the nearest shapes on these instead of the matrix.
+        @param end_pts: array of the end points
+        """
         self.size = size
         self.mutate_rate = mutate_rate
         self.pop = []
         self.rot = []
+        self.st_pts = st_pts
+        self.end_pts = end_pts
 
         # logger.debug('The Population size is: %s' %self.size)
 
@@ -144,10 +340,18 @@ class PopulationClass:
             elif g.config.vars.Route_Optimisation['begin_art'] == 'random':
                 self.pop.append(self.random_begin(size[0]))
             elif g.config.vars.Route_Optimisation['begin_art'] == 'heuristic':
-                self.pop.append(self.heuristic_begin(dmatrix[:]))
+                self.pop.append(self.heuristic_begin(dmatrix))
+            elif g.config.vars.Route_Optimisation['begin_art'] == 'hilbert':
+                if not pop_nr:
+                    hilbert_tour = self.hilbert_begin()
+                self.pop.append(hilbert_tour[:])
             else:
                 logger.error(self.tr('Wrong begin art of TSP chosen'))
 
+        # Die Routen werden als Zeilen eines Arrays gespeichert
+        # The tours are stored as the rows of an array
+        self.pop = np.array(self.pop, dtype=np.intp).reshape(self.size[1], self.size[0])
+
         for rot_nr in range(size[0]):
             self.rot.append(0)
 
@@ -180,38 +384,41 @@ class PopulationClass:
         heuristic_begin for TSP
         """
         tour = []
-        possibilities = list(range(len(dmatrix[0])))
-        start_nr = int(floor(random()*len(dmatrix[0])))
+        start_nr = int(floor(random()*self.size[0]))
 
-        # Hinzufügen der Nr und entfernen aus possibilies
-        # Add and remove the number of possibilities
-        tour.append(start_nr)
-        possibilities.pop(possibilities.index(tour[-1]))
-        counter = 0
+        # Auf den Koordinaten suchen / Search on the coordinates
+        if self.st_pts is not None:
+            return nearest_neighbour_tour(self.st_pts, self.end_pts, start_nr)
+        dmatrix = np.asarray(dmatrix)
 
-        while len(possibilities):
-            counter += 1
-            tour.append(self.heuristic_find_next(tour[-1], possibilities, dmatrix))
-            possibilities.pop(possibilities.index(tour[-1]))
+        # Hinzufügen der Nr und markieren als besucht
+        # Add the number and mark it as visited
+        tour.append(start_nr)
+        visited = np.zeros(len(dmatrix[0]), dtype=bool)
+        visited[start_nr] = True
 
-            # if counter % 10 == 0:
-            #     logger.debug("TSP heuristic searching nr %i" % counter)
+        while len(tour) < len(visited):
+            tour.append(self.heuristic_find_next(tour[-1], visited, dmatrix))
+            visited[tour[-1]] = True
         return tour
 
-    def heuristic_find_next(self, start, possibilities, dmatrix):
+    def heuristic_find_next(self, start, visited, dmatrix):
         """
         heuristic_find_next() for TSP
         """
         # Auswahl der Entfernungen des nächsten Punkts
         # The distances of the point selection
-        min_dist = 1e99
-        darray = dmatrix[start]
+        darray = np.where(visited, np.inf, dmatrix[start])
+        return int(np.argmin(darray))
 
-        for pnr in possibilities:
-            if darray[pnr] < min_dist:
-                min_point = pnr
-                min_dist = darray[pnr]
-        return min_point
+    def hilbert_begin(self):
+        """
+        hilbert_begin for TSP - The shapes are ordered along a Hilbert curve
+        through the middle of their start and end points.
+        """
+        if self.st_pts is None:
+            return list(range(self.size[0]))
+        return hilbert_order((self.st_pts + self.end_pts) / 2)
 
     def genetic_algorithm(self, Result, mutate_rate):
         """
@@ -219,11 +426,9 @@ class PopulationClass:
         """
         self.mutate_rate = mutate_rate
 
-        # Neue Population Matrix erstellen
-        # Create new Population Matrix
-        new_pop = []
-        for p_nr in range(self.size[1]):
-            new_pop.append([])
+        # Neue Population Matrix erstellen, nicht belegte Zeilen bleiben
+        # Create new Population Matrix, rows which aren't filled are kept
+        new_pop = self.pop.copy()
 
         # Tournament Selection 1 between Parents (2 Parents remaining)
         ts_r1 = list(range(self.size[1]))
@@ -251,16 +456,17 @@ class PopulationClass:
             # Schreiben der Gewinner in die neue Population Matrix
             # print(winner)
             for pnr in range(2):
-                new_pop[pnr * self.size[1] // 2 + nr] = winner[:]
+                new_pop[pnr * self.size[1] // 2 + nr] = winner
 
         # Crossover Gens from 2 Parents
         crossover = list(range(self.size[1] // 2))
         shuffle(crossover)
+        is_gen = np.zeros(self.size[0], dtype=bool)
         for nr in range(self.size[1] // 4):
             # child = parent2
             # Parents are the winners of the first round (Genetic Selection?)
-            parent1 = winners_r1[crossover[nr * 2]][:]
-            child = winners_r1[crossover[(nr * 2) + 1]][:]
+            parent1 = winners_r1[crossover[nr * 2]]
+            child = winners_r1[crossover[(nr * 2) + 1]]
 
             # The genetic line that is exchanged in the child parent1
             indx = [int(floor(random()*self.size[0])), int(floor(random()*self.size[0]))]
@@ -271,16 +477,17 @@ class PopulationClass:
             gens = parent1[indx[0]:indx[1] + 1]
 
             # Remove the exchanged genes
-            for gen in gens:
-                child.pop(child.index(gen))
+            is_gen[gens] = True
+            child = child[~is_gen[child]]
+            is_gen[gens] = False
 
             # Insert the new genes at a random position
             ins_indx = int(floor(random()*self.size[0]))
-            new_children = child[0:ins_indx] + gens + child[ins_indx:len(child)]
+            new_children = np.concatenate((child[0:ins_indx], gens, child[ins_indx:]))
 
             # Write the new children in the new population matrix
             for pnr in range(2):
-                new_pop[int((pnr + 0.5) * self.size[1] / 2 + nr)] = new_children[:]
+                new_pop[int((pnr + 0.5) * self.size[1] / 2 + nr)] = new_children
 
         # Mutate the 2nd half of the population matrix
         mutate = list(range(self.size[1] // 2))
@@ -298,24 +505,270 @@ class PopulationClass:
             # Line to be mutated ????
             mutline = new_pop[self.size[1] // 2 + mutate[nr]]
             if random() < 0.75:  # Gen Abschnitt umdrehen / Turn gene segment
-                cut = mutline[indx[0]:indx[1] + 1]
-                cut.reverse()
-                mutline = mutline[0:indx[0]] + cut + mutline[indx[1] + 1:len(mutline)]
+                mutline[indx[0]:indx[1] + 1] = mutline[indx[0]:indx[1] + 1][::-1]
             else:  # 2 Gene tauschen / 2 Gene exchange
-                orgline = mutline[:]
-                mutline[indx[0]] = orgline[indx[1]]
-                mutline[indx[1]] = orgline[indx[0]]
-            new_pop[self.size[1] // 2 + mutate[nr]] = mutline
+                mutline[indx] = mutline[indx[::-1]]
 
         # Assign the new population matrix
         self.pop = new_pop
 
-class DistanceMatrixClass:
+class LocalSearchClass:
     """
-    DistanceMatrixClass
+    Local search for the tours with 2-opt and Or-opt moves. Only the nearest
+    neighbours of each shape are tried as new connections and shapes whose
+    surrounding didn't change are not searched again (don't look bits).
+    The first element of the tour (start point) is kept. The fixed shapes
+    (order) keep their order, with CONSTRAIN_PLACE_AFTER they also stay in
+    front of all the other shapes.
+    """
+    def __init__(self, dmatrix, order, nei_nr=8, max_seg_len=3, neighbours=None):
+        """
+        @param dmatrix: The distance matrix (end point of i to start point of j)
+        @param order: The shapes which have a fixed order
+        @param nei_nr: Number of nearest neighbours to be checked per shape
+        @param max_seg_len: Longest segment to be moved by Or-opt
+        @param neighbours: The nearest successors and predecessors of each
+        shape. If they are given the dmatrix is only indexed, e.g. for a
+        CandidateDistanceClass.
+        """
+        self.dmatrix = dmatrix if neighbours else np.asarray(dmatrix, dtype=np.float64)
+        self.order = order
+        self.place_after = (g.config.vars.Route_Optimisation['TSP_shape_order'] ==
+                            'CONSTRAIN_PLACE_AFTER')
+        self.max_seg_len = max_seg_len
+        self.eps = 1e-9
+
+        size = len(self.dmatrix)
+        self.fixed = np.zeros(size, dtype=np.intp)
+        self.fixed[list(order)] = 1
+
+        if neighbours:
+            self.out_neighbours, self.in_neighbours = neighbours
+            return
+
+        # Nearest successors and predecessors of each shape
+        nei_nr = max(1, min(nei_nr, size - 1))
+        dmatrix = self.dmatrix.copy()
+        np.fill_diagonal(dmatrix, np.inf)
+        self.out_neighbours = self.calc_neighbours(dmatrix, nei_nr)
+        self.in_neighbours = self.calc_neighbours(dmatrix.T, nei_nr)
+
+    def calc_neighbours(self, dmatrix, nei_nr):
+        """
+        Returns the nei_nr nearest neighbours of each row sorted by distance
+        """
+        if nei_nr >= len(dmatrix):
+            neighbours = np.argsort(dmatrix, axis=1)
+        else:
+            neighbours = np.argpartition(dmatrix, nei_nr - 1, axis=1)[:, :nei_nr]
+            dist = np.take_along_axis(dmatrix, neighbours, axis=1)
+            neighbours = np.take_along_axis(neighbours, np.argsort(dist, axis=1), axis=1)
+        return neighbours[:, :nei_nr].tolist()
+
+    def improve(self, tour):
+        """
+        Improves the tour until neither a 2-opt nor an Or-opt move is found.
+        @param tour: The tour with the start point at the beginning
+        @return: The improved tour as list
+        """
+        size = len(tour)
+        if size < 4:
+            return list(tour)
+
+        # The shapes in front of lo are not moved
+        self.lo = 1 + (len(self.order) if self.place_after else 0)
+        self.tour = list(tour) + list(tour[:1])
+        self.pos = [0] * len(self.dmatrix)
+        self.forward = np.zeros(size + 1)
+        self.backward = np.zeros(size + 1)
+        self.fixed_nr = np.zeros(size + 1, dtype=np.intp)
+        self.fixed_nr[1] = self.fixed[self.tour[0]]
+        self.update_tour(1, size - 1)
+
+        active = deque(self.tour[self.lo:size])
+        in_active = np.zeros(len(self.dmatrix), dtype=bool)
+        in_active[active] = True
+        while active:
+            node = active.popleft()
+            in_active[node] = False
+            changed = self.improve_2opt(node) or self.improve_oropt(node)
+            if changed:
+                for node in changed:
+                    if not in_active[node] and self.pos[node] >= self.lo - 1:
+                        in_active[node] = True
+                        active.append(node)
+        return self.tour[:size]
+
+    def update_tour(self, beg, end):
+        """
+        Updates the position of each shape, the cumulated lengths of the tour
+        forwards and backwards and the cumulated number of fixed shapes after
+        the shapes from position beg to end (the start point excluded) were
+        changed in the closed tour. Only the changed part is calculated again,
+        the lengths behind it are just shifted.
+        """
+        pos = self.pos
+        for nr in range(beg, end + 1):
+            pos[self.tour[nr]] = nr
+
+        tour = np.array(self.tour[beg - 1:end + 2], dtype=np.intp)
+        for cum, dis in ((self.forward, self.dmatrix[tour[:-1], tour[1:]]),
+                         (self.backward, self.dmatrix[tour[1:], tour[:-1]])):
+            shift = cum[end + 1]
+            cum[beg:end + 2] = cum[beg - 1] + np.cumsum(dis)
+            cum[end + 2:] += cum[end + 1] - shift
+        self.fixed_nr[beg + 1:end + 2] = self.fixed_nr[beg] + np.cumsum(self.fixed[tour[1:-1]])
+
+    def improve_2opt(self, node):
+        """
+        Tries to connect node with one of its nearest neighbours by reversing
+        the part of the tour in between.
+        @return: The shapes at the changed connections or None
+        """
+        d = self.dmatrix
+        t = self.tour
+        i = self.pos[node] + 1
+        if i < self.lo:
+            return None
+        succ = t[i]
+        for nei in self.out_neighbours[node]:
+            gain = d[node, succ] - d[node, nei]
+            if gain <= self.eps:
+                break
+            j = self.pos[nei]
+            if j <= i or j >= len(t) - 1:
+                continue
+            # Max one fixed shape may be reversed
+            if self.fixed_nr[j + 1] - self.fixed_nr[i] > 1:
+                continue
+            delta = (d[node, nei] + d[succ, t[j + 1]] - d[node, succ] - d[nei, t[j + 1]] +
+                     self.backward[j] - self.backward[i] -
+                     self.forward[j] + self.forward[i])
+            if delta < -self.eps:
+                changed = [node, succ, nei, t[j + 1]]
+                t[i:j + 1] = t[j:i - 1:-1]
+                self.update_tour(i, j)
+                return changed
+        return None
+
+    def improve_oropt(self, node):
+        """
+        Tries to move a segment of up to max_seg_len shapes starting with node
+        behind one of its nearest predecessors.
+        @return: The shapes at the changed connections or None
+        """
+        d = self.dmatrix
+        t = self.tour
+        i = self.pos[node]
+        if i < self.lo:
+            return None
+        for seg_len in range(1, self.max_seg_len + 1):
+            k = i + seg_len - 1
+            if k >= len(t) - 1:
+                break
+            last = t[k]
+            removed = d[t[i - 1], node] + d[last, t[k + 1]] - d[t[i - 1], t[k + 1]]
+            seg_fixed = self.fixed_nr[k + 1] - self.fixed_nr[i]
+            for nei in self.in_neighbours[node]:
+                gain = removed - d[nei, node]
+                if gain <= self.eps:
+                    break
+                p = self.pos[nei]
+                if i - 1 <= p <= k or p < self.lo - 1:
+                    continue
+                # Fixed shapes may not pass each other
+                if seg_fixed:
+                    if p > k:
+                        passed = self.fixed_nr[p + 1] - self.fixed_nr[k + 1]
+                    else:
+                        passed = self.fixed_nr[i] - self.fixed_nr[p + 1]
+                    if passed:
+                        continue
+                delta = d[last, t[p + 1]] - d[nei, t[p + 1]] - gain
+                if delta < -self.eps:
+                    changed = [node, last, nei, t[p + 1], t[i - 1], t[k + 1]]
+                    seg = t[i:k + 1]
+                    if p > k:
+                        t[i:p + 1] = t[k + 1:p + 1] + seg
+                        self.update_tour(i, p)
+                    else:
+                        t[p + 1:k + 1] = seg + t[p + 1:i]
+                        self.update_tour(p + 1, k)
+                    return changed
+        return None
+
+class MachineTimeClass:
+    """
+    MachineTimeClass - Cost model which estimates the time in seconds of the
+    moves from the end of one shape to the start of the next one: the retract
+    to axis3_retract, the rapid move in the plane (the slowest axis with its
+    feed rate and acceleration is decisive) and the rapid move down to the
+    safe margin with the plunge to the first depth.
     """
     def __init__(self):
-        self.matrix = []
+        self.rapid_feed_x = g.config.vars.Route_Optimisation['rapid_feed_x'] / 60
+        self.rapid_feed_y = g.config.vars.Route_Optimisation['rapid_feed_y'] / 60
+        self.rapid_feed_z = g.config.vars.Route_Optimisation['rapid_feed_z'] / 60
+        self.acceleration = g.config.vars.Route_Optimisation['rapid_acceleration']
+        self.exit_times = np.zeros(0)
+        self.entry_times = np.zeros(0)
+
+    def calc_axis_time(self, dist, feed):
+        """
+        Time of a rapid move of dist along one axis, which accelerates up to
+        its feed rate if the move is long enough.
+        """
+        dist = np.abs(dist)
+        if not self.acceleration:
+            return dist / feed
+        return np.where(dist > feed ** 2 / self.acceleration,
+                        dist / feed + feed / self.acceleration,
+                        2 * np.sqrt(dist / self.acceleration))
+
+    def set_shapes(self, shapes):
+        """
+        Calculates the time of the Z moves at the end and at the beginning of
+        each shape.
+        @param shapes: The shapes in the order of the points of the TSP, None
+        for the start point of the machine (without Z moves)
+        """
+        self.exit_times = np.zeros(len(shapes))
+        self.entry_times = np.zeros(len(shapes))
+        for nr, shape in enumerate(shapes):
+            if shape is None:
+                continue
+            retract = shape.parentLayer.axis3_retract
+            top = shape.axis3_start_mill_depth
+            safe = top + abs(shape.parentLayer.axis3_safe_margin)
+            first_depth = max(top - abs(shape.axis3_slice_depth), shape.axis3_mill_depth)
+            self.exit_times[nr] = self.calc_axis_time(retract - shape.axis3_mill_depth,
+                                                      self.rapid_feed_z)
+            self.entry_times[nr] = (self.calc_axis_time(retract - safe, self.rapid_feed_z) +
+                                    (safe - first_depth) / (shape.f_g1_depth / 60))
+
+    def calc_costs(self, dx, dy, i, j):
+        """
+        @param dx, dy: The distances in x and y from the end of shape i to the
+        start of shape j
+        @param i, j: The nrs of the shapes (may be arrays)
+        @return: The estimated time of the moves in between
+        """
+        return (np.maximum(self.calc_axis_time(dx, self.rapid_feed_x),
+                           self.calc_axis_time(dy, self.rapid_feed_y)) +
+                self.exit_times[i] + self.entry_times[j])
+
+class DistanceMatrixClass:
+    """
+    DistanceMatrixClass - matrix[i][j] is the distance (or the cost of the
+    CostModel) from the end point of shape i to the start point of shape j.
+    """
+    def __init__(self, dtype=np.float64, CostModel=None):
+        self.dtype = dtype
+        self.CostModel = CostModel
+        self.matrix = np.zeros((0, 0), dtype=dtype)
+        self.buffer = None
+        self.st_pts = np.zeros((0, 2))
+        self.end_pts = np.zeros((0, 2))
         self.size = [0, 0]
 
     def __str__(self):
@@ -326,42 +779,171 @@ class DistanceMatrixClass:
                 string += "%8.2f" % x_vals
         return string
 
+    def __getstate__(self):
+        # A shared matrix is passed to the processes by its buffer
+        state = self.__dict__.copy()
+        if self.buffer is not None:
+            del state['matrix']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.buffer is not None:
+            self.matrix = np.frombuffer(self.buffer, dtype=self.dtype).reshape(self.size)
+
+    def share(self):
+        """
+        Moves the matrix into shared memory, so that the worker processes of
+        the islands can use it without a copy.
+        """
+        if self.buffer is not None:
+            return
+        self.buffer = RawArray('f' if self.dtype == np.float32 else 'd', self.matrix.size)
+        matrix = np.frombuffer(self.buffer, dtype=self.dtype).reshape(self.size)
+        matrix[:] = self.matrix
+        self.matrix = matrix
+
     def generate_matrix(self, st_end_points):
-        self.matrix = [[st_end_y[1].distance(st_end_x[0]) for st_end_x in st_end_points]
-                       for st_end_y in st_end_points]
+        self.st_pts = np.array([(st_end[0].x, st_end[0].y) for st_end in st_end_points],
+                               dtype=float).reshape(-1, 2)
+        self.end_pts = np.array([(st_end[1].x, st_end[1].y) for st_end in st_end_points],
+                                dtype=float).reshape(-1, 2)
+        dx = self.end_pts[:, np.newaxis, 0] - self.st_pts[np.newaxis, :, 0]
+        dy = self.end_pts[:, np.newaxis, 1] - self.st_pts[np.newaxis, :, 1]
+        if self.CostModel is None:
+            self.matrix = np.hypot(dx, dy).astype(self.dtype, copy=False)
+        else:
+            nrs = np.arange(len(st_end_points))
+            self.matrix = self.CostModel.calc_costs(dx, dy, nrs[:, np.newaxis], nrs[np.newaxis, :]
+                                                    ).astype(self.dtype, copy=False)
         self.size = [len(st_end_points), len(st_end_points)]
 
+class CandidateDistanceClass:
+    """
+    CandidateDistanceClass - Replaces the distance matrix for very many
+    shapes. The distances are calculated from the coordinates when they are
+    needed, only the nearest candidates of each shape are stored. It can be
+    indexed like the matrix: [i, j] is the distance from the end point of
+    shape i to the start point of shape j (i and j may be arrays).
+    """
+    def __init__(self, nei_nr=8, CostModel=None):
+        """
+        @param nei_nr: Number of nearest candidates to be stored per shape
+        @param CostModel: The cost of the moves, if it is None the distance
+        """
+        self.nei_nr = nei_nr
+        self.CostModel = CostModel
+        self.matrix = self
+        self.st_pts = np.zeros((0, 2))
+        self.end_pts = np.zeros((0, 2))
+        self.out_neighbours = []
+        self.in_neighbours = []
+        self.size = [0, 0]
+
+    def __str__(self):
+        return ("Candidate distances; size: %i X %i, %i candidates per shape"
+                % (self.size[0], self.size[1], self.nei_nr))
+
+    def __len__(self):
+        return self.size[0]
+
+    def __getitem__(self, index):
+        i, j = index
+        if self.CostModel is not None:
+            return self.CostModel.calc_costs(self.end_pts[i, 0] - self.st_pts[j, 0],
+                                             self.end_pts[i, 1] - self.st_pts[j, 1], i, j)
+        if isinstance(i, int) and isinstance(j, int):
+            return hypot(self.end_x[i] - self.st_x[j], self.end_y[i] - self.st_y[j])
+        return np.hypot(self.end_pts[i, 0] - self.st_pts[j, 0],
+                        self.end_pts[i, 1] - self.st_pts[j, 1])
+
+    def generate_matrix(self, st_end_points):
+        self.st_pts = np.array([(st_end[0].x, st_end[0].y) for st_end in st_end_points],
+                               dtype=float).reshape(-1, 2)
+        self.end_pts = np.array([(st_end[1].x, st_end[1].y) for st_end in st_end_points],
+                                dtype=float).reshape(-1, 2)
+        self.st_x, self.st_y = self.st_pts.T.tolist()
+        self.end_x, self.end_y = self.end_pts.T.tolist()
+        self.size = [len(st_end_points), len(st_end_points)]
+
+        # Die nächsten Nachfolger und Vorgänger jeder Kontur
+        # Nearest successors and predecessors of each shape
+        nei_nr = max(1, min(self.nei_nr, self.size[0] - 1))
+        self.out_neighbours = self.calc_neighbours(self.st_pts, self.end_x, self.end_y, nei_nr)
+        self.in_neighbours = self.calc_neighbours(self.end_pts, self.st_x, self.st_y, nei_nr)
+
+    def calc_neighbours(self, pts, x, y, nei_nr):
+        """
+        Returns the nei_nr nearest of the pts (without the shape itself) to
+        each point (x, y) sorted by distance
+        """
+        index = GridIndex(pts)
+        neighbours = []
+        for nr in range(len(x)):
+            nearest = index.k_nearest(x[nr], y[nr], nei_nr + 1)
+            neighbours.append([nei for nei in nearest if nei != nr][:nei_nr])
+        return neighbours
+
 class FittnessClass:
-    def __init__(self, population, cur_fittness, order):
+    def __init__(self, population, cur_fittness, order, precedence=None):
         self.population = population
         self.cur_fittness = cur_fittness
         self.order = order
         self.best_fittness = []
         self.best_route = []
 
+        # Shapes which have to come after others, the inner ones first. The
+        # fixed order is corrected after the precedence and only keeps it
+        # for the other shapes.
+        fixed = set(order)
+        precedence = precedence or []
+        free_precedence = [(before_nr, after_nr) for before_nr, after_nr in precedence
+                           if before_nr not in fixed and after_nr not in fixed]
+        if len(free_precedence) < len(precedence):
+            logger.warning("The precedence of %i shapes with a fixed order is ignored"
+                           % (len(precedence) - len(free_precedence)))
+        children = {}
+        after = {}
+        for before_nr, after_nr in free_precedence:
+            children.setdefault(after_nr, []).append(before_nr)
+            after[before_nr] = after_nr
+
+        # Depth of each shape in the chains (e.g. the containment level
+        # counted from the inside), the inner ones are corrected first
+        depths = {}
+        for nr in children:
+            chain = []
+            while nr not in depths and nr in after:
+                chain.append(nr)
+                nr = after[nr]
+            depth = depths.setdefault(nr, 0)
+            for nr in reversed(chain):
+                depth += 1
+                depths[nr] = depth
+        self.precedence = sorted(children.items(), key=lambda item: -depths[item[0]])
+
     def __str__(self):
         return "\nBest Fittness: %s \nBest Route: %s \nBest Pop: %s"\
                % (self.best_fittness[-1], self.best_route, self.population.pop[self.best_route])
 
     def calc_st_fittness(self, matrix, st_pop):
-        dis = matrix[st_pop[-1]][st_pop[0]]
-        for nr in range(1, len(st_pop)):
-            dis += matrix[st_pop[nr - 1]][st_pop[nr]]
-
-        self.best_fittness.append(dis)
+        self.best_fittness.append(self.calc_tour_lengths(matrix, [st_pop])[0])
 
     def calc_cur_fittness(self, matrix):
-        # logger.debug("Calculating current fittness len(self.population.pop): %s"
-        #              % len(self.population.pop))
-        # logger.debug("Length of self.cur_fittness: %s" %(len(self.cur_fittness)))
-
-        for pop_nr in range(len(self.population.pop)):
-            pop = self.population.pop[pop_nr]
-            # logger.debug("pop_nr: %s" %pop_nr)
-            dis = matrix[pop[-1]][pop[0]]
-            for nr in range(1, len(pop)):
-                dis += matrix[pop[nr - 1]][pop[nr]]
-            self.cur_fittness[pop_nr] = dis
+        self.cur_fittness[:] = self.calc_tour_lengths(matrix, self.population.pop)
+
+    def calc_tour_lengths(self, matrix, pop):
+        """
+        Calculates the lengths of all the (closed) tours at once
+        @param matrix: The distance matrix
+        @param pop: list of the tours
+        @return: list with the lengths of the tours
+        """
+        tours = np.asarray(pop, dtype=np.intp)
+        if tours.shape[1] == 0:
+            return [0.0] * len(tours)
+        dis = matrix[tours, np.roll(tours, -1, axis=1)]
+        return dis.sum(axis=1, dtype=np.float64).tolist()
 
     # 2te Möglichkeit die Reihenfolge festzulegen (Korrekturfunktion=Aktiv)
     # Second option set the order (correction function = Active)
@@ -369,26 +951,59 @@ class FittnessClass:
         """FIXME: in order to change the correction to have all ordered shapes
         in begin this might be the best place to change it. Maybe we can also have
         an additional option in the config file?"""
-
-        for pop in self.population.pop:
-            # Search the current order
-            order_index = self.get_pop_index_list(pop)
-            # Momentane Reihenfolge der indexe sortieren
-            # Current sort order of the index ???
-            order_index.sort()
-            # Indices according to correct order
-            for ind_nr in range(len(order_index)):
-                pop[order_index[ind_nr]] = self.order[ind_nr]
+        if self.precedence:
+            self.correct_precedence()
+        if not self.order:
+            return
+
+        pop = self.population.pop
+        rows = np.arange(len(pop))[:, np.newaxis]
+        # Momentane Positionen der festen Shapes sortieren und sie in der
+        # gewünschten Reihenfolge dort einsetzen
+        # Sort the current positions of the fixed shapes and place them there
+        # in the desired order
+        order_index = np.sort(self.get_pop_index_list(pop)[:, self.order], axis=1)
+        pop[rows, order_index] = self.order
+
+        # Die festen Shapes werden vor alle anderen gelegt
+        # The fixed shapes are placed in front of all the other ones
+        if g.config.vars.Route_Optimisation['TSP_shape_order'] == 'CONSTRAIN_PLACE_AFTER':
+            fixed = np.zeros(pop.shape[1], dtype=bool)
+            fixed[self.order] = True
+            others = pop[:, 1:][~fixed[pop[:, 1:]]].reshape(len(pop), -1)
+            pop[:, 1:len(self.order) + 1] = self.order
+            pop[:, len(self.order) + 1:] = others
+
+    def correct_precedence(self):
+        """
+        Moves each shape which has to come after others directly behind the
+        last of them, if it isn't there yet. The other shapes keep their
+        order.
+        """
+        pop = self.population.pop
+        # Sort key of each shape, a moved shape gets the key of the last
+        # shape before it plus a fraction
+        keys = self.get_pop_index_list(pop).astype(float)
+        step = 1.0 / (pop.shape[1] + 1)
+        for after_nr, before_nrs in self.precedence:
+            last = keys[:, before_nrs].max(axis=1)
+            keys[:, after_nr] = np.where(keys[:, after_nr] > last, keys[:, after_nr], last + step)
+        pop[:] = np.argsort(keys, axis=1, kind='stable')
 
     def set_startpoint(self):
-        n_pts = len(self.population.pop[-1])
-        for pop in self.population.pop:
-            st_pt_nr = pop.index(n_pts - 1)
-            # Contour with the starting point at the beginning
-            pop[:] = pop[st_pt_nr:n_pts] + pop[0:st_pt_nr]
+        pop = self.population.pop
+        n_pts = pop.shape[1]
+        st_pt_nr = self.get_pop_index_list(pop)[:, n_pts - 1]
+        # Contour with the starting point at the beginning
+        pop[:] = np.take_along_axis(pop, (st_pt_nr[:, np.newaxis] + np.arange(n_pts)) % n_pts, axis=1)
 
     def get_pop_index_list(self, pop):
-        return [pop.index(order) for order in self.order]
+        """
+        @return: Lookup table with the position of each shape in each tour
+        """
+        index = np.empty_like(pop)
+        index[np.arange(len(pop))[:, np.newaxis], pop] = np.arange(pop.shape[1])
+        return index
 
     def select_best_fittness(self):
         self.best_fittness.append(min(self.cur_fittness))
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+############################################################################
+#
+#   Copyright (C) 2008-2015
+#    Christian Kohlöffel
+#    Vinzenz Schulz
+#    Jean-Paul Schouwstra
+#
+#   This file is part of DXF2GCODE.
+#
+#   DXF2GCODE is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DXF2GCODE is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with DXF2GCODE.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+from __future__ import absolute_import
+from __future__ import division
+
+from math import sin
+import unittest
+
+from core.point import Point
+from dxfimport.biarc import BiarcClass
+
+
+class BiarcTest(unittest.TestCase):
+
+    def test_parallel_tangents(self):
+        # The tangents of a symmetric inflection are parallel (alpha = -beta)
+        Biarc = BiarcClass(Point(0.0, 0.0), 0.3, Point(4.0, 0.0), 0.3)
+        self.assertEqual(Biarc.shape, "S-shaped")
+        Arc0, Arc1 = Biarc.geos
+        self.assertAlmostEqual(Arc0.Pe.x, 2.0)
+        self.assertAlmostEqual(Arc0.Pe.y, 0.0)
+        self.assertAlmostEqual(Arc0.r, 1.0 / sin(0.3))
+        self.assertAlmostEqual(Arc1.r, 1.0 / sin(0.3))
+        self.assertTrue(Arc0.ext * Arc1.ext < 0.0)
+
+    def test_fitting_errors(self):
+        Biarc = BiarcClass(Point(0.0, 0.0), 0.3, Point(4.0, 0.0), 0.3)
+        Arc0, Arc1 = Biarc.geos
+        on_arc = Arc0.O.get_arc_point(Arc0.s_ang + Arc0.ext / 2, Arc0.r)
+        # Beyond the end of the biarc the distance to the end point counts
+        errors = Biarc.get_biarc_fitting_errors([(on_arc.x, on_arc.y), (5.0, 0.0)])
+        self.assertAlmostEqual(errors[0], 0.0)
+        self.assertAlmostEqual(errors[1], 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
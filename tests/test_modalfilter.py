@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+############################################################################
+#
+#   Copyright (C) 2008-2015
+#    Christian Kohlöffel
+#    Vinzenz Schulz
+#    Jean-Paul Schouwstra
+#
+#   This file is part of DXF2GCODE.
+#
+#   DXF2GCODE is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DXF2GCODE is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with DXF2GCODE.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+from __future__ import absolute_import
+from __future__ import division
+
+import unittest
+
+from postpro.modalfilter import ModalFilter
+
+MODAL_FILTER = {'modal_groups': ['G0 G1 G2 G3', 'G17 G18 G19', 'G90 G91'],
+                'axis_words': ['X', 'Y', 'Z'],
+                'modal_words': ['F', 'S']}
+
+
+class ListWriter(object):
+    """
+    Collects the code written by the filter.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, chunk):
+        self.chunks.append(chunk)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def filter_lines(lines, abs_export=True):
+    writer = ListWriter()
+    modal_filter = ModalFilter(writer, MODAL_FILTER, abs_export)
+    modal_filter.write(''.join(line + '\n' for line in lines))
+    modal_filter.close()
+    return ''.join(writer.chunks).splitlines()
+
+
+class ModalFilterTest(unittest.TestCase):
+
+    def test_repeated_words(self):
+        self.assertEqual(filter_lines(['G1 X1 Y1 F100', 'G1 X2 Y1 F100', 'G1 X2 Y1']),
+                         ['G1 X1 Y1 F100', 'X2'])
+
+    def test_canned_cycle(self):
+        # G81 and G80 change the motion mode, so the G1 after them is kept
+        self.assertEqual(filter_lines(['G1 X1 Y1', 'G81 X2 Y2 Z-1 R1', 'G80', 'G1 X3 Y3']),
+                         ['G1 X1 Y1', 'G81 X2 Y2 Z-1 R1', 'G80', 'G1 X3 Y3'])
+
+    def test_incremental_custom_code(self):
+        # In G91 each axis word is a move
+        self.assertEqual(filter_lines(['G1 X1 Y1', 'G91', 'G1 X1', 'G1 X1', 'G90', 'G1 X3 Y3', 'G1 X3 Y3']),
+                         ['G1 X1 Y1', 'G91', 'X1', 'X1', 'G90', 'X3 Y3'])
+
+    def test_incremental_export(self):
+        self.assertEqual(filter_lines(['G1 X1', 'G1 X1'], abs_export=False),
+                         ['G1 X1', 'X1'])
+
+    def test_arc_axes(self):
+        self.assertEqual(filter_lines(['G1 X1 Y1', 'G2 X1 Y1 I1 J0']),
+                         ['G1 X1 Y1', 'G2 X1 Y1 I1 J0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+############################################################################
+#
+#   Copyright (C) 2008-2015
+#    Christian Kohlöffel
+#    Vinzenz Schulz
+#    Jean-Paul Schouwstra
+#
+#   This file is part of DXF2GCODE.
+#
+#   DXF2GCODE is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DXF2GCODE is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with DXF2GCODE.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+from __future__ import absolute_import
+from __future__ import division
+
+from math import cos, sin, sqrt
+import unittest
+
+import numpy as np
+
+from core.point import Point
+import dxfimport.spline_convert as spline_convert
+from dxfimport.spline_convert import NURBSClass, Spline2Arcs
+
+
+class CountingNURBS(NURBSClass):
+    """
+    Counts the evaluated points of the spline conversion.
+    """
+    evaluations = 0
+
+    def NURBS_evaluate_array(self, n=0, u=()):
+        CountingNURBS.evaluations += len(u)
+        return NURBSClass.NURBS_evaluate_array(self, n, u)
+
+
+def uniform_knots(degree, count):
+    inner = [k / (count - degree) for k in range(1, count - degree)]
+    return [0.0] * (degree + 1) + inner + [1.0] * (degree + 1)
+
+
+def wave():
+    # Zigzag of the control points, the curvature changes its sign everywhere
+    CPoints = [Point(k * 2.0, 5.0 if k % 2 else -5.0) for k in range(40)]
+    return 3, uniform_knots(3, 40), [1.0] * 40, CPoints
+
+
+def spiral():
+    CPoints = [Point((2 + k * 0.5) * cos(k * 0.6), (2 + k * 0.5) * sin(k * 0.6)) for k in range(40)]
+    return 3, uniform_knots(3, 40), [1.0] * 40, CPoints
+
+
+def circle():
+    # Rational quadratic full circle with a radius of 50
+    CPoints = [Point(50.0 * x, 50.0 * y) for x, y in
+               [(1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1), (1, 0)]]
+    Weights = [1.0, sqrt(0.5)] * 4 + [1.0]
+    Knots = [0.0] * 3 + [0.25] * 2 + [0.5] * 2 + [0.75] * 2 + [1.0] * 3
+    return 2, Knots, Weights, CPoints
+
+
+class Spline2ArcsTest(unittest.TestCase):
+    tol = 0.01
+
+    def setUp(self):
+        spline_convert.NURBSClass = CountingNURBS
+        CountingNURBS.evaluations = 0
+
+    def tearDown(self):
+        spline_convert.NURBSClass = NURBSClass
+
+    def convert(self, spline):
+        degree, Knots, Weights, CPoints = spline
+        return Spline2Arcs(degree=degree, Knots=Knots, Weights=Weights,
+                           CPoints=CPoints, tol=self.tol, check=1)
+
+    def max_deviation(self, spline):
+        """
+        Returns the maximum distance of the NURBS to the biarcs of the high
+        accuracy fitting, before they are compressed.
+        """
+        degree, Knots, Weights, CPoints = spline
+        NURBS = NURBSClass(degree=degree, Knots=Knots, Weights=Weights, CPoints=CPoints)
+        Pts = NURBS.NURBS_evaluate_array(n=0, u=np.linspace(1e-9, 1 - 1e-9, 1000)).tolist()
+
+        BiarcCurves = self.convert(spline).calc_high_accurancy_BiarcCurve()[0]
+        errors = [Biarc.get_biarc_fitting_errors(Pts)
+                  for BiarcCurve in BiarcCurves for Biarc in BiarcCurve]
+        return max(min(Pt_errors) for Pt_errors in zip(*errors))
+
+    def test_evaluations(self):
+        # The NURBS is sampled once and only refined where needed, the counts
+        # are pinned to notice when the fitting evaluates more again
+        for spline, evaluations in [(wave(), 1401), (spiral(), 364), (circle(), 106)]:
+            CountingNURBS.evaluations = 0
+            self.convert(spline)
+            self.assertEqual(CountingNURBS.evaluations, evaluations)
+
+    def test_deviation(self):
+        for spline in [wave(), spiral(), circle()]:
+            self.assertLessEqual(self.max_deviation(spline), self.tol)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+############################################################################
+#
+#   Copyright (C) 2008-2015
+#    Christian Kohlöffel
+#    Vinzenz Schulz
+#    Jean-Paul Schouwstra
+#
+#   This file is part of DXF2GCODE.
+#
+#   DXF2GCODE is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DXF2GCODE is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with DXF2GCODE.  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+
+
+from __future__ import absolute_import
+from __future__ import division
+
+import unittest
+
+import numpy as np
+
+from postpro.tspoptimisation import FittnessClass
+
+
+class Population(object):
+    """
+    The tours of a population, as far as FittnessClass uses them.
+    """
+    def __init__(self, tours):
+        self.pop = np.array(tours, dtype=np.intp)
+
+
+def make_fittness(tours, order, precedence):
+    return FittnessClass(Population(tours), [0.0] * len(tours), order, precedence)
+
+
+def positions(tour):
+    return dict((nr, pos) for pos, nr in enumerate(tour))
+
+
+class CorrectPrecedenceTest(unittest.TestCase):
+    # Two parts (0 and 5) with holes, one hole (2) contains an island (3)
+    # with a hole (4) itself. The pairs are (inner, outer).
+    nested = [(1, 0), (2, 0), (3, 2), (4, 3), (6, 5), (7, 5)]
+
+    def assertPrecedence(self, tours, precedence):
+        for tour in tours:
+            pos = positions(tour.tolist())
+            for inner, outer in precedence:
+                self.assertLess(pos[inner], pos[outer])
+
+    def test_nested_shapes(self):
+        rng = np.random.RandomState(1)
+        tours = [rng.permutation(8) for tour_nr in range(20)] + [list(range(8)), list(range(7, -1, -1))]
+        fittness = make_fittness(tours, [], self.nested)
+        fittness.correct_constrain_order()
+        self.assertPrecedence(fittness.population.pop, self.nested)
+        for tour in fittness.population.pop:
+            self.assertEqual(sorted(tour.tolist()), list(range(8)))
+
+    def test_kept_order(self):
+        # A tour which keeps the precedence isn't changed
+        tour = [1, 4, 3, 2, 0, 6, 7, 5]
+        fittness = make_fittness([tour], [], self.nested)
+        fittness.correct_constrain_order()
+        self.assertEqual(fittness.population.pop[0].tolist(), tour)
+
+    def test_deep_chain(self):
+        # Concentric rings, each one inside the next one
+        nr = 3000
+        chain = [(inner, inner + 1) for inner in range(nr - 1)]
+        fittness = make_fittness([list(range(nr - 1, -1, -1))], [], chain)
+        fittness.correct_constrain_order()
+        self.assertEqual(fittness.population.pop[0].tolist(), list(range(nr)))
+
+    def test_fixed_order_ignored(self):
+        fittness = make_fittness([list(range(8))], [0], self.nested)
+        self.assertEqual(sorted(after_nr for after_nr, before_nrs in fittness.precedence), [2, 3, 5])
+
+
+if __name__ == '__main__':
+    unittest.main()